@@ -1,95 +1,412 @@
-from itertools import chain, combinations
-from math import factorial as fact
+import time
+from collections import Counter, OrderedDict, defaultdict
+from itertools import chain
 from typing import Set
 
 from tqdm.auto import tqdm
 
+from paradeller.index import IdView, VocabMasks
+from paradeller.metrics import metrics
+from paradeller.solver import exact_covers
+
 # ---------- FIND STANZAS ----------
 
 
-def find_matches_for_start_pairs(pairs, adj_list_ids, adj_list_words):
+def find_matches_for_start_pairs(
+    pairs, adj_list_ids, adj_list_words, masks=None, stats=None
+):
     """Given a collection of potential start pairs, look for matches on each"""
     all_valid = []
     for p in tqdm(pairs):
-        valid = find_matches(p[0], p[1], adj_list_ids, adj_list_words)
+        valid = find_matches(p[0], p[1], adj_list_ids, adj_list_words, masks, stats)
         if valid:
             all_valid.append((p, valid))
     return all_valid
 
 
-def find_matches(id1, id2, adj_list_ids, adj_list_words):
-    """Given a pair of tweets, look for matches to finish the stanza"""
+def find_matches(
+    id1,
+    id2,
+    adj_list_ids,
+    adj_list_words,
+    masks=None,
+    stats=None,
+    earlier=None,
+    matcher=None,
+):
+    """
+    Given a pair of tweets, look for matches to finish the stanza.
+    Pass `masks` (an index.VocabMasks) to use bitmasks for the subset test,
+    and `stats` (a CandidateStats) to count candidates. Pass `matcher` (a
+    vectorized.VectorMatcher) to search with NumPy instead.
+
+    `earlier` is for when every pair of some seeds gets searched: a
+    predicate on tweet ids, true for seeds in a pair searched before this
+    one. A match of two such tweets has already found this stanza (from
+    the other side), so it's left out, and each stanza comes from one seed.
+
+    Matches are returned as sorted pairs, in sorted order, whichever way
+    they were found, so results don't depend on the backend.
+    """
+    if matcher is not None:
+        return canonical_lines(matcher.find_matches(id1, id2, earlier))
 
     # combine words from tweets
     stanza_words = adj_list_ids[id1] + adj_list_ids[id2]
 
-    # look for other tweets with those words
-    pot_ids = set().union(*[adj_list_words[w] for w in stanza_words])
-
-    # --- filter down ---
-    # remove start tweets
-    # ensure tweets contain subset of master_word_set
-    pot_ids = pot_ids - {id1, id2}
-    pot_ids = [x for x in pot_ids if set(adj_list_ids[x]) <= set(stanza_words)]
+    # look for other tweets with those words,
+    # which only contain words from master_word_set
+    with metrics.timer("find_matches.gather"):
+        pot_ids = gather_candidates(
+            stanza_words, adj_list_ids, adj_list_words, {id1, id2}, masks, stats
+        )
+    metrics.count("find_matches.seeds")
+    metrics.count("find_matches.candidates", len(pot_ids))
+    metrics.observe("find_matches.pot_ids", len(pot_ids))
 
     # look for valid pairs of potential tweets
     if len(pot_ids) > 1:
-        return find_valid_matches(pot_ids, adj_list_ids, stanza_words)
+        with metrics.timer("find_matches.verify"):
+            valid = find_valid_matches(pot_ids, adj_list_ids, stanza_words, earlier)
+        metrics.count("find_matches.matches", len(valid))
+        return canonical_lines(valid)
     return []
 
 
-def find_valid_matches(pot_ids, adj_list_ids, stanza_words):
-    # make pairings of two potential tweets
-    combos = combinations(pot_ids, 2)
+class CandidateStats:
+    """
+    Counters for gather_candidates (the bench's find_matches stage reports
+    them). Posting list entries examined are also counted in metrics, as
+    "find_matches.examined", in every search.
+
+    With compare_union=True, also computes the union of every stanza word's
+    postings (what find_matches used to filter), to report how many
+    candidates were avoided. That is as slow as the old approach, so it is
+    off by default.
+    """
 
-    # for each pair:
-    # get combination of words, check if equals stanza_words
-    valid = []
-    for pair in combos:
-        words = adj_list_ids[pair[0]] + adj_list_ids[pair[1]]
-        if sorted(words) == sorted(stanza_words):
-            valid.append(pair)
-    return valid
+    def __init__(self, compare_union=False):
+        self.compare_union = compare_union
+        self.seeds = 0  # stanzas looked at
+        self.examined = 0  # posting list entries looked at
+        self.kept = 0  # candidates returned
+        self.union = 0  # size of postings union (if compare_union)
+
+    @property
+    def avoided(self) -> int:
+        """Candidates the union approach would have examined, but we didn't"""
+        return self.union - self.examined
+
+    def as_dict(self) -> dict:
+        d = dict(seeds=self.seeds, examined=self.examined, kept=self.kept)
+        if self.compare_union:
+            d.update(union=self.union, avoided=self.avoided)
+        return d
+
+
+def gather_candidates(
+    stanza_words, adj_list_ids, adj_list_words, exclude, masks=None, stats=None
+):
+    """
+    Find tweets (not in exclude) that could be one of the two lines completing
+    a stanza, i.e. ones that belong to a pair matching stanza_words.
+
+    One line of every completing pair must contain the stanza's rarest word,
+    so only that word's postings are scanned for first lines ("anchors").
+    Each anchor fixes the words its partner must have, so partners are
+    looked up in the postings of the rarest of those words.
+    """
+    target = Counter(stanza_words)
+    num_ids = {word: len(adj_list_words[word]) for word in target}
+    rarest = lambda words: min(words, key=num_ids.get)
+
+    # word -> {signature: ids} for subset tweets in that word's postings
+    by_word = {}
+
+    def lookup(word):
+        if word not in by_word:
+            ids = filter_subsets(
+                adj_list_words[word], adj_list_ids, stanza_words, masks
+            )
+            sigs = defaultdict(list)
+            for id_ in ids:
+                if id_ in exclude:
+                    continue
+                sigs[word_signature(adj_list_ids[id_])].append(id_)
+            by_word[word] = sigs
+            metrics.count("find_matches.examined", num_ids[word])
+            if stats is not None:
+                stats.examined += num_ids[word]
+        return by_word[word]
+
+    anchors = lookup(rarest(target))
+    candidates = set()
+    for signature, ids in anchors.items():
+        candidates.update(ids)
+        complement = complement_signature(target, signature)
+        if complement:
+            candidates.update(lookup(rarest(complement)).get(complement, []))
+
+    if stats is not None:
+        stats.seeds += 1
+        stats.kept += len(candidates)
+        if stats.compare_union:
+            union = set().union(*[adj_list_words[w] for w in target]) - exclude
+            stats.union += len(union)
+
+    return list(candidates)
+
+
+def filter_subsets(pot_ids, adj_list_ids, words, masks=None):
+    """
+    Keep potential tweets whose words are all in words.
+    Uses a single AND/compare per tweet if given bitmasks (index.VocabMasks),
+    and an exact check only for those that pass.
+    An index's masks come with it, so they're always used with one.
+    """
+    if masks is None and isinstance(adj_list_ids, IdView):
+        masks = VocabMasks(adj_list_ids.index)
+    if masks is not None:
+        kept = masks.filter_subsets(pot_ids, words)
+    else:
+        word_set = set(words)
+        kept = [x for x in pot_ids if word_set.issuperset(adj_list_ids[x])]
+    metrics.count("filter_subsets.tested", len(pot_ids))
+    metrics.count("filter_subsets.rejected", len(pot_ids) - len(kept))
+    return kept
+
+
+def find_valid_matches(pot_ids, adj_list_ids, stanza_words, earlier=None):
+    """
+    Find pairs of potential tweets whose words together equal stanza_words.
+
+    Each tweet gets a multiset signature; for each tweet we look up the
+    signature of its complement (stanza words minus its words) among the
+    tweets seen so far, so pairs come out without checking every combination.
+    Pairs are returned in the same order as combinations(pot_ids, 2).
+    Pairs of tweets that both pass `earlier` are skipped (see find_matches).
+    """
+    target = Counter(stanza_words)
+
+    # signature -> positions (in pot_ids) of tweets seen so far, and of
+    # those that don't pass earlier
+    seen = defaultdict(list)
+    seen_later = defaultdict(list) if earlier is not None else seen
+
+    found = []
+    for j, id_ in enumerate(pot_ids):
+        words = adj_list_ids[id_]
+        is_earlier = earlier is not None and earlier(id_)
+        complement = complement_signature(target, words)
+        if complement is not None:
+            partners = seen_later if is_earlier else seen
+            found.extend((i, j) for i in partners.get(complement, []))
+        signature = word_signature(words)
+        seen[signature].append(j)
+        if not is_earlier and earlier is not None:
+            seen_later[signature].append(j)
+
+    found.sort()
+    return [(pot_ids[i], pot_ids[j]) for i, j in found]
+
+
+def word_signature(words) -> tuple:
+    """Canonical, hashable signature of a multiset of words"""
+    return tuple(sorted(words))
+
+
+def complement_signature(target, words):
+    """
+    Signature of the words left in target (a Counter) after removing words.
+    Returns None if words is not a sub-multiset of target.
+    """
+    remaining = target.copy()
+    remaining.subtract(words)
+    if any(v < 0 for v in remaining.values()):
+        return None
+    return word_signature(remaining.elements())
 
 
 def consolidate_stanzas(valid_stanzas):
-    stanzas = []
-    for pair, matches in valid_stanzas:
-        t1, t2 = pair
-        stanza_start = [t1, t2]
-        for match in matches:
-            a, b = match
-            stanza = stanza_start + [a, b]
-        stanzas.append(stanza)
-    stanzas = set([tuple(sorted(x)) for x in stanzas])
+    """
+    Every stanza in a list of (pair, matches), in canonical form (see
+    canonical_stanza), in the order they were first found
+    """
+    stanzas = dict.fromkeys(
+        canonical_stanza(pair, match)
+        for pair, matches in valid_stanzas
+        for match in matches
+    )
     return list(stanzas)
 
 
+def canonical_lines(groups) -> list:
+    """Groups of lines (tweet ids), each sorted, in sorted order"""
+    return sorted(tuple(sorted(group)) for group in groups)
+
+
+def canonical_stanza(pair1, pair2) -> tuple:
+    """
+    A stanza is two pairs of tweets with the same words. Its canonical form
+    is (a, b, c, d) with a < b, c < d and a < c, where (a, b) and (c, d)
+    are the pairs. So the first two lines are a pair (the first and second
+    lines of a paradelle stanza) whichever pair it was found from.
+    """
+    first, second = sorted([tuple(sorted(pair1)), tuple(sorted(pair2))])
+    return (*first, *second)
+
+
 # ---------- FIND POEMS ----------
 
 
-def find_final_stanzas_from_stanzas(stanzas, adj_list_ids, adj_list_words):
+def find_final_stanzas_from_stanzas(
+    stanzas, adj_list_ids, adj_list_words, masks=None, cache=None
+):
     """Given a collection of potential start pairs, look for matches on each"""
 
-    # create combos generator
-    all_combos = combinations(stanzas, 3)
-
-    # filtered generator (all lines unique)
-    combos = (c for c in all_combos if len(set().union(*c)) == 12)
+    # generator of plausible stanza triples (all lines unique)
+    combos = stanza_triples(stanzas, adj_list_ids)
 
     all_valid = []
     for combo in tqdm(combos):
-        valid = find_final_stanzas(*combo, adj_list_ids, adj_list_words)
+        valid = find_final_stanzas(*combo, adj_list_ids, adj_list_words, masks, cache)
         if valid:
             all_valid.append((combo, valid))
     return all_valid
 
 
-def find_final_stanzas(stan1, stan2, stan3, adj_list_ids, adj_list_words):
+def stanza_triples(stanzas, adj_list_ids, **kwargs):
+    """
+    Generate triples of stanzas worth searching for a final stanza,
+    in colexicographic order (see triangles).
+
+    Builds a graph of stanzas that share no line and could, between them,
+    still be completed from the corpus word counts (see stanzas_feasible).
+    Triples are the triangles of that graph that are feasible as a whole.
+    Since adding a stanza only makes the word counts harder to meet,
+    every triple skipped here would have been rejected by find_final_stanzas.
+    """
+    feasible = StanzaFeasibility(stanzas, adj_list_ids)
+
+    # neighbors of each stanza that come before it
+    graph = compatibility_graph(stanzas, feasible, **kwargs)
+
+    for u, v, w in triangles(graph, feasible):
+        yield stanzas[u], stanzas[v], stanzas[w]
+
+
+class StanzaFeasibility:
+    """
+    Callable that checks whether a group of stanzas (by position in stanzas)
+    could still be completed from the corpus word counts.
+    """
+
+    def __init__(self, stanzas, adj_list_ids, overall_wc=None):
+        self.stanzas = stanzas
+        self.adj_list_ids = adj_list_ids
+        self.overall_wc = (
+            word_counts(adj_list_ids) if overall_wc is None else overall_wc
+        )
+        self._counts = {}
+
+    def counts(self, i):
+        """(words needed by final stanza, words used) for stanza i"""
+        if i not in self._counts:
+            stanza, words = self.stanzas[i], self.adj_list_ids
+            self._counts[i] = (
+                Counter(chain.from_iterable(words[x] for x in stanza[:2])),
+                Counter(chain.from_iterable(words[x] for x in stanza)),
+            )
+        return self._counts[i]
+
+    def __call__(self, *group) -> bool:
+        needed, used = Counter(), Counter()
+        for i in group:
+            n, u = self.counts(i)
+            needed.update(n)
+            used.update(u)
+        return stanzas_feasible(needed, used, self.overall_wc)
+
+
+def triangles(graph, feasible, start=0, stop=None, deadline=None):
+    """
+    Triangles (u, v, w), with u < v < w, of a graph given as sorted lists of
+    earlier neighbors, that pass feasible(u, v, w). Only triangles whose last
+    node is in range(start, stop) are generated, in colexicographic order.
+    So triangles among the first m nodes are exactly those with w < m.
+    Stops early, possibly partway through a node, once deadline (a
+    time.monotonic() time) passes.
+    """
+    stop = len(graph) if stop is None else stop
+    for w in range(start, stop):
+        w_nbrs = graph[w]
+        for k, v in enumerate(w_nbrs):
+            if deadline is not None and time.monotonic() >= deadline:
+                return
+            v_nbrs = set(graph[v])
+            for u in w_nbrs[:k]:
+                if u in v_nbrs and feasible(u, v, w):
+                    yield u, v, w
+
+
+def compatibility_graph(stanzas, feasible, **kwargs):
+    """
+    For each stanza, sorted list of earlier stanzas that share no line with
+    it and pass feasible(j, i). Pass `deadline` (a time.monotonic() time)
+    to stop at it, with the graph of just the first stanzas.
+    """
+    nobar = kwargs.get("nobar", False)
+    deadline = kwargs.get("deadline")
+    line_sets = [set(stanza) for stanza in stanzas]
+    graph = []
+    for i, lines in enumerate(tqdm(line_sets, disable=nobar)):
+        if deadline is not None and time.monotonic() >= deadline:
+            break
+        graph.append(
+            [j for j in range(i) if lines.isdisjoint(line_sets[j]) and feasible(j, i)]
+        )
+    return graph
+
+
+def stanzas_feasible(needed, used, overall_wc) -> bool:
+    """
+    True if the corpus has enough of each needed word (for a final stanza)
+    outside the lines already used by the previous stanzas.
+    """
+    return all(overall_wc[w] - used[w] >= n for w, n in needed.items())
+
+
+def word_counts(adj_list_ids) -> Counter:
+    """Overall count of each word in the corpus"""
+    overall_wc = Counter()
+    for words in adj_list_ids.values():
+        overall_wc.update(words)
+    return overall_wc
+
+
+def find_final_stanzas(
+    stan1,
+    stan2,
+    stan3,
+    adj_list_ids,
+    adj_list_words,
+    masks=None,
+    cache=None,
+    matcher=None,
+):
+    """
+    Given 3 stanzas, look for lines that finish the poem.
+    Pass `cache` (a FinalStanzaCache) to reuse searches across triples that
+    need the same words, and `matcher` (a vectorized.VectorMatcher) to
+    gather candidate lines with NumPy.
+    """
     pair1, pair2, pair3 = stan1[:2], stan2[:2], stan3[:2]
+    lines = {*stan1, *stan2, *stan3}
+    metrics.count("final_stanzas.triples")
 
     # check for repeated lines
-    if len(set().union(stan1, stan2, stan3)) < 12:
+    if len(lines) < 12:
+        metrics.count("final_stanzas.repeated_lines")
         return []
 
     # combine words from tweets
@@ -97,44 +414,121 @@ def find_final_stanzas(stan1, stan2, stan3, adj_list_ids, adj_list_words):
         chain.from_iterable([adj_list_ids[line] for line in [*pair1, *pair2, *pair3]])
     )
 
-    # look for other tweets with those words
-    pot_ids = set().union(*[adj_list_words[w] for w in prev_stanza_words])
+    if cache is None:
+        return search_final_lines(
+            prev_stanza_words, lines, adj_list_ids, adj_list_words, masks, matcher
+        )
+
+    # search without excluding any lines, so other triples can reuse it
+    key = word_signature(prev_stanza_words)
+    entry = cache.get(key)
+    if entry is None:
+        entry = search_final_lines(
+            prev_stanza_words, set(), adj_list_ids, adj_list_words, masks, matcher
+        )
+        cache.put(key, entry)
+    return [stanza for stanza in entry if lines.isdisjoint(stanza)]
+
+
+def search_final_lines(
+    prev_stanza_words, exclude, adj_list_ids, adj_list_words, masks=None, matcher=None
+):
+    """
+    Look for 6 lines (not in exclude) that use up prev_stanza_words.
+    Each comes back sorted, in sorted order (see canonical_lines).
+    """
 
-    # --- filter down ---
-    # remove lines from previous stanzas
-    # ensure tweets contain subset of master_word_set
-    pot_ids = pot_ids - {*stan1, *stan2, *stan3}
-    pot_ids = [x for x in pot_ids if set(adj_list_ids[x]) <= set(prev_stanza_words)]
+    with metrics.timer("final_lines.gather"):
+        if matcher is not None:
+            pot_ids = matcher.final_candidates(prev_stanza_words, exclude)
+        else:
+            # look for other tweets with those words
+            pot_ids = set().union(*[adj_list_words[w] for w in prev_stanza_words])
+
+            # --- filter down ---
+            # remove lines from previous stanzas
+            # ensure tweets contain subset of master_word_set
+            pot_ids = pot_ids - exclude
+            pot_ids = filter_subsets(pot_ids, adj_list_ids, prev_stanza_words, masks)
+    metrics.count("final_lines.searches")
+    metrics.count("final_lines.candidates", len(pot_ids))
+    metrics.observe("final_lines.pot_ids", len(pot_ids))
 
     # look for valid pairs of potential tweets
     if len(pot_ids) > 1:
-        return find_valid_final_lines(pot_ids, adj_list_ids, prev_stanza_words)
+        with metrics.timer("final_lines.verify"):
+            valid = find_valid_final_lines(pot_ids, adj_list_ids, prev_stanza_words)
+        metrics.count("final_lines.matches", len(valid))
+        return canonical_lines(valid)
     return []
 
 
+class FinalStanzaCache:
+    """
+    LRU cache of final stanza searches, keyed by the signature of the
+    words the final stanza has to use.
+
+    Each entry holds every solution over the whole corpus; callers filter
+    out solutions that reuse their own stanzas' lines. maxsize bounds the
+    total number of tweet ids held, least recently used entries are
+    evicted first.
+    """
+
+    def __init__(self, maxsize=1_000_000):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """Cached solutions for key, or None"""
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return entry
+
+    def put(self, key, solutions):
+        size = 1 + 6 * len(solutions)
+        if size > self.maxsize:
+            return
+        self.entries[key] = solutions
+        self.size += size
+        while self.size > self.maxsize:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= 1 + 6 * len(evicted)
+            self.evictions += 1
+
+    def pop_stats(self) -> dict:
+        """Hit/miss/eviction counts since the last call, then reset them"""
+        stats = dict(hits=self.hits, misses=self.misses, evictions=self.evictions)
+        self.hits = self.misses = self.evictions = 0
+        return stats
+
+
 def find_valid_final_lines(pot_ids, adj_list_ids, prev_stanza_words):
-    """Find valid lines for final stanza"""
-
-    # make pairings of two potential tweets
-    combos = list(combinations(pot_ids, 6))
-
-    # for each pair:
-    # get combination of words, check if equals stanza_words
-    valid = []
-    for stanza in combos:
-        words = list(chain.from_iterable([adj_list_ids[line] for line in stanza]))
-        if sorted(words) == sorted(prev_stanza_words):
-            valid.append(stanza)
+    """
+    Find valid lines for final stanza
+
+    Groups of 6 lines that exactly cover prev_stanza_words, returned in the
+    same order as combinations(pot_ids, 6).
+    """
+    order = {id_: i for i, id_ in enumerate(pot_ids)}
+    valid = list(exact_covers(pot_ids, adj_list_ids, prev_stanza_words, k=6))
+    valid.sort(key=lambda stanza: [order[id_] for id_ in stanza])
     return valid
 
 
 def consolidate_poems(valid_poems):
+    """Every poem in a list of (3 stanzas, final stanzas)"""
     poems = []
     for init_stanzas, matches in valid_poems:
-        poem_start = list(init_stanzas)
         for end in matches:
-            poem = poem_start + [end]
-        poems.append(poem)
+            poems.append([*init_stanzas, end])
     return poems
 
 
@@ -147,4 +541,53 @@ def get_num_combos(n, r):
       - n: types to choose from
       - r: number chosen
     """
-    return fact(n) // (fact(r) * fact(n - r))
+    if r < 0 or r > n:
+        return 0
+    r = min(r, n - r)
+    num = 1
+    for i in range(r):
+        num = num * (n - i) // (i + 1)
+    return num
+
+
+def unrank_combination(rank, r):
+    """
+    Combination (sorted tuple of r indices) at position `rank` in
+    colexicographic order. In that order, every combination of range(m)
+    comes before any that uses index m or above, so ranks below
+    get_num_combos(m, r) are exactly the combinations of range(m).
+    """
+    combo = []
+    for i in range(r, 0, -1):
+        # largest c with C(c, i) <= rank
+        lo, hi = i - 1, i
+        while get_num_combos(hi, i) <= rank:
+            lo, hi = hi, hi * 2
+        while hi - lo > 1:
+            mid = (lo + hi) // 2
+            if get_num_combos(mid, i) <= rank:
+                lo = mid
+            else:
+                hi = mid
+        combo.append(lo)
+        rank -= get_num_combos(lo, i)
+    return tuple(reversed(combo))
+
+
+def combinations_range(r, start, stop):
+    """
+    Combinations of r indices ranked start to stop - 1 in colexicographic
+    order (see unrank_combination), without generating the ones before.
+    """
+    if start >= stop:
+        return
+    combo = list(unrank_combination(start, r))
+    for _ in range(stop - start):
+        yield tuple(combo)
+        # next in colex order: bump the lowest index that has room,
+        # and reset the ones below it
+        i = 0
+        while i < r - 1 and combo[i] + 1 == combo[i + 1]:
+            i += 1
+        combo[i] += 1
+        combo[:i] = range(i)
@@ -0,0 +1,286 @@
+"""
+Append-only tweet archive.
+
+Tweets are stored as JSON lines in numbered segment files, a new segment
+starting once the current one reaches max_segment_bytes. Nothing already
+written is ever rewritten. An index file holds a fixed-size record per
+tweet (id, segment, offset, length), so it's quick to load, and tells
+whether a tweet is already archived without reading any tweets.
+
+Writes go to the segment first and then to the index, each synced to
+disk. If a write is interrupted, whatever the index doesn't cover is
+dropped the next time the archive is opened.
+
+The archive's directory and index are only created when the first tweets
+are added. Reading an archive that doesn't exist (e.g. a mistyped path)
+raises FileNotFoundError, rather than finding it empty.
+"""
+
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from paradeller.helper import archive_fp, data_fp
+
+archive_dir = os.path.join(data_fp, "archive")
+
+INDEX = "index.bin"
+RECORD_DTYPE = np.dtype(
+    [("id", "<i8"), ("segment", "<u4"), ("offset", "<u8"), ("length", "<u4")]
+)
+
+
+class ArchiveStore:
+    """
+    Archive of tweet dicts (id, text, author, time), see module docstring.
+
+    Parameters
+    ----------
+    path : str
+        directory of the archive (created when tweets are first added)
+    max_segment_bytes : int
+        size at which to start a new segment
+    """
+
+    def __init__(self, path=archive_dir, max_segment_bytes=64_000_000):
+        self.path = path
+        self.max_segment_bytes = max_segment_bytes
+        records = self._recover()
+        self._chunks = [records]
+        self._positions = None
+        self.segment = int(records["segment"][-1]) if len(records) else 0
+        self._segment_file = None
+        self._index_file = None
+
+    def _recover(self) -> np.ndarray:
+        """Load index records, dropping anything a crash left half written"""
+        index_fp = os.path.join(self.path, INDEX)
+        if os.path.exists(index_fp):
+            size = os.path.getsize(index_fp)
+            whole = size - size % RECORD_DTYPE.itemsize
+            if whole != size:
+                os.truncate(index_fp, whole)
+            records = np.fromfile(index_fp, dtype=RECORD_DTYPE)
+        else:
+            records = np.zeros(0, dtype=RECORD_DTYPE)
+
+        # the last segment may have lines past its last indexed tweet
+        if len(records):
+            last = records[-1]
+            end = int(last["offset"]) + int(last["length"])
+            fp = self.segment_fp(int(last["segment"]))
+            if os.path.getsize(fp) > end:
+                os.truncate(fp, end)
+        last_segment = int(records["segment"][-1]) if len(records) else -1
+        for fp in self.segment_fps()[last_segment + 1 :]:
+            os.remove(fp)
+        return records
+
+    # ---------- READING ----------
+
+    @property
+    def exists(self) -> bool:
+        """Whether the archive has been created (tweets were ever added)"""
+        return os.path.exists(os.path.join(self.path, INDEX))
+
+    def _check_exists(self):
+        if not self.exists:
+            raise FileNotFoundError(f"no archive in {self.path}")
+
+    @property
+    def records(self) -> np.ndarray:
+        """Index record of each tweet, in the order they were added"""
+        if len(self._chunks) > 1:
+            self._chunks = [np.concatenate(self._chunks)]
+        return self._chunks[0]
+
+    def segment_fp(self, segment) -> str:
+        return os.path.join(self.path, f"segment-{segment:05}.jsonl")
+
+    def segment_fps(self) -> list:
+        if not os.path.isdir(self.path):
+            return []
+        names = sorted(n for n in os.listdir(self.path) if n.startswith("segment-"))
+        return [os.path.join(self.path, n) for n in names]
+
+    @property
+    def positions(self) -> dict:
+        """Tweet id -> position in records (built on first use)"""
+        if self._positions is None:
+            ids = self.records["id"].tolist()
+            self._positions = {id_: pos for pos, id_ in enumerate(ids)}
+        return self._positions
+
+    def __len__(self):
+        return sum(len(chunk) for chunk in self._chunks)
+
+    def __contains__(self, id_):
+        return id_ in self.positions
+
+    def __iter__(self):
+        return self.read()
+
+    def read(self):
+        """Yield every tweet, in the order they were added, one at a time"""
+        self._check_exists()
+        self.flush()
+        segments = self.records["segment"].astype(np.int64)
+        num_segments = int(segments[-1]) + 1 if len(segments) else 0
+        ends = np.zeros(num_segments, dtype=np.int64)
+        np.maximum.at(
+            ends,
+            segments,
+            self.records["offset"].astype(np.int64) + self.records["length"],
+        )
+
+        # only read as far as the index goes
+        for segment in range(num_segments):
+            with open(self.segment_fp(segment), "rb") as file:
+                pos = 0
+                for line in file:
+                    pos += len(line)
+                    if pos > ends[segment]:
+                        break
+                    yield json.loads(line)
+
+    def get(self, id_) -> dict:
+        """A tweet by id, raises KeyError if not archived"""
+        self._check_exists()
+        rec = self.records[self.positions[id_]]
+        self.flush()
+        with open(self.segment_fp(int(rec["segment"])), "rb") as file:
+            file.seek(int(rec["offset"]))
+            return json.loads(file.read(int(rec["length"])))
+
+    def get_many(self, ids) -> dict:
+        """
+        Tweets by id, as a dict. Reads them in file order, opening each
+        segment once. Raises KeyError if any aren't archived.
+        """
+        self._check_exists()
+        positions = self.positions
+        picked = np.array([positions[id_] for id_ in ids], dtype=np.int64)
+        records = self.records[picked]
+        records = records[np.lexsort((records["offset"], records["segment"]))]
+        self.flush()
+
+        found = {}
+        segment, file = None, None
+        try:
+            for rec in records:
+                if int(rec["segment"]) != segment:
+                    if file is not None:
+                        file.close()
+                    segment = int(rec["segment"])
+                    file = open(self.segment_fp(segment), "rb")
+                file.seek(int(rec["offset"]))
+                found[int(rec["id"])] = json.loads(file.read(int(rec["length"])))
+        finally:
+            if file is not None:
+                file.close()
+        return found
+
+    def fingerprint(self) -> str:
+        """Hash of what's in the archive, changes whenever tweets are added"""
+        self._check_exists()
+        return hashlib.blake2b(self.records.tobytes(), digest_size=16).hexdigest()
+
+    @property
+    def size_bytes(self) -> int:
+        """Total size of the archive's files"""
+        fps = self.segment_fps() + [os.path.join(self.path, INDEX)]
+        return sum(os.path.getsize(fp) for fp in fps if os.path.exists(fp))
+
+    # ---------- WRITING ----------
+
+    def add(self, tweets) -> int:
+        """Append tweets that aren't archived yet, returns number added"""
+        new = {}
+        for tweet in tweets:
+            if tweet["id"] not in self.positions:
+                new[tweet["id"]] = tweet
+        if not new:
+            return 0
+
+        lines = [(json.dumps(tweet) + "\n").encode("utf-8") for tweet in new.values()]
+        records = np.zeros(len(lines), dtype=RECORD_DTYPE)
+        file = self._open_segment()
+        offset = file.tell()
+        for i, (id_, line) in enumerate(zip(new, lines)):
+            if offset and offset + len(line) > self.max_segment_bytes:
+                file = self._open_segment(rotate=True)
+                offset = 0
+            file.write(line)
+            records[i] = (id_, self.segment, offset, len(line))
+            offset += len(line)
+        _sync(file)
+
+        # only now are the tweets in the archive
+        records.tofile(self._index_file)
+        _sync(self._index_file)
+        self._chunks.append(records)
+        positions = self.positions
+        for pos, id_ in enumerate(new, len(positions)):
+            positions[id_] = pos
+        return len(new)
+
+    def _open_segment(self, rotate=False):
+        if self._index_file is None:
+            os.makedirs(self.path, exist_ok=True)
+            self._index_file = open(os.path.join(self.path, INDEX), "ab")
+        if rotate:
+            _sync(self._segment_file)
+            self._segment_file.close()
+            self._segment_file = None
+            self.segment += 1
+        if self._segment_file is None:
+            self._segment_file = open(self.segment_fp(self.segment), "ab")
+            self._segment_file.seek(0, os.SEEK_END)
+        return self._segment_file
+
+    def flush(self):
+        for file in (self._segment_file, self._index_file):
+            if file is not None:
+                file.flush()
+
+    def close(self):
+        for file in (self._segment_file, self._index_file):
+            if file is not None:
+                file.close()
+        self._segment_file = self._index_file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # ---------- MIGRATING ----------
+
+    def import_json(self, fp=archive_fp, batch_size=10_000) -> int:
+        """Add the tweets of an old style archive.json, returns number added"""
+        with open(fp) as file:
+            data = json.load(file)
+        added = 0
+        for i in range(0, len(data), batch_size):
+            added += self.add(data[i : i + batch_size])
+        return added
+
+
+def open_archive(**kwargs) -> ArchiveStore:
+    """
+    Open the archive, first importing data/archive.json into it if the
+    archive is empty and there is one.
+    """
+    store = ArchiveStore(**kwargs)
+    if not len(store) and os.path.exists(archive_fp):
+        print("Importing archive.json into segmented archive...")
+        store.import_json(archive_fp)
+    return store
+
+
+def _sync(file):
+    file.flush()
+    os.fsync(file.fileno())
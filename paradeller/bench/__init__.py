@@ -0,0 +1,12 @@
+"""
+Benchmarks on synthetic corpora with planted paradelles.
+
+Usage:
+    python -m paradeller.bench [--sizes 10000,100000] [--out FILE] ...
+    python -m paradeller.bench compare OLD.json NEW.json
+"""
+
+from paradeller.bench.corpus import SyntheticCorpus, synthetic_corpus
+from paradeller.bench.suite import STAGES, measure, run_stages
+
+__all__ = ["STAGES", "SyntheticCorpus", "measure", "run_stages", "synthetic_corpus"]
@@ -0,0 +1,110 @@
+import argparse
+import json
+import os
+import sys
+
+from paradeller.bench.corpus import synthetic_corpus
+from paradeller.bench.suite import STAGES, environment, run_stages
+from paradeller.helper import data_fp
+
+
+def bench(args):
+    sizes = [int(x) for x in args.sizes.split(",")]
+    stages = args.stages.split(",")
+    prep_workers = [int(x) for x in args.prep_workers.split(",")]
+    results = []
+    for size in sizes:
+        print(f"\n---------- {size:,} tweets ----------")
+        corpus = synthetic_corpus(
+            size, plant=args.plant, vocab_size=args.vocab, seed=args.seed
+        )
+        stage_results = run_stages(
+            corpus,
+            stages,
+            args.repeat,
+            args.seeds,
+            args.workers,
+            prep_workers,
+            args.backend,
+        )
+        for res in stage_results:
+            print(
+                f"{res['stage']:20} {res['seconds']:9.3f}s "
+                f"{res['peak_mb']:9.1f} MB  {res['counts']}"
+            )
+            results.append(dict(size=size, **res))
+
+    out = dict(meta=dict(environment(), args=vars(args)), results=results)
+    fp = args.out
+    if fp is None:
+        fp = os.path.join(data_fp, "bench", f"bench_{out['meta']['date']}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(fp)), exist_ok=True)
+    with open(fp, "w") as file:
+        json.dump(out, file, indent=2)
+    print(f"\nresults saved to {fp}")
+
+
+def compare(old_fp, new_fp):
+    """Print how each (size, stage) changed between two benchmark files"""
+    with open(old_fp) as file:
+        old = json.load(file)
+    with open(new_fp) as file:
+        new = json.load(file)
+    before = {(r["size"], r["stage"]): r for r in old["results"]}
+    print(f"{'size':>10} {'stage':20} {'old s':>9} {'new s':>9} {'speedup':>8}")
+    for res in new["results"]:
+        prev = before.get((res["size"], res["stage"]))
+        if prev is None:
+            continue
+        speedup = prev["seconds"] / res["seconds"] if res["seconds"] else float("inf")
+        print(
+            f"{res['size']:>10,} {res['stage']:20} "
+            f"{prev['seconds']:9.3f} {res['seconds']:9.3f} {speedup:7.2f}x"
+        )
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m paradeller.bench",
+        description="Benchmark search stages on synthetic corpora",
+    )
+    parser.add_argument(
+        "--sizes", default="10000,100000", help="comma separated corpus sizes"
+    )
+    parser.add_argument(
+        "--stages",
+        default=",".join(STAGES),
+        help=f"comma separated stages to run (of {', '.join(STAGES)})",
+    )
+    parser.add_argument("--plant", type=int, default=8, help="sample poems to plant")
+    parser.add_argument(
+        "--vocab", type=int, default=50_000, help="distinct words in random tweets"
+    )
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    parser.add_argument(
+        "--seeds", type=int, default=50, help="popular tweets to pair off as seeds"
+    )
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs per stage")
+    parser.add_argument("--workers", type=int, help="worker processes for pipeline")
+    parser.add_argument(
+        "--prep-workers",
+        default="1,2,4",
+        help="comma separated worker counts for prep_parallel",
+    )
+    parser.add_argument(
+        "--backend",
+        choices=["python", "numpy"],
+        default="python",
+        help="how candidate lines are found and checked",
+    )
+    parser.add_argument("--out", help="where to save results (JSON)")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["compare"]:
+        if len(sys.argv) != 4:
+            exit("Usage: python -m paradeller.bench compare OLD.json NEW.json")
+        compare(sys.argv[2], sys.argv[3])
+    else:
+        bench(parse_args())
@@ -0,0 +1,147 @@
+"""
+Synthetic tweet corpora, with paradelles planted in them.
+
+Random tweets draw words from a Zipfian vocabulary of made-up words
+("w0", "w1", ...). Planted tweets are the lines of the sample poems
+(samples/poems.py), each copy with its words renamed (e.g. "heart" ->
+"heartxb"), so copies don't share words with each other or with the
+random tweets. That way each copy's stanzas and poems are exactly those
+of the sample poem it came from.
+"""
+
+import random
+from string import ascii_lowercase
+
+import numpy as np
+
+from paradeller.analysis import canonical_stanza, find_final_stanzas, stanza_triples
+from paradeller.dataprep import prep_data, tokenize
+from paradeller.discover import discover_stanzas
+from paradeller.index import CorpusIndex
+from paradeller.samples import load_samples
+
+
+class SyntheticCorpus:
+    """
+    A synthetic corpus, and what was planted in it.
+
+    Attributes
+    ----------
+    data : list
+        tweet dicts (id, text, author, time), in random order
+    planted_stanzas : list
+        stanzas planted, in canonical form (see analysis.canonical_stanza)
+    planted_poems : list
+        paradelles planted, as (stanza, stanza, stanza, final lines)
+    """
+
+    def __init__(self, data, planted_stanzas, planted_poems):
+        self.data = data
+        self.planted_stanzas = planted_stanzas
+        self.planted_poems = planted_poems
+
+    def __len__(self):
+        return len(self.data)
+
+
+def synthetic_corpus(n, plant=4, vocab_size=50_000, zipf_s=1.1, seed=0):
+    """
+    Make a corpus of about n tweets.
+
+    Parameters
+    ----------
+    n : int
+        number of random tweets
+    plant : int
+        copies of the sample poems to plant (cycling through them)
+    vocab_size : int
+        number of distinct words in random tweets
+    zipf_s : float
+        Zipf exponent: word of rank r is drawn with probability ~ 1 / r^s
+    seed : int
+        random seed, the same seed always makes the same corpus
+    """
+    rng = np.random.default_rng(seed)
+
+    # random tweets of 4 to 10 words
+    weights = 1 / np.arange(1, vocab_size + 1) ** zipf_s
+    cdf = np.cumsum(weights / weights.sum())
+    lengths = rng.integers(4, 11, size=n)
+    word_ids = np.searchsorted(cdf, rng.random(lengths.sum()), side="right")
+    word_ids = np.minimum(word_ids, vocab_size - 1)
+    offsets = np.concatenate([[0], np.cumsum(lengths)]).tolist()
+    words = [f"w{i}" for i in word_ids.tolist()]
+    texts = [" ".join(words[a:b]) for a, b in zip(offsets, offsets[1:])]
+
+    # planted poem lines, with ids after the random tweets
+    planted, stanzas, poems = [], [], []
+    samples = _sample_poems()
+    for copy in range(plant):
+        lines, s_stanzas, s_poems = samples[copy % len(samples)]
+        tag = _tag(copy)
+        id_of = {}
+        for line in lines:
+            id_of[line["id"]] = n + len(planted)
+            renamed = " ".join(w + tag for w in tokenize(line["text"]))
+            planted.append(renamed)
+        rename = lambda ids: tuple(id_of[i] for i in ids)
+        restanza = lambda s: canonical_stanza(rename(s[:2]), rename(s[2:]))
+        stanzas.extend(restanza(s) for s in s_stanzas)
+        poems.extend((*map(restanza, poem[:3]), rename(poem[3])) for poem in s_poems)
+    texts.extend(planted)
+
+    # shuffle where tweets sit in the corpus (ids stay the same)
+    order = list(range(len(texts)))
+    random.Random(seed).shuffle(order)
+    data = [
+        dict(id=i, text=texts[i], author=f"user{i % 997}", time="2020-01-01 00:00:00")
+        for i in order
+    ]
+    return SyntheticCorpus(data, sorted(stanzas), sorted(poems))
+
+
+def _tag(copy) -> str:
+    """Suffix for the words of a planted copy: xa, xb, ..., xz, xaa, ..."""
+    letters = ""
+    copy += 1
+    while copy:
+        copy, r = divmod(copy - 1, 26)
+        letters = ascii_lowercase[r] + letters
+    return "x" + letters
+
+
+_samples_cache = []
+
+
+def _sample_poems():
+    """
+    For each sample poem: its distinct lines (tweet dicts), its stanzas and
+    poems (found by searching the poem's lines on their own).
+
+    Repeated lines are left out, so which copy of a line survives
+    deduplication doesn't depend on where it lands in the corpus.
+    """
+    if not _samples_cache:
+        data = load_samples()
+        for name in sorted({x["poem"] for x in data}):
+            lines, seen = [], set()
+            for line in data:
+                words = tuple(sorted(tokenize(line["text"])))
+                if line["poem"] == name and words not in seen:
+                    seen.add(words)
+                    lines.append(line)
+            _samples_cache.append((lines, *_find_all(lines)))
+    return _samples_cache
+
+
+def _find_all(lines):
+    """Every stanza and poem among some lines"""
+    _, _, adj_list_words, adj_list_ids = prep_data(lines, verbose=False)
+    if not adj_list_ids:
+        return [], []
+    stanzas = discover_stanzas(CorpusIndex.build(adj_list_ids), nobar=True)
+    poems = []
+    for triple in stanza_triples(stanzas, adj_list_ids, nobar=True):
+        for end in find_final_stanzas(*triple, adj_list_ids, adj_list_words):
+            poems.append((*triple, end))
+    return stanzas, poems
@@ -0,0 +1,220 @@
+"""
+Stage benchmarks: time and peak memory of each stage of the search,
+on a synthetic corpus.
+
+Each stage is timed `repeat` times (keeping the best), then run once more
+under tracemalloc for its peak memory. tracemalloc only sees this
+process, so for the pipeline and prep_parallel stages that's the driver,
+not the workers.
+
+With backend="numpy", find_matches, find_final_stanzas and the pipeline
+search with a vectorized.VectorMatcher. Compare with a python run to see
+the difference.
+
+prep_parallel times prep_data_parallel for each of `prep_workers`, to
+see how it scales, and checks its output is the same as prep_data's.
+"""
+
+import gc
+import os
+import platform
+import subprocess
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+from itertools import combinations
+
+from paradeller.analysis import (
+    CandidateStats,
+    FinalStanzaCache,
+    find_final_stanzas,
+    find_matches,
+    stanza_triples,
+)
+from paradeller.checkpoint import Run
+from paradeller.dataprep import prep_data, prep_data_parallel, sort_ids_by_popularity
+from paradeller.helper import DATE_FMT
+from paradeller.index import CorpusIndex, VocabMasks
+from paradeller.parallel import Executor
+from paradeller.run import search_poems, search_stanzas
+from paradeller.vectorized import VectorMatcher
+
+STAGES = ("prep", "prep_parallel", "find_matches", "find_final_stanzas", "pipeline")
+
+
+def measure(func, repeat=3) -> tuple:
+    """Run func, returns (its result, dict of timings and peak memory)"""
+    times = []
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        out = func()
+        times.append(time.perf_counter() - start)
+
+    gc.collect()
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return out, dict(seconds=min(times), times=times, peak_mb=peak / 1e6)
+
+
+def run_stages(
+    corpus,
+    stages=STAGES,
+    repeat=3,
+    seeds=50,
+    workers=None,
+    prep_workers=(1, 2, 4),
+    backend="python",
+) -> list:
+    """
+    Benchmark stages on a SyntheticCorpus.
+
+    Parameters
+    ----------
+    corpus : SyntheticCorpus
+        corpus to search
+    stages : iterable
+        which of STAGES to run
+    repeat : int
+        timed runs of each stage
+    seeds : int
+        number of most popular tweets to pair off as seeds
+    workers : int, optional
+        worker processes for the pipeline stage
+    prep_workers : iterable
+        worker processes to time the prep_parallel stage with
+    backend : str
+        "python" or "numpy", how to find and check candidate lines
+
+    Returns
+    -------
+    list
+        dict for each stage: stage, seconds, times, peak_mb and counts
+    """
+    results = []
+
+    def record(stage, stats, **counts):
+        results.append(dict(stage=stage, **stats, counts=counts))
+
+    # everything else needs the prepared corpus, so always prep
+    prepped, stats = measure(
+        lambda: prep_data(corpus.data, verbose=False), repeat if "prep" in stages else 1
+    )
+    data, _, _, adj_list_ids = prepped
+    if "prep" in stages:
+        record("prep", stats, tweets=len(corpus.data), kept=len(data))
+
+    if "prep_parallel" in stages:
+        base = stats["seconds"]
+        for num in prep_workers:
+            out, stats = measure(
+                lambda: prep_data_parallel(corpus.data, workers=num, verbose=False),
+                repeat,
+            )
+            record(
+                f"prep_parallel_{num}",
+                stats,
+                workers=num,
+                speedup=round(base / stats["seconds"], 2),
+                same=out == prepped,
+            )
+            del out
+
+    index = CorpusIndex.build(adj_list_ids)
+    del adj_list_ids
+    ids_view, words_view = index.adj_list_ids, index.adj_list_words
+    masks = VocabMasks(index)
+    matcher = VectorMatcher(index) if backend == "numpy" else None
+    seed_ids = sort_ids_by_popularity(ids_view, words_view)[:seeds]
+
+    if "find_matches" in stages:
+        pairs = list(combinations(seed_ids, 2))
+
+        def search_pairs():
+            return [
+                find_matches(*pair, ids_view, words_view, masks, matcher=matcher)
+                for pair in pairs
+            ]
+
+        found, stats = measure(search_pairs, repeat)
+        counts = dict(
+            pairs=len(pairs), with_matches=sum(1 for matches in found if matches)
+        )
+        if matcher is None:
+            # untimed: candidates examined, vs the union of every word's postings
+            candidates = CandidateStats(compare_union=True)
+            for pair in pairs:
+                find_matches(*pair, ids_view, words_view, masks, candidates)
+            counts["candidates"] = candidates.as_dict()
+        record("find_matches", stats, **counts)
+
+    if "find_final_stanzas" in stages:
+        # planted stanzas are sure to be there, and to make poems
+        triples = list(stanza_triples(corpus.planted_stanzas, ids_view, nobar=True))
+
+        def search_triples():
+            cache = FinalStanzaCache()
+            return [
+                find_final_stanzas(*triple, ids_view, words_view, masks, cache, matcher)
+                for triple in triples
+            ]
+
+        found, stats = measure(search_triples, repeat)
+        record(
+            "find_final_stanzas",
+            stats,
+            triples=len(triples),
+            poems=sum(len(ends) for ends in found),
+            planted_poems=len(corpus.planted_poems),
+        )
+
+    if "pipeline" in stages:
+
+        def pipeline():
+            with tempfile.TemporaryDirectory() as tmpdir, Executor(
+                index, workers=workers, context=dict(backend=backend)
+            ) as executor:
+                run = Run(tmpdir)
+                stanzas = search_stanzas(executor, run, seed_ids)
+                poems = (
+                    search_poems(executor, run, stanzas) if len(stanzas) >= 3 else []
+                )
+                run.close()
+                return stanzas, poems
+
+        (stanzas, poems), stats = measure(pipeline, repeat)
+        record(
+            "pipeline",
+            stats,
+            seeds=len(seed_ids),
+            stanzas=len(stanzas),
+            poems=len(poems),
+            workers=workers or os.cpu_count(),
+        )
+
+    return results
+
+
+def environment() -> dict:
+    """Where and when a benchmark ran, to tell runs apart"""
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            cwd=os.path.dirname(__file__),
+        ).stdout.strip()
+    except OSError:
+        commit = ""
+    return dict(
+        date=datetime.utcnow().strftime(DATE_FMT),
+        commit=commit,
+        python=platform.python_version(),
+        platform=platform.platform(),
+        cpus=os.cpu_count(),
+    )
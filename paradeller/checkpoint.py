@@ -0,0 +1,215 @@
+"""
+Checkpointed, resumable search runs.
+
+A run lives in its own directory under data/runs, with:
+
+  - results.jsonl: append-only results, one JSON line per non-empty search
+    result, written as workers return them
+  - checkpoint.json: the run's arguments, the corpus fingerprint, which
+    ranges of each phase are done, and how much of results.jsonl they cover
+
+Results past the checkpointed offset (e.g. a half written line from a
+crash) belong to ranges that weren't recorded as done, so on resume the
+file is truncated back to the offset and those ranges are searched again.
+"""
+
+import json
+import os
+import time
+from datetime import datetime
+
+from paradeller.helper import data_fp
+
+runs_fp = os.path.join(data_fp, "runs")
+
+RESULTS = "results.jsonl"
+CHECKPOINT = "checkpoint.json"
+
+
+class Ranges:
+    """Set of integers, stored as sorted, merged [start, stop) intervals"""
+
+    def __init__(self, spans=()):
+        self.spans = []
+        for start, stop in spans:
+            self.add(start, stop)
+
+    def add(self, start, stop):
+        if start >= stop:
+            return
+        merged = []
+        for s, e in self.spans:
+            if e < start or s > stop:
+                merged.append([s, e])
+            else:
+                start, stop = min(s, start), max(e, stop)
+        merged.append([start, stop])
+        self.spans = sorted(merged)
+
+    def missing(self, total):
+        """[start, stop) intervals of range(total) not in the set"""
+        gaps, pos = [], 0
+        for start, stop in self.spans:
+            if start > pos:
+                gaps.append((pos, min(start, total)))
+            pos = max(pos, stop)
+        if pos < total:
+            gaps.append((pos, total))
+        return [(s, e) for s, e in gaps if s < e]
+
+    def overlap(self, start, stop):
+        """[start, stop) intervals of the set within range(start, stop)"""
+        spans = [(max(s, start), min(e, stop)) for s, e in self.spans]
+        return [(s, e) for s, e in spans if s < e]
+
+    def count(self) -> int:
+        return sum(e - s for s, e in self.spans)
+
+
+class Run:
+    """
+    A search run's directory: streamed results plus a checkpoint.
+
+    Parameters
+    ----------
+    path : str
+        run directory (created if needed)
+    every : float
+        seconds between checkpoints
+    """
+
+    def __init__(self, path, every=30):
+        self.path = path
+        self.every = every
+        os.makedirs(path, exist_ok=True)
+        self.state = dict(args={}, fingerprint=None, phases={}, offset=0, stats={})
+        if os.path.exists(self.checkpoint_fp):
+            with open(self.checkpoint_fp) as file:
+                self.state = json.load(file)
+        self.ranges = {
+            phase: Ranges(spans) for phase, spans in self.state["phases"].items()
+        }
+
+        # drop anything written after the last checkpoint
+        self.file = open(self.results_fp, "a+b")
+        self.file.truncate(self.state["offset"])
+        self.file.seek(0, os.SEEK_END)
+        self.last_save = time.monotonic()
+
+    @classmethod
+    def new(cls, **kwargs):
+        """Start a run in a new, timestamped directory"""
+        name = datetime.utcnow().strftime("run_%Y-%m-%d-%H%M%S")
+        path = os.path.join(runs_fp, name)
+        n = 1
+        while os.path.exists(path):
+            n += 1
+            path = os.path.join(runs_fp, f"{name}-{n}")
+        return cls(path, **kwargs)
+
+    @classmethod
+    def resume(cls, path, **kwargs):
+        """Reopen a run, raises FileNotFoundError if it has no checkpoint"""
+        if not has_checkpoint(path):
+            raise FileNotFoundError(f"nothing to resume in {path}: no checkpoint")
+        return cls(path, **kwargs)
+
+    @classmethod
+    def latest(cls, **kwargs):
+        """
+        Reopen the most recently started run that can be resumed: it has a
+        checkpoint, and didn't have a time budget
+        """
+        names = sorted(os.listdir(runs_fp)) if os.path.isdir(runs_fp) else []
+        paths = [os.path.join(runs_fp, name) for name in names]
+        paths = [path for path in paths if has_checkpoint(path)]
+        paths = [path for path in paths if not had_time_budget(path)]
+        if not paths:
+            raise FileNotFoundError(
+                f"no runs to resume in {runs_fp} "
+                "(runs with a time budget can't be resumed)"
+            )
+        return cls(paths[-1], **kwargs)
+
+    @property
+    def results_fp(self):
+        return os.path.join(self.path, RESULTS)
+
+    @property
+    def checkpoint_fp(self):
+        return os.path.join(self.path, CHECKPOINT)
+
+    def done(self, phase) -> Ranges:
+        """Ranges of a phase already searched"""
+        if phase not in self.ranges:
+            self.ranges[phase] = Ranges()
+        return self.ranges[phase]
+
+    def write(self, phase, start, stop, batch, stats=None):
+        """
+        Record the (key, result) batch found for range(start, stop),
+        checkpointing (with stats) if it's been a while.
+        """
+        lines = [
+            json.dumps(dict(phase=phase, key=key, result=result)) + "\n"
+            for key, result in batch
+        ]
+        self.file.write("".join(lines).encode("utf-8"))
+        self.done(phase).add(start, stop)
+        if time.monotonic() - self.last_save >= self.every:
+            self.save(stats)
+
+    def save(self, stats=None):
+        """Write a checkpoint, once results so far are safely on disk"""
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.state["offset"] = self.file.tell()
+        self.state["phases"] = {p: r.spans for p, r in self.ranges.items()}
+        if stats is not None:
+            self.state["stats"] = dict(stats)
+
+        tmp_fp = self.checkpoint_fp + ".tmp"
+        with open(tmp_fp, "w") as file:
+            json.dump(self.state, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_fp, self.checkpoint_fp)
+        self.last_save = time.monotonic()
+
+    def results(self, phase) -> list:
+        """(key, result) of a phase so far, in key order"""
+        self.file.flush()
+        found = []
+        with open(self.results_fp, "rb") as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # partial line at the end of the file
+                    break
+                if record["phase"] == phase:
+                    found.append((_tuples(record["key"]), _tuples(record["result"])))
+        found.sort(key=lambda x: x[0])
+        return found
+
+    def close(self):
+        self.file.close()
+
+
+def has_checkpoint(path) -> bool:
+    """Whether a run directory has a checkpoint to resume from"""
+    return os.path.exists(os.path.join(path, CHECKPOINT))
+
+
+def had_time_budget(path) -> bool:
+    """Whether a checkpointed run was searched with a time budget"""
+    with open(os.path.join(path, CHECKPOINT)) as file:
+        state = json.load(file)
+    return bool(state["args"].get("time_budget"))
+
+
+def _tuples(obj):
+    """Turn JSON lists back into (nested) tuples"""
+    if isinstance(obj, list):
+        return tuple(_tuples(x) for x in obj)
+    return obj
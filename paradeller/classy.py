@@ -1,4 +1,5 @@
 from paradeller.dataprep import (
+    TokenCache,
     find_duplicates,
     filter_out_duplicates,
     filter_out_short,
@@ -9,9 +10,10 @@ from paradeller.dataprep import (
 class RoboPoet:
     def __init__(self, data):
         self.data = data
-        self.duplicates = find_duplicates(data)
+        self.cache = TokenCache()
+        self.duplicates = find_duplicates(data, cache=self.cache)
 
     def filter_data(self):
-        data = filter_out_short(self.data)
+        data = filter_out_short(self.data, cache=self.cache)
         data = filter_out_duplicates(data, self.duplicates)
-        data = filter_out_oddballs_recursive(data)
+        data = filter_out_oddballs_recursive(data, cache=self.cache)
@@ -1,12 +1,33 @@
+import json
+import os
+import pickle
+import shutil
 import string
 from collections import defaultdict, Counter
+from multiprocessing import Pool
 from statistics import mean
 from typing import Dict
 
 import emoji
 from tqdm.auto import tqdm
 
-from paradeller.helper import load_archive, read_from_pickle, save_to_pickle
+from paradeller.archive import open_archive
+from paradeller.helper import data_fp
+from paradeller.index import CorpusIndex
+from paradeller.metrics import metrics
+
+# bump whenever a change here changes what prep_data produces (or a
+# change to CorpusIndex changes what's saved), so prepared corpora saved
+# by older code get rebuilt
+PREP_VERSION = 2
+
+prepared_fp = os.path.join(data_fp, "prepared")
+
+PUNCTUATION = '!"#$%&()*+,-./:;<=>?@[\\]^_`{|}~“”'
+
+# remove apostrophe, replace other punctuation with space
+_punc_table = str.maketrans({"'": None, **{c: " " for c in PUNCTUATION}})
+_emoji_pattern = emoji.get_emoji_regexp()
 
 
 def tokenize(text):
@@ -18,19 +39,48 @@ def tokenize(text):
     list
         list of standardized tokens
     """
-    # remove apostraphe
-    text = text.replace("'", "")
-    # replace other punctuation with space
-    punc = '!"#$%&()*+,-./:;<=>?@[\\]^_`{|}~“”'
-    text = text.translate(str.maketrans(punc, " " * len(punc)))
+    # remove apostraphe & replace other punctuation with space
+    text = text.translate(_punc_table)
     # remove emoji
-    emoji_pattern = emoji.get_emoji_regexp()
-    text = emoji_pattern.sub("", text)
+    text = _emoji_pattern.sub("", text)
     # split into words & clean each word
     words = text.split()
     return [w.lower().strip() for w in words]
 
 
+class TokenCache:
+    """
+    Tokens for each tweet, keyed by tweet id.
+
+    A tweet's text is tokenized the first time it is looked up, and the
+    tokens are reused by every later stage. Pass the same cache to each
+    step as `cache=...` so the corpus is only tokenized once.
+
+    tokens is a dict of id -> tokens already worked out, if any.
+    """
+
+    def __init__(self, tokens=None):
+        self._tokens = {} if tokens is None else tokens
+
+    def __getitem__(self, item):
+        """Tokens for a tweet dict (with "id" and "text")"""
+        id_ = item["id"]
+        tokens = self._tokens.get(id_)
+        if tokens is None:
+            tokens = tokenize(item["text"])
+            self._tokens[id_] = tokens
+        return tokens
+
+    def __len__(self):
+        return len(self._tokens)
+
+
+def _get_cache(kwargs):
+    """Token cache passed in as kwarg, or a fresh one"""
+    cache = kwargs.get("cache")
+    return TokenCache() if cache is None else cache
+
+
 # ---------- FILTERING ----------
 
 
@@ -40,9 +90,10 @@ def find_duplicates(data, **kwargs):
     values are list of ids
     """
     nobar = kwargs.get("nobar", False)
+    cache = _get_cache(kwargs)
     duplicates = defaultdict(list)
     for item in tqdm(data, disable=nobar):
-        words = tokenize(item["text"])
+        words = cache[item]
         words_tup = tuple(sorted(words))
         duplicates[words_tup].append(item["id"])
     return dict(duplicates)
@@ -60,20 +111,31 @@ def filter_out_duplicates(data, duplicates):
 def filter_out_short(data, n=4, **kwargs):
     """Only keep tweets with # tokens >= n"""
     nobar = kwargs.get("nobar", False)
-    return [x for x in tqdm(data, disable=nobar) if len(tokenize(x["text"])) >= n]
+    cache = _get_cache(kwargs)
+    return [x for x in tqdm(data, disable=nobar) if len(cache[x]) >= n]
 
 
 def filter_out_oddballs_recursive(data, verbose=True, **kwargs):
+    """
+    Filter out oddballs (see filter_out_oddballs) until none are left.
+
+    Rather than re-running filter_out_oddballs until nothing changes, word
+    counts and posting lists are updated in place as tweets are removed,
+    and only tweets sharing a word with a removed tweet are checked again.
+    Keeps the same tweets as repeated rounds of filter_out_oddballs.
+    """
     printif = lambda s: print(s) if verbose else None
-    start_len = len(data)
-    data = filter_out_oddballs(data, **kwargs)
-    diff = start_len - len(data)
-    if diff == 0:
-        printif("Nothing removed. Done filtering.")
-        return data
+    cache = _get_cache(kwargs)
+
+    pruner = OddballPruner({item["id"]: cache[item] for item in data})
+    rm_ids = pruner.prune(**kwargs)
+    if rm_ids:
+        printif(f"{len(rm_ids):,} tweets removed.")
     else:
-        printif(f"{diff:,} tweets removed. Running again.")
-        return filter_out_oddballs_recursive(data, verbose=verbose, **kwargs)
+        printif("Nothing removed.")
+    printif("Done filtering.")
+
+    return [x for x in data if x["id"] not in rm_ids]
 
 
 def filter_out_oddballs(data, **kwargs):
@@ -110,6 +172,120 @@ def filter_out_oddballs(data, **kwargs):
     return [x for x in data if x["id"] not in rm_ids]
 
 
+class OddballPruner:
+    """
+    Worklist-based oddball removal.
+
+    Keeps posting lists and word counts for the tweets still in play, and
+    updates them in place whenever a tweet is removed. Only tweets that
+    share a word with a removed tweet are checked again.
+    """
+
+    def __init__(self, tokens_by_id):
+        # id -> Counter of words, for every tweet in play
+        self.counts = {id_: Counter(tokens) for id_, tokens in tokens_by_id.items()}
+        # word -> ids in play, and total count of word among them
+        self.postings: Dict[str, set] = defaultdict(set)
+        self.word_counts: Counter = Counter()
+        # word -> most times it appears in a single tweet
+        self.max_counts: Counter = Counter()
+
+        for id_, counts in self.counts.items():
+            self._add_counts(id_, counts)
+
+    @classmethod
+    def merged(cls, tokens_by_id, partials) -> "OddballPruner":
+        """
+        Pruner for tokens_by_id, from the postings, word counts and max
+        counts of chunks of it (see prep_chunk) rather than from scratch
+        """
+        pruner = cls({})
+        pruner.counts = {id_: Counter(tokens) for id_, tokens in tokens_by_id.items()}
+        for postings, word_counts, max_counts in partials:
+            for word, ids in postings.items():
+                pruner.postings[word].update(ids)
+            pruner.word_counts.update(word_counts)
+            for word, n in max_counts.items():
+                if n > pruner.max_counts[word]:
+                    pruner.max_counts[word] = n
+        return pruner
+
+    def _add_counts(self, id_, counts):
+        for word, n in counts.items():
+            self.postings[word].add(id_)
+            self.word_counts[word] += n
+            if n > self.max_counts[word]:
+                self.max_counts[word] = n
+
+    def is_oddball(self, id_) -> bool:
+        """
+        True if tweet:
+          1) Doesn't share each word with at least 2 other lines, or
+          2) Includes a word enough times that too few remain to complete a poem
+        """
+        for word, n in self.counts[id_].items():
+            if len(self.postings[word]) < 3:
+                return True
+            if self.word_counts[word] - n < n * 2:
+                return True
+        return False
+
+    def _affected(self, word):
+        """Ids in play that may have become oddballs after word lost a tweet"""
+        ids = self.postings[word]
+        if len(ids) < 3:
+            return ids
+        total = self.word_counts[word]
+        if self.max_counts[word] * 3 <= total:
+            # no tweet has enough of this word to fail the word count check
+            return ()
+        return [i for i in ids if self.counts[i][word] * 3 > total]
+
+    def remove(self, id_):
+        """Take a tweet out of play, return ids that need checking again"""
+        counts = self.counts.pop(id_)
+        affected = set()
+        for word, n in counts.items():
+            self.postings[word].discard(id_)
+            self.word_counts[word] -= n
+            affected.update(self._affected(word))
+        return affected
+
+    def prune(self, ids=None, **kwargs) -> set:
+        """
+        Remove oddballs until none are left.
+
+        Parameters
+        ----------
+        ids : iterable, optional
+            ids to check first (default: every tweet in play)
+
+        Returns
+        -------
+        set
+            ids removed
+        """
+        nobar = kwargs.get("nobar", False)
+        worklist = list(self.counts if ids is None else ids)
+        queued = set(worklist)
+        removed = set()
+
+        with tqdm(total=len(worklist), disable=nobar) as bar:
+            while worklist:
+                id_ = worklist.pop()
+                queued.discard(id_)
+                bar.update()
+                if id_ not in self.counts or not self.is_oddball(id_):
+                    continue
+                removed.add(id_)
+                for other in self.remove(id_):
+                    if other not in queued:
+                        queued.add(other)
+                        worklist.append(other)
+                        bar.total += 1
+        return removed
+
+
 # ---------- RESTRUCTURING ----------
 
 
@@ -128,12 +304,13 @@ def restructure_data(data, **kwargs) -> tuple:
         (adj_list_by_word, adj_list_by_id)
     """
     nobar = kwargs.get("nobar", False)
+    cache = _get_cache(kwargs)
 
     adj_list_by_word: Dict[str, set] = defaultdict(set)
     adj_list_by_id: Dict[int, set] = defaultdict(set)
 
     for item in tqdm(data, disable=nobar):
-        tokens = tokenize(item["text"])
+        tokens = cache[item]
         adj_list_by_id[item["id"]] = tokens
         for token in tokens:
             adj_list_by_word[token].add(item["id"])
@@ -142,18 +319,20 @@ def restructure_data(data, **kwargs) -> tuple:
 
 def create_adj_list_by_id(data, **kwargs):
     nobar = kwargs.get("nobar", False)
+    cache = _get_cache(kwargs)
     adj_list_by_id: Dict[int, set] = defaultdict(set)
     for item in tqdm(data, disable=nobar):
-        tokens = tokenize(item["text"])
+        tokens = cache[item]
         adj_list_by_id[item["id"]] = tokens
     return dict(adj_list_by_id)
 
 
 def create_adj_list_by_word(data, **kwargs):
     nobar = kwargs.get("nobar", False)
+    cache = _get_cache(kwargs)
     adj_list_by_word: Dict[str, set] = defaultdict(set)
     for item in tqdm(data, disable=nobar):
-        tokens = tokenize(item["text"])
+        tokens = cache[item]
         for token in tokens:
             adj_list_by_word[token].add(item["id"])
     return dict(adj_list_by_word)
@@ -181,55 +360,175 @@ def prep_data(data, verbose=True):
     printif = lambda s: print(s) if verbose else None
     nobar = not verbose
 
+    # every stage reads tokens from here, so each tweet is tokenized once
+    cache = TokenCache()
+
     showlen(data)
     printif("\nCleaning up data...")
+    metrics.count("prep.tweets", len(data))
 
     # remove too short
     printif("> Remove too short") if verbose else None
-    data = filter_out_short(data, n=4, nobar=nobar)
+    with metrics.timer("prep.filter_short"):
+        data = filter_out_short(data, n=4, nobar=nobar, cache=cache)
     showlen(data)
 
     # remove duplicate phrases
     printif("> Remove duplicate phrases")
-    duplicates = find_duplicates(data, nobar=nobar)
-    data = filter_out_duplicates(data, duplicates)
+    with metrics.timer("prep.duplicates"):
+        duplicates = find_duplicates(data, nobar=nobar, cache=cache)
+        data = filter_out_duplicates(data, duplicates)
     showlen(data)
 
     # remove oddballs (too few matches)
     printif("> Recursively remove oddballs")
-    data = filter_out_oddballs_recursive(data, nobar=nobar, verbose=verbose)
+    with metrics.timer("prep.oddballs"):
+        data = filter_out_oddballs_recursive(
+            data, nobar=nobar, verbose=verbose, cache=cache
+        )
     showlen(data)
 
     # make adj lists
     printif("\nCreating adjacency lists...")
-    adj_list_words, adj_list_ids = restructure_data(data, nobar=nobar)
+    with metrics.timer("prep.restructure"):
+        adj_list_words, adj_list_ids = restructure_data(data, nobar=nobar, cache=cache)
 
     # restructure duplicates
     printif("\nRestructing duplicates...")
     duplicates = create_duplicates_dict(adj_list_ids, duplicates)
+    metrics.count("prep.kept", len(adj_list_ids))
 
     return data, duplicates, adj_list_words, adj_list_ids
 
 
-def load_and_prep(use_pickle=False, update_pickle=False):
+def prep_chunk(items, n=4) -> dict:
+    """
+    Map step of prep_data_parallel, for a chunk of (id, text) tuples.
+
+    Returns a dict of, for the tweets with >= n tokens:
+      - tokens: id -> tokens
+      - signatures: sorted tokens -> ids (as find_duplicates)
+      - postings: word -> ids
+      - word_counts: word -> count
+      - max_counts: word -> most times it appears in a single tweet
     """
-    Load and prep all data, either from file or from pickle.
+    tokens = {}
+    signatures = defaultdict(list)
+    postings = defaultdict(list)
+    word_counts = Counter()
+    max_counts = Counter()
+    for id_, text in items:
+        words = tokenize(text)
+        if len(words) < n:
+            continue
+        tokens[id_] = words
+        signatures[tuple(sorted(words))].append(id_)
+        counts = Counter(words)
+        word_counts.update(counts)
+        for word, k in counts.items():
+            postings[word].append(id_)
+            if k > max_counts[word]:
+                max_counts[word] = k
+    return dict(
+        tokens=tokens,
+        signatures=dict(signatures),
+        postings=dict(postings),
+        word_counts=word_counts,
+        max_counts=max_counts,
+    )
+
+
+def prep_data_parallel(data, workers=None, verbose=True, chunk_size=20_000):
+    """
+    Same as prep_data, with the work spread over worker processes.
+
+    Map: workers tokenize chunks of tweets, drop short ones, and work out
+    each chunk's duplicate signatures, postings and word counts (prep_chunk).
+    Reduce: chunks are merged in order, duplicates are dropped, and
+    oddballs are pruned starting from the merged postings. Tweet ids are
+    assumed unique, as they are in the archive.
+
     Returns tuple: data, duplicates, adj_list_words, adj_list_ids
+    (the same as prep_data would)
+    """
+    showlen = lambda data: print(f"  length: {len(data):,}\n") if verbose else None
+    printif = lambda s: print(s) if verbose else None
+    nobar = not verbose
+    workers = workers or os.cpu_count()
+
+    showlen(data)
+    printif(f"\nTokenizing in {workers} processes...")
+    metrics.count("prep.tweets", len(data))
+    chunks = [
+        [(x["id"], x["text"]) for x in data[i : i + chunk_size]]
+        for i in range(0, len(data), chunk_size)
+    ]
+    with metrics.timer("prep.map"):
+        if workers == 1:
+            parts = [prep_chunk(chunk) for chunk in tqdm(chunks, disable=nobar)]
+        else:
+            with Pool(workers) as pool:
+                parts = list(
+                    tqdm(
+                        pool.imap(prep_chunk, chunks), total=len(chunks), disable=nobar
+                    )
+                )
+
+    printif("> Merge chunks and remove duplicate phrases")
+    with metrics.timer("prep.merge"):
+        tokens_by_id = {}
+        duplicates = defaultdict(list)
+        for part in parts:
+            tokens_by_id.update(part["tokens"])
+            for words_tup, ids in part["signatures"].items():
+                duplicates[words_tup].extend(ids)
+        duplicates = dict(duplicates)
+        pruner = OddballPruner.merged(
+            tokens_by_id,
+            [(p["postings"], p["word_counts"], p["max_counts"]) for p in parts],
+        )
+        del parts
+        # only keep first instance of every phrase
+        unique_ids = {ids[0] for ids in duplicates.values()}
+        for id_ in tokens_by_id:
+            if id_ not in unique_ids:
+                pruner.remove(id_)
+    printif(f"  length: {len(pruner.counts):,}\n")
+
+    printif("> Recursively remove oddballs")
+    with metrics.timer("prep.oddballs"):
+        pruner.prune(nobar=nobar)
+        data = [x for x in data if x["id"] in pruner.counts]
+    showlen(data)
+
+    printif("\nCreating adjacency lists...")
+    with metrics.timer("prep.restructure"):
+        cache = TokenCache(tokens_by_id)
+        adj_list_words, adj_list_ids = restructure_data(data, nobar=nobar, cache=cache)
+
+    printif("\nRestructing duplicates...")
+    duplicates = create_duplicates_dict(adj_list_ids, duplicates)
+    metrics.count("prep.kept", len(adj_list_ids))
+
+    return data, duplicates, adj_list_words, adj_list_ids
+
+
+def load_and_prep(use_pickle=False, update_pickle=False):
     """
+    Load and prep all data, either from the archive or from the prepared
+    corpus cache (see load_prepared).
+    Returns tuple: data, duplicates, adj_list_words, adj_list_ids
 
-    # TODO: If archive.json newer than stuff.pickle, update pickle
+    The adjacency lists are read-only views of the CorpusIndex.
+    With use_pickle=False, the corpus is prepared from the archive, and only
+    cached if update_pickle. With use_pickle=True, a cache that's out of
+    date is prepared again and replaced.
+    """
     print("")
-    if use_pickle:
-        print("Loading processed data from pickle...")
-        data, duplicates, adj_list_words, adj_list_ids = read_from_pickle()
-    else:
-        print("Loading raw data from archive.json...")
-        data = load_archive()
-        data, duplicates, adj_list_words, adj_list_ids = prep_data(data)
-
-        if update_pickle:
-            print("\nSaving new data to pickle...")
-            save_to_pickle((data, duplicates, adj_list_words, adj_list_ids))
+    corpus = load_prepared(rebuild=not use_pickle, save=use_pickle or update_pickle)
+    data, duplicates = corpus.data, corpus.duplicates
+    adj_list_words = corpus.index.adj_list_words
+    adj_list_ids = corpus.index.adj_list_ids
 
     print("-" * 50)
     print("DONE\n")
@@ -245,13 +544,131 @@ def load_and_prep(use_pickle=False, update_pickle=False):
     return data, duplicates, adj_list_words, adj_list_ids
 
 
+# ---------- CACHE ----------
+
+
+class PreparedCorpus:
+    """
+    Prepared corpus: a CorpusIndex of the kept tweets, the duplicates dict,
+    and the kept tweet dicts (`data`).
+
+    Saved to a directory as .npy files for the index (memory mapped on
+    load), plus pickles of data and duplicates. data is only unpickled
+    when it's used.
+    """
+
+    def __init__(self, index: CorpusIndex, duplicates, data=None, path=None):
+        self.index = index
+        self.duplicates = duplicates
+        self.path = path
+        self._data = data
+
+    @classmethod
+    def from_data(cls, data, verbose=True, workers=1):
+        """
+        Prepare a corpus from raw tweet dicts, with prep_data_parallel if
+        workers isn't 1 (None for one per CPU)
+        """
+        if workers == 1:
+            prepped = prep_data(data, verbose=verbose)
+        else:
+            prepped = prep_data_parallel(data, workers=workers, verbose=verbose)
+        data, duplicates, _, adj_list_ids = prepped
+        return cls(CorpusIndex.build(adj_list_ids), duplicates, data)
+
+    @property
+    def data(self) -> list:
+        if self._data is None:
+            with open(os.path.join(self.path, "data.pickle"), "rb") as file:
+                self._data = pickle.load(file)
+        return self._data
+
+    @property
+    def data_len(self) -> int:
+        return len(self.index)
+
+    def save(self, path, key):
+        """Save to a directory, tagged with a cache key (see cache_key)"""
+        tmp_path = path + ".tmp"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        self.index.save(os.path.join(tmp_path, "index"))
+        with open(os.path.join(tmp_path, "data.pickle"), "wb") as file:
+            pickle.dump(self.data, file, protocol=pickle.HIGHEST_PROTOCOL)
+        with open(os.path.join(tmp_path, "duplicates.pickle"), "wb") as file:
+            pickle.dump(self.duplicates, file, protocol=pickle.HIGHEST_PROTOCOL)
+        with open(os.path.join(tmp_path, "key.json"), "w") as file:
+            json.dump(key, file)
+
+        # swap in the new directory
+        shutil.rmtree(path, ignore_errors=True)
+        os.replace(tmp_path, path)
+        self.path = path
+
+    @classmethod
+    def load(cls, path):
+        index = CorpusIndex.load(os.path.join(path, "index"))
+        with open(os.path.join(path, "duplicates.pickle"), "rb") as file:
+            duplicates = pickle.load(file)
+        return cls(index, duplicates, path=path)
+
+
+def cache_key(store) -> dict:
+    """What a prepared corpus depends on: the archive and the prep code"""
+    return dict(archive=store.fingerprint(), prep_version=PREP_VERSION)
+
+
+def saved_key(path=prepared_fp):
+    """Cache key of the prepared corpus saved at path, or None"""
+    try:
+        with open(os.path.join(path, "key.json")) as file:
+            return json.load(file)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def load_prepared(
+    rebuild=False, path=prepared_fp, verbose=True, workers=None, save=True
+) -> PreparedCorpus:
+    """
+    Prepared corpus of the archive, from the cache at path if it's up to
+    date (same archive contents and PREP_VERSION), otherwise prepared
+    from the archive (in `workers` processes, default one per CPU) and
+    cached, unless save is False.
+    """
+    printif = lambda s: print(s) if verbose else None
+    with open_archive() as store:
+        key = cache_key(store)
+        if not rebuild and saved_key(path) == key:
+            printif("Loading prepared corpus from cache...")
+            with metrics.timer("prep.load_cached"):
+                return PreparedCorpus.load(path)
+
+        printif("Loading raw data from archive...")
+        data = list(store)
+
+    corpus = PreparedCorpus.from_data(data, verbose=verbose, workers=workers)
+    if not save:
+        return corpus
+    printif("\nSaving prepared corpus...")
+    with metrics.timer("prep.save"):
+        corpus.save(path, key)
+
+    # reopen, so the index is memory mapped like a warm start
+    return PreparedCorpus.load(path)
+
+
 # --------- SORT ----------
 
 
 def sort_ids_by_popularity(adj_list_ids, adj_list_words):
+    """
+    Sort tweet ids by the mean number of tweets sharing each of their words.
+    Works with plain adjacency lists or the views of an index.CorpusIndex.
+    """
+    num_ids = {word: len(ids) for word, ids in adj_list_words.items()}
     pop = []
     for id_, words in tqdm(adj_list_ids.items()):
-        pop.append((id_, mean([len(adj_list_words[word]) for word in words])))
+        pop.append((id_, mean([num_ids[word] for word in words])))
     pop.sort(key=lambda x: x[1], reverse=True)
     ids = [x[0] for x in pop]
     return ids
@@ -0,0 +1,346 @@
+"""
+Full-corpus stanza discovery.
+
+A stanza is two disjoint pairs of tweets, (t, x) and (c, z), whose
+combined words are equal. Put another way, t - c = z - x: what one line
+has over a line of the other pair is what the other two differ by.
+
+Every line's words are all in the other pair, so its rarest word is in
+one of the other pair's lines. So every stanza splits into two "cross
+pairs", each a line and a line with the other's rarest word: say t's
+rarest word is in c. If x's is in z, (t, c) and (x, z) will do. If not,
+x's is in c, and z's is in t (take (t, z) and (x, c)) or in x (take (t, c)
+and (x, z)).
+
+So rather than every pair of tweets, only cross pairs are generated:
+each row with the rows in its rarest word's postings, both ways round.
+Each (a, b) gets an additive multiset hash of a's words minus b's (a's
+row hash minus b's), and they are grouped by that hash in a sharded hash
+join. Two with the same difference (checked exactly), p - q = r - s, on
+four different rows make the stanza (p, s), (r, q).
+
+The work, and what's held in memory or spilled to disk (16 bytes for each
+way round of a cross pair), grow with the number of cross pairs: the sum
+over rows of their rarest word's postings. That is far fewer than all
+pairs when most tweets have an uncommon word, but still grows with the
+square of the corpus when even tweets' rarest words are common. The
+number is known up front, and discovery stops before it starts if it
+would spill more than max_disk_bytes.
+
+Usage: python -m paradeller.discover [load|fresh|test] [max_pairs] [max_disk_gb]
+"""
+
+import hashlib
+import math
+import os
+import shutil
+import sys
+import tempfile
+from collections import Counter, defaultdict
+from datetime import datetime
+from itertools import combinations
+
+import numpy as np
+from tqdm.auto import tqdm
+
+from paradeller.analysis import canonical_stanza
+from paradeller.dataprep import PreparedCorpus, load_prepared
+from paradeller.helper import DATE_FMT, save_results
+from paradeller.index import CorpusIndex
+from paradeller.samples import load_samples
+from paradeller.vectorized import _ranges
+
+# hash of a cross pair's difference, and the rows it is made of
+PAIR_DTYPE = np.dtype([("h", "<u8"), ("i", "<u4"), ("j", "<u4")])
+
+
+class DiskLimitExceeded(Exception):
+    """Raised when discovery would spill more than it's allowed to disk"""
+
+
+def word_hash(word) -> int:
+    """Stable 64-bit hash of a word"""
+    digest = hashlib.blake2b(word.encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "little")
+
+
+def row_hashes(index: CorpusIndex) -> np.ndarray:
+    """Additive multiset hash of each row (sum of its word hashes, mod 2^64)"""
+    hashes = np.fromiter((word_hash(w) for w in index.vocab), dtype=np.uint64)
+    per_token = hashes[index.tokens]
+    sums = np.zeros(len(index), dtype=np.uint64)
+    lengths = np.diff(index.token_offsets)
+    nonempty = np.flatnonzero(lengths)
+    if len(nonempty):
+        starts = index.token_offsets[:-1][nonempty]
+        sums[nonempty] = np.add.reduceat(per_token, starts)
+    return sums
+
+
+def rarest_words(index: CorpusIndex) -> np.ndarray:
+    """Word id of each row's rarest word (in the fewest rows), -1 if it has none"""
+    lengths = np.diff(index.token_offsets)
+    rows = np.repeat(np.arange(len(index)), lengths)
+    # each row's tokens stay where they are, sorted by how rare they are
+    order = np.lexsort((index.posting_lengths()[index.tokens], rows))
+    rarest = np.full(len(index), -1, dtype=np.int64)
+    nonempty = lengths > 0
+    rarest[nonempty] = index.tokens[order[index.token_offsets[:-1][nonempty]]]
+    return rarest
+
+
+def infeasible_rows(index: CorpusIndex) -> np.ndarray:
+    """
+    Rows that can't be in any stanza, because of the word count constraint:
+    a stanza uses each word of a pair twice (once per pair), so the corpus
+    must have at least twice as many of each of a row's words.
+    """
+    total = np.bincount(index.tokens, minlength=len(index.vocab_offsets) - 1)
+    rows = np.repeat(np.arange(len(index)), np.diff(index.token_offsets))
+    keys, counts = np.unique(
+        rows * len(total) + index.tokens.astype(np.int64), return_counts=True
+    )
+    key_rows, key_words = keys // max(len(total), 1), keys % max(len(total), 1)
+    return np.unique(key_rows[total[key_words] // 2 - counts < 0])
+
+
+def discover_stanzas(
+    index: CorpusIndex,
+    max_pairs=10_000_000,
+    tmpdir=None,
+    max_disk_bytes=10_000_000_000,
+    **kwargs,
+):
+    """
+    Find every stanza in the corpus, via a hash join of cross pairs (see
+    module docstring).
+
+    Parameters
+    ----------
+    index : CorpusIndex
+        prepared corpus
+    max_pairs : int
+        roughly how many cross pairs to hold in memory at once. When there
+        are more than this, they are spilled to disk in shards by hash,
+        and each shard is joined separately.
+    tmpdir : str, optional
+        where to put spilled shards
+    max_disk_bytes : int, optional
+        most bytes to spill, raises DiskLimitExceeded (before starting) if
+        it would take more. None for no limit.
+
+    Returns
+    -------
+    list
+        stanzas, in canonical form (see analysis.canonical_stanza)
+    """
+    nobar = kwargs.get("nobar", False)
+    hashes = row_hashes(index)
+    rarest = rarest_words(index)
+    ok_rows = rarest >= 0
+    ok_rows[infeasible_rows(index)] = False
+    rows = np.flatnonzero(ok_rows)
+
+    # rows each row is paired with, and where they start in the postings
+    starts = index.posting_offsets[rarest[rows]]
+    counts = index.posting_offsets[rarest[rows] + 1] - starts
+
+    # split cross pairs into 2^bits shards, by the top bits of their hash
+    num_pairs = 2 * int(counts.sum())
+    bits = max(0, math.ceil(math.log2(max(num_pairs, 1) / max_pairs)))
+    shards = ShardWriter(bits, max_pairs, tmpdir, max_disk_bytes)
+
+    try:
+        shards.check_size(num_pairs)
+
+        # rows at a time, about max_pairs cross pairs' worth
+        ends = np.cumsum(counts)
+        start = 0
+        with tqdm(total=len(rows), disable=nobar) as bar:
+            while start < len(rows):
+                base = ends[start - 1] if start else 0
+                stop = int(np.searchsorted(ends, base + max_pairs // 2, "right"))
+                chunk = slice(start, max(stop, start + 1))
+                pairs = cross_pairs(
+                    index, rows[chunk], starts[chunk], counts[chunk], hashes, ok_rows
+                )
+                shards.add(pairs)
+                bar.update(chunk.stop - start)
+                start = chunk.stop
+
+        stanzas = set()
+        for pairs in tqdm(shards.read(), total=shards.num_shards, disable=nobar):
+            stanzas.update(join_shard(index, pairs))
+    finally:
+        shards.close()
+
+    ids = index.tweet_ids
+    return sorted(
+        {
+            canonical_stanza(ids[list(p1)].tolist(), ids[list(p2)].tolist())
+            for p1, p2 in stanzas
+        }
+    )
+
+
+def cross_pairs(index, rows, starts, counts, hashes, ok_rows) -> np.ndarray:
+    """
+    Cross pairs of some rows: each with the rows in its rarest word's
+    postings (counts of them from starts), both ways round, with the hash
+    of their difference
+    """
+    a = np.repeat(rows, counts)
+    b = index.postings[_ranges(starts, counts)]
+    keep = (a != b) & ok_rows[b]
+    a, b = a[keep], b[keep]
+    pairs = np.empty(2 * len(a), dtype=PAIR_DTYPE)
+    pairs["i"] = np.concatenate([a, b])
+    pairs["j"] = np.concatenate([b, a])
+    pairs["h"] = hashes[pairs["i"]] - hashes[pairs["j"]]
+    return pairs
+
+
+def join_shard(index: CorpusIndex, pairs: np.ndarray):
+    """Find stanzas among one shard of cross pairs, as pairs of pairs of rows"""
+    # sorted by hash, without the cross pairs found from both their rows
+    pairs = np.unique(pairs)
+    h = pairs["h"]
+    starts = np.flatnonzero(np.r_[True, h[1:] != h[:-1]])
+    stops = np.r_[starts[1:], len(h)]
+    for start, stop in zip(starts.tolist(), stops.tolist()):
+        if stop - start < 2:
+            continue
+
+        # same hash: confirm the differences really match (rule out collisions)
+        by_diff = defaultdict(list)
+        for p, q in zip(
+            pairs["i"][start:stop].tolist(), pairs["j"][start:stop].tolist()
+        ):
+            diff = Counter(index.token_ids(p).tolist())
+            diff.subtract(index.token_ids(q).tolist())
+            by_diff[tuple(sorted((w, n) for w, n in diff.items() if n))].append((p, q))
+
+        # p - q = r - s, so p + s = r + q
+        for matching in by_diff.values():
+            for (p, q), (r, s) in combinations(matching, 2):
+                if len({p, q, r, s}) == 4:
+                    yield (p, s), (r, q)
+
+
+class ShardWriter:
+    """
+    Collects pairs into 2^bits shards, by the top bits of their hash.
+    With one shard, everything stays in memory; otherwise pairs are
+    buffered (up to max_pairs) and spilled to a file per shard, raising
+    DiskLimitExceeded rather than spilling more than max_bytes.
+    """
+
+    def __init__(self, bits, max_pairs, tmpdir=None, max_bytes=None):
+        self.bits = bits
+        self.num_shards = 2**bits
+        self.max_pairs = max_pairs
+        self.max_bytes = max_bytes
+        self.buffer = []
+        self.buffered = 0
+        self.spilled = 0  # bytes written to shard files
+        self.dir = tempfile.mkdtemp(prefix="discover-", dir=tmpdir) if bits else None
+
+    def check_size(self, num_pairs):
+        """Raise DiskLimitExceeded now if num_pairs would spill too much"""
+        nbytes = num_pairs * PAIR_DTYPE.itemsize
+        if self.bits and self.max_bytes is not None and nbytes > self.max_bytes:
+            raise DiskLimitExceeded(
+                f"{num_pairs:,} cross pairs would spill {nbytes / 1e9:.1f} GB to "
+                f"disk, more than the limit of {self.max_bytes / 1e9:.1f} GB"
+            )
+
+    def path(self, shard):
+        return os.path.join(self.dir, f"shard-{shard:05}.bin")
+
+    def add(self, pairs):
+        self.buffer.append(pairs)
+        self.buffered += len(pairs)
+        if self.bits and self.buffered >= self.max_pairs:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        pairs = np.concatenate(self.buffer)
+        self.buffer, self.buffered = [], 0
+        self.spilled += pairs.nbytes
+        if self.max_bytes is not None and self.spilled > self.max_bytes:
+            raise DiskLimitExceeded(
+                f"spilled more than the limit of {self.max_bytes / 1e9:.1f} GB to disk"
+            )
+        shard_of = pairs["h"] >> np.uint64(64 - self.bits)
+        order = np.argsort(shard_of, kind="stable")
+        pairs, shard_of = pairs[order], shard_of[order]
+        bounds = np.searchsorted(shard_of, np.arange(self.num_shards + 1))
+        for shard in range(self.num_shards):
+            start, stop = bounds[shard], bounds[shard + 1]
+            if stop > start:
+                with open(self.path(shard), "ab") as file:
+                    pairs[start:stop].tofile(file)
+
+    def read(self):
+        """Yield the pairs of each shard in turn"""
+        if not self.bits:
+            pairs = self.buffer
+            self.buffer, self.buffered = [], 0
+            yield np.concatenate(pairs) if pairs else np.empty(0, dtype=PAIR_DTYPE)
+            return
+        self.flush()
+        for shard in range(self.num_shards):
+            path = self.path(shard)
+            if os.path.exists(path):
+                yield np.fromfile(path, dtype=PAIR_DTYPE)
+            else:
+                yield np.empty(0, dtype=PAIR_DTYPE)
+
+    def close(self):
+        if self.dir:
+            shutil.rmtree(self.dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    # parse command line arguments
+    args_dict = dict(enumerate(sys.argv))
+    style = args_dict.get(1, "load")  # load | fresh | test
+    max_pairs = int(args_dict.get(2, "10000000"))  # pairs held in memory
+    max_disk_gb = float(args_dict.get(3, "10"))  # most to spill to disk
+
+    # note start time
+    start_time = datetime.utcnow()
+
+    # load & prepare data
+    if style == "load":
+        corpus = load_prepared()
+    elif style == "fresh":
+        corpus = load_prepared(rebuild=True)
+    elif style == "test":
+        print("Loading samples")
+        corpus = PreparedCorpus.from_data(load_samples(), verbose=False)
+    else:
+        exit("Invalid argument")
+    index = corpus.index
+
+    print("\nJoining cross pairs of tweets...")
+    try:
+        stanzas = discover_stanzas(
+            index, max_pairs=max_pairs, max_disk_bytes=max_disk_gb * 1e9
+        )
+    except DiskLimitExceeded as e:
+        exit(str(e))
+    print(f"Found {len(stanzas)} results.")
+
+    stop_time = datetime.utcnow()
+    meta = dict(
+        start_time=start_time.strftime(DATE_FMT),
+        stop_time=stop_time.strftime(DATE_FMT),
+        mode="discover",
+        style=style,
+        data_len=corpus.data_len,
+    )
+    results = dict(meta=meta, stanzas=stanzas, poems=[], duplicates=corpus.duplicates)
+    save_results(results)
@@ -0,0 +1,228 @@
+"""
+Incremental corpus updates and stanza detection.
+
+IncrementalCorpus keeps the same state that prep_data builds (short and
+duplicate tweets skipped, oddballs pruned, adjacency lists), but takes
+tweets in batches. Each batch is applied as a delta, and the only stanzas
+searched for are the ones that use at least one line that just came into
+play. So after every batch, the stanzas found so far are exactly the
+stanzas of the corpus prep_data would make from all tweets seen.
+
+Usage: python -m paradeller.incremental [n] [--fake FILE]
+    prepare the archive, then scrape n more batches, printing (and
+    saving) stanzas that use the new tweets as they turn up
+"""
+
+import argparse
+import asyncio
+import json
+import os
+from collections import Counter, defaultdict
+from datetime import datetime
+
+from paradeller.analysis import canonical_stanza, word_signature
+from paradeller.archive import open_archive
+from paradeller.dataprep import OddballPruner, tokenize
+from paradeller.helper import DATE_FMT, data_fp
+from paradeller.ingest import FakeSource, TweepySource, ingest
+
+
+class IncrementalCorpus:
+    """
+    Prepared corpus that grows a batch of tweets at a time.
+
+    Tweets pruned as oddballs are kept aside: new tweets can raise the
+    counts of their words enough to bring them back into play.
+    """
+
+    def __init__(self, min_len=4):
+        self.min_len = min_len
+        self.seen = set()  # every id added
+        self.tokens = {}  # id -> tokens, for first instances of a word set
+        self.duplicates = defaultdict(list)  # word signature -> ids
+        self.pruner = OddballPruner({})  # tweets in play
+        self.signatures = {}  # word signature -> id in play
+        # pruned tweets, and word -> pruned ids with it
+        self.removed = set()
+        self.removed_postings = defaultdict(set)
+        self.stanzas = set()
+
+    @property
+    def adj_list_ids(self) -> dict:
+        """Tweet id -> list of words, for tweets in play"""
+        return {id_: self.tokens[id_] for id_ in self.pruner.counts}
+
+    @property
+    def adj_list_words(self) -> dict:
+        """Word -> set of ids in play"""
+        return {w: ids for w, ids in self.pruner.postings.items() if ids}
+
+    def __len__(self):
+        return len(self.pruner.counts)
+
+    def add(self, tweets, search=True) -> list:
+        """
+        Add a batch of tweet dicts (with "id" and "text").
+        Returns new stanzas, in canonical form (see analysis.canonical_stanza).
+
+        With search=False, the batch's lines aren't searched for stanzas
+        (e.g. to load an existing corpus quickly), so later batches only
+        find stanzas that use their own lines.
+        """
+        new = []
+        for item in tweets:
+            id_ = item["id"]
+            if id_ in self.seen:
+                continue
+            self.seen.add(id_)
+            tokens = tokenize(item["text"])
+            if len(tokens) < self.min_len:
+                continue
+            dups = self.duplicates[word_signature(tokens)]
+            dups.append(id_)
+            if len(dups) == 1:
+                self.tokens[id_] = tokens
+                new.append(id_)
+
+        lines = self._update_play(new)
+        if not search:
+            return []
+        found = set()
+        for id_ in lines:
+            found.update(self.stanzas_with(id_))
+        found -= self.stanzas
+        self.stanzas |= found
+        return sorted(found)
+
+    def _update_play(self, new) -> set:
+        """Bring new tweets into play, return ids that came into play"""
+
+        # pruned tweets sharing a word with a tweet coming into play might
+        # be kept now (and might keep each other), so try them all again
+        candidates = set(new)
+        changed = set()
+        frontier = {w for id_ in new for w in self.tokens[id_]}
+        while frontier:
+            changed |= frontier
+            revived = set()
+            for word in frontier:
+                revived |= self.removed_postings[word]
+            revived -= candidates
+            candidates |= revived
+            frontier = {w for id_ in revived for w in self.tokens[id_]} - changed
+
+        for id_ in candidates:
+            if id_ in self.removed:
+                self._unremove(id_)
+            counts = Counter(self.tokens[id_])
+            self.pruner.counts[id_] = counts
+            self.pruner._add_counts(id_, counts)
+
+        # tweets in play before can't have become oddballs
+        pruned = self.pruner.prune(candidates, nobar=True)
+        for id_ in pruned:
+            self.removed.add(id_)
+            for word in self.tokens[id_]:
+                self.removed_postings[word].add(id_)
+
+        lines = candidates - pruned
+        for id_ in lines:
+            self.signatures[word_signature(self.tokens[id_])] = id_
+        return lines
+
+    def _unremove(self, id_):
+        self.removed.discard(id_)
+        for word in self.tokens[id_]:
+            self.removed_postings[word].discard(id_)
+
+    def stanzas_with(self, t):
+        """
+        Stanzas (in canonical form) with line t, among tweets in play.
+
+        A stanza is pairs (t, x) and (c, z) with the same words. The other
+        pair covers all of t's words, so one of its lines, c, has t's
+        rarest word. Given c, z has x's words plus P (t's words not in c)
+        minus Q (c's words not in t). So if P isn't empty, z has P's rarest
+        word and x is looked up by signature; otherwise x has Q's rarest
+        word and z is looked up.
+        """
+        counts, postings = self.pruner.counts, self.pruner.postings
+        rarest = lambda words: min(words, key=lambda w: len(postings[w]))
+
+        words = counts[t]
+        for c in list(postings[rarest(words)]):
+            if c == t:
+                continue
+            P = words - counts[c]
+            Q = counts[c] - words
+            if P:
+                pairs = (
+                    (self._lookup(counts[z], P, Q), z) for z in postings[rarest(P)]
+                )
+            else:
+                pairs = (
+                    (x, self._lookup(counts[x], Q, P)) for x in postings[rarest(Q)]
+                )
+            for x, z in pairs:
+                if x is not None and z is not None and len({t, x, c, z}) == 4:
+                    yield canonical_stanza((t, x), (c, z))
+
+    def _lookup(self, counts, minus, plus):
+        """Id in play whose words are counts - minus + plus, or None"""
+        if any(counts[w] < n for w, n in minus.items()):
+            return None
+        return self.signatures.get(word_signature((counts - minus + plus).elements()))
+
+
+# ---------- LIVE ----------
+
+
+def watch(n, source, fetchers=4, fp=None):
+    """
+    Prepare the archive, then scrape n batches from source, adding them to
+    the archive and to an IncrementalCorpus. Stanzas using the new tweets
+    are printed, and appended to a JSON lines file, as they turn up.
+    """
+    if fp is None:
+        dt_string = datetime.utcnow().strftime(DATE_FMT)
+        fp = os.path.join(data_fp, "found", f"incremental_{dt_string}.jsonl")
+    os.makedirs(os.path.dirname(fp), exist_ok=True)
+
+    corpus = IncrementalCorpus()
+    with open_archive() as store, open(fp, "a") as out:
+        if store.exists:
+            print("Preparing archive...")
+            corpus.add(store, search=False)
+        print(f"{len(corpus):,} tweets in play")
+
+        def emit(batch):
+            for stanza in corpus.add(batch):
+                print(f"New stanza: {stanza}")
+                out.write(json.dumps(stanza) + "\n")
+            out.flush()
+
+        print("\nScraping!")
+        stats = asyncio.run(ingest(source, store, n, fetchers=fetchers, sink=emit))
+    print(f"\nAdded {stats['added']:,} tweets, {len(corpus.stanzas):,} stanzas")
+    print(f"stanzas saved to {fp}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog="python -m paradeller.incremental",
+        description="Scrape tweets, looking for new stanzas as they come in",
+    )
+    parser.add_argument(
+        "n", nargs="?", type=int, default=200, help="number of searches to make"
+    )
+    parser.add_argument(
+        "--fetchers", type=int, default=4, help="searches to run concurrently"
+    )
+    parser.add_argument(
+        "--fake",
+        metavar="FILE",
+        help="replay canned tweets from a JSON lines file instead of searching",
+    )
+    args = parser.parse_args()
+    source = FakeSource(args.fake) if args.fake else TweepySource()
+    watch(args.n, source, fetchers=args.fetchers)
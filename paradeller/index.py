@@ -0,0 +1,401 @@
+import hashlib
+import os
+from collections import Counter
+from collections.abc import Mapping, Set
+from typing import Dict
+
+import numpy as np
+
+
+class CorpusIndex:
+    """
+    Compact, array-backed index of a prepared corpus.
+
+    Words are interned to dense integer ids and tweets to dense row numbers.
+    Each tweet's word ids and each word's rows are stored back to back in
+    flat arrays, with offset arrays marking where each one starts, e.g. the
+    word ids of row r are tokens[token_offsets[r]:token_offsets[r + 1]].
+
+    `adj_list_ids` and `adj_list_words` are read-only views with the same
+    interface as the dicts made by `dataprep.restructure_data`, so the
+    functions in `analysis` can run against an index unchanged. Each lookup
+    through them costs more than a dict's, so hot paths work on rows and
+    word ids instead (rows_of, tokens_of, rows_with, VocabMasks).
+    """
+
+    # flat arrays that make up an index
+    ARRAYS = (
+        "vocab_blob",  # uint8, utf-8 encoded words back to back
+        "vocab_offsets",  # int64, len(vocab) + 1
+        "tweet_ids",  # int64, tweet id of each row
+        "id_order",  # int64, rows sorted by tweet id (for lookups)
+        "token_offsets",  # int64, len(tweet_ids) + 1
+        "tokens",  # int32, word ids of each row, in order
+        "posting_offsets",  # int64, len(vocab) + 1
+        "postings",  # int32, rows containing each word, ascending
+        "row_masks",  # uint64, hashed word mask of each row (see VocabMasks)
+    )
+
+    def __init__(self, arrays: Dict[str, np.ndarray], path=None):
+        for name in self.ARRAYS:
+            # plain ndarray views of memory maps (no copy): indexing an
+            # np.memmap is several times slower, and the index does a lot
+            setattr(self, name, arrays[name].view(np.ndarray))
+        self.path = path  # directory the arrays are mapped from, if any
+        self._vocab = None
+        self._word_ids = None
+        self._sorted_ids = None
+
+    def __getstate__(self):
+        return self.arrays
+
+    def __setstate__(self, state):
+        self.__init__(state)
+
+    @property
+    def arrays(self) -> Dict[str, np.ndarray]:
+        return {name: getattr(self, name) for name in self.ARRAYS}
+
+    # ---------- BUILDING ----------
+
+    @classmethod
+    def build(cls, adj_list_ids):
+        """
+        Build index from an adjacency list of tweet id -> list of words,
+        as made by `dataprep.restructure_data`.
+        """
+        word_ids: Dict[str, int] = {}
+        tweet_ids = np.fromiter(adj_list_ids.keys(), dtype=np.int64)
+        lengths = np.fromiter(
+            (len(words) for words in adj_list_ids.values()), dtype=np.int64
+        )
+        tokens = np.fromiter(
+            (
+                word_ids.setdefault(word, len(word_ids))
+                for words in adj_list_ids.values()
+                for word in words
+            ),
+            dtype=np.int32,
+        )
+        token_offsets = np.zeros(len(tweet_ids) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=token_offsets[1:])
+
+        # vocab, as one utf-8 blob
+        encoded = [word.encode("utf-8") for word in word_ids]
+        vocab_offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum(
+            np.fromiter((len(b) for b in encoded), dtype=np.int64),
+            out=vocab_offsets[1:],
+        )
+        vocab_blob = np.frombuffer(b"".join(encoded), dtype=np.uint8).copy()
+
+        # postings: unique (word, row) pairs, grouped by word
+        rows = np.repeat(np.arange(len(tweet_ids), dtype=np.int32), lengths)
+        pairs = np.unique(tokens.astype(np.int64) * len(tweet_ids) + rows)
+        posting_words = pairs // max(len(tweet_ids), 1)
+        postings = (pairs % max(len(tweet_ids), 1)).astype(np.int32)
+        posting_offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum(
+            np.bincount(posting_words, minlength=len(encoded)),
+            out=posting_offsets[1:],
+        )
+
+        # OR of each row's word bits (an empty row keeps a zero mask)
+        row_masks = np.zeros(len(tweet_ids), dtype=np.uint64)
+        nonempty = lengths > 0
+        if nonempty.any():
+            row_masks[nonempty] = np.bitwise_or.reduceat(
+                word_bits(tokens), token_offsets[:-1][nonempty]
+            )
+
+        return cls(
+            dict(
+                vocab_blob=vocab_blob,
+                vocab_offsets=vocab_offsets,
+                tweet_ids=tweet_ids,
+                id_order=np.argsort(tweet_ids, kind="stable"),
+                token_offsets=token_offsets,
+                tokens=tokens,
+                posting_offsets=posting_offsets,
+                postings=postings,
+                row_masks=row_masks,
+            )
+        )
+
+    # ---------- SAVING ----------
+
+    def save(self, path):
+        """Save arrays as .npy files in a directory"""
+        os.makedirs(path, exist_ok=True)
+        for name, arr in self.arrays.items():
+            np.save(os.path.join(path, f"{name}.npy"), arr)
+
+    @classmethod
+    def load(cls, path, mmap_mode="r"):
+        """
+        Load an index saved with `save`. By default the arrays are memory
+        mapped, so loading is quick, and processes that load the same
+        index share its pages.
+        """
+        arrays = {}
+        for name in cls.ARRAYS:
+            fp = os.path.join(path, f"{name}.npy")
+            try:
+                arrays[name] = np.load(fp, mmap_mode=mmap_mode)
+            except ValueError:
+                # empty arrays can't be mapped
+                arrays[name] = np.load(fp)
+        return cls(arrays, path=path if mmap_mode else None)
+
+    # ---------- READING ----------
+
+    @property
+    def vocab(self) -> list:
+        """Word for each word id"""
+        if self._vocab is None:
+            blob = self.vocab_blob.tobytes()
+            offsets = self.vocab_offsets.tolist()
+            self._vocab = [
+                blob[start:stop].decode("utf-8")
+                for start, stop in zip(offsets, offsets[1:])
+            ]
+        return self._vocab
+
+    def word_id(self, word) -> int:
+        """Word id of a word, raises KeyError if not in vocab"""
+        if self._word_ids is None:
+            self._word_ids = {w: i for i, w in enumerate(self.vocab)}
+        return self._word_ids[word]
+
+    @property
+    def sorted_ids(self) -> np.ndarray:
+        """Tweet ids in ascending order (of rows id_order)"""
+        if self._sorted_ids is None:
+            self._sorted_ids = self.tweet_ids[self.id_order]
+        return self._sorted_ids
+
+    def row_of(self, id_) -> int:
+        """Row of a tweet id, raises KeyError if not in index"""
+        sorted_ids = self.sorted_ids
+        pos = int(sorted_ids.searchsorted(id_))
+        if pos < len(sorted_ids) and sorted_ids[pos] == id_:
+            return int(self.id_order[pos])
+        raise KeyError(id_)
+
+    def rows_of(self, ids) -> np.ndarray:
+        """Rows of some tweet ids (in order), raises KeyError if any aren't in index"""
+        ids = np.fromiter(ids, dtype=np.int64)
+        if not len(ids) or not len(self.id_order):
+            if len(ids):
+                raise KeyError(int(ids[0]))
+            return np.zeros(0, dtype=np.int64)
+        pos = np.minimum(self.sorted_ids.searchsorted(ids), len(self.id_order) - 1)
+        missing = self.sorted_ids[pos] != ids
+        if missing.any():
+            raise KeyError(int(ids[missing][0]))
+        return self.id_order[pos]
+
+    def tokens_of(self, rows) -> tuple:
+        """
+        Word ids of some rows back to back, and the position (in rows) of
+        the row each came from
+        """
+        starts = self.token_offsets[rows]
+        lengths = self.token_offsets[rows + 1] - starts
+        owners = np.repeat(np.arange(len(rows)), lengths)
+        # start of each token's row, minus where its row begins in the output
+        ends = np.cumsum(lengths)
+        shift = np.repeat(starts - (ends - lengths), lengths)
+        return self.tokens[np.arange(int(ends[-1]) if len(ends) else 0) + shift], owners
+
+    def token_ids(self, row) -> np.ndarray:
+        """Word ids of a row, in order (with repeats)"""
+        start, stop = self.token_offsets[row : row + 2].tolist()
+        return self.tokens[start:stop]
+
+    def rows_with(self, word_id) -> np.ndarray:
+        """Rows that contain a word id"""
+        start, stop = self.posting_offsets[word_id : word_id + 2].tolist()
+        return self.postings[start:stop]
+
+    def words(self, row) -> list:
+        """Words of a row, in order (with repeats)"""
+        vocab = self.vocab
+        return [vocab[i] for i in self.token_ids(row).tolist()]
+
+    def word_counts(self) -> Counter:
+        """Number of times each word is used in the corpus"""
+        counts = np.bincount(self.tokens, minlength=len(self.vocab_offsets) - 1)
+        return Counter(dict(zip(self.vocab, counts.tolist())))
+
+    def posting_lengths(self) -> np.ndarray:
+        """Number of tweets containing each word id"""
+        return np.diff(self.posting_offsets)
+
+    def __len__(self):
+        return len(self.tweet_ids)
+
+    def fingerprint(self) -> str:
+        """Hash of the corpus contents, to tell if saved work still applies"""
+        digest = hashlib.blake2b(digest_size=16)
+        for name in ("vocab_blob", "vocab_offsets", "tweet_ids", "token_offsets"):
+            digest.update(getattr(self, name).tobytes())
+        digest.update(self.tokens.astype("<i4").tobytes())
+        return digest.hexdigest()
+
+    @property
+    def adj_list_ids(self) -> "IdView":
+        return IdView(self)
+
+    @property
+    def adj_list_words(self) -> "WordView":
+        return WordView(self)
+
+
+class IdView(Mapping):
+    """Read-only tweet id -> list of words, backed by a CorpusIndex"""
+
+    def __init__(self, index: CorpusIndex):
+        self.index = index
+
+    def __getitem__(self, id_):
+        return self.index.words(self.index.row_of(id_))
+
+    def __iter__(self):
+        return iter(self.index.tweet_ids.tolist())
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, id_):
+        try:
+            self.index.row_of(id_)
+        except KeyError:
+            return False
+        return True
+
+
+class WordView(Mapping):
+    """Read-only word -> set of tweet ids, backed by a CorpusIndex"""
+
+    def __init__(self, index: CorpusIndex):
+        self.index = index
+
+    def __getitem__(self, word):
+        return Postings(self.index, self.index.rows_with(self.index.word_id(word)))
+
+    def __iter__(self):
+        return iter(self.index.vocab)
+
+    def __len__(self):
+        return len(self.index.vocab_offsets) - 1
+
+    def __contains__(self, word):
+        try:
+            self.index.word_id(word)
+        except KeyError:
+            return False
+        return True
+
+
+class Postings(Set):
+    """
+    Read-only set of the tweet ids containing a word, backed by a CorpusIndex.
+    Its size is known without decoding any ids.
+    """
+
+    def __init__(self, index: CorpusIndex, rows: np.ndarray):
+        self.index = index
+        self.rows = rows
+
+    @classmethod
+    def _from_iterable(cls, it):
+        return set(it)
+
+    def __iter__(self):
+        return iter(self.index.tweet_ids[self.rows].tolist())
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __contains__(self, id_):
+        try:
+            row = self.index.row_of(id_)
+        except KeyError:
+            return False
+        pos = int(self.rows.searchsorted(row))
+        return pos < len(self.rows) and self.rows[pos] == row
+
+    # set operations decode the ids once, as a set, rather than going
+    # through Set's generic ones an item at a time
+
+    def __and__(self, other):
+        return set(self).intersection(other)
+
+    def __or__(self, other):
+        return set(self).union(other)
+
+    def __sub__(self, other):
+        return set(self).difference(other)
+
+    def __xor__(self, other):
+        return set(self).symmetric_difference(other)
+
+    def __rsub__(self, other):
+        return set(other).difference(self)
+
+    __rand__, __ror__, __rxor__ = __and__, __or__, __xor__
+
+    def isdisjoint(self, other):
+        return set(self).isdisjoint(other)
+
+
+class VocabMasks:
+    """
+    Subset test by vocabulary bitmasks, read from a CorpusIndex.
+
+    Each word hashes to one of 64 bits (see word_bits), and the index holds
+    the OR of its words' bits for each tweet (row_masks). A tweet can only
+    be made of some words if its mask has no bits outside theirs, so one
+    AND/compare rules most tweets out; the few that pass are checked
+    exactly. The masks are part of the index, so worker processes share
+    them rather than building their own.
+    """
+
+    # fewer ids than this are checked one by one, as numpy's overhead per
+    # call would outweigh the work
+    SMALL = 64
+
+    def __init__(self, index: CorpusIndex):
+        self.index = index
+
+    def __getitem__(self, id_) -> int:
+        return int(self.index.row_masks[self.index.row_of(id_)])
+
+    def mask(self, words) -> int:
+        """Bitmask of a collection of words"""
+        word_ids = [self.index.word_id(word) for word in words]
+        return int(np.bitwise_or.reduce(word_bits(np.array(word_ids, dtype=np.int64))))
+
+    def filter_subsets(self, ids, words) -> list:
+        """Ids (in order) whose words are all contained in words"""
+        index = self.index
+        if len(ids) <= self.SMALL:
+            word_set = set(words)
+            return [x for x in ids if word_set.issuperset(index.words(index.row_of(x)))]
+        rows = ids.rows if isinstance(ids, Postings) else index.rows_of(ids)
+        word_ids = np.unique([index.word_id(word) for word in words])
+        target = np.bitwise_or.reduce(word_bits(word_ids))
+        rows = rows[(index.row_masks[rows] & ~target) == 0]
+
+        # confirm the ones that pass: every word of the tweet is in words
+        tokens, owners = index.tokens_of(rows)
+        subset = np.ones(len(rows), dtype=bool)
+        subset[owners[~np.isin(tokens, word_ids)]] = False
+        return index.tweet_ids[rows[subset]].tolist()
+
+
+def word_bits(word_ids) -> np.ndarray:
+    """Bit (of 64) standing for each word id, as uint64 masks"""
+    word_ids = np.asarray(word_ids)
+    return np.left_shift(np.uint64(1), (word_ids % 64).astype(np.uint64))
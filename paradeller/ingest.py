@@ -0,0 +1,362 @@
+"""
+Asyncio pipeline for scraping tweets into the archive.
+
+    fetchers  ->  raw queue  ->  filter/format  ->  tweet queue  ->  writer
+
+Several fetchers call a Source concurrently, sharing a rate limiter. The
+filter stage formats what they get and drops tweets that aren't usable
+(see is_good). The writer adds tweets to the archive in batches. Queues
+between the stages are bounded, so a slow writer holds back the fetchers
+rather than piling tweets up in memory.
+
+Sources:
+  - TweepySource: the Twitter search API, via tweepy
+  - FakeSource: replays canned tweets from a file, for offline tests and
+    benchmarks
+
+Usage: python -m paradeller.ingest FILE [n]
+    benchmark the pipeline, scraping n batches from a FakeSource replaying
+    FILE into a throwaway archive
+"""
+
+import asyncio
+import json
+import sys
+import tempfile
+import time
+from abc import ABC, abstractmethod
+
+from tqdm.auto import tqdm
+
+from paradeller.archive import ArchiveStore
+from paradeller.dataprep import tokenize
+
+
+class RateLimited(Exception):
+    """Raised by a source when it has hit its rate limit"""
+
+    def __init__(self, retry_after):
+        super().__init__(f"rate limited, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+# ---------- SOURCES ----------
+
+
+class Source(ABC):
+    """
+    Where tweets come from.
+
+    `fetch` returns one batch of raw results (whatever the source deals
+    in), and `format` turns one raw result into a tweet dict (id, text,
+    author, time). `rate_limit` is (calls, seconds), or None for no limit.
+    `errors` are the exceptions fetch raises when a fetch fails (e.g. the
+    API's errors): they're counted and skipped, anything else propagates.
+    """
+
+    rate_limit = None
+    errors = ()
+
+    @abstractmethod
+    async def fetch(self) -> list:
+        pass
+
+    @abstractmethod
+    def format(self, raw) -> dict:
+        pass
+
+
+class TweepySource(Source):
+    """
+    Twitter search for tweets matching basic criteria
+    (not retweets, no links, no media), ~100 per fetch.
+
+    tweepy waits out Twitter's rate limit itself (wait_on_rate_limit), in
+    the fetch's thread, and the pipeline's own limiter keeps fetches to
+    rate_limit. Should tweepy still raise RateLimitError, fetch raises
+    RateLimited, and the pipeline pauses every fetcher.
+    """
+
+    # standard search API, with user auth
+    rate_limit = (180, 15 * 60)
+
+    def __init__(self):
+        import tweepy
+
+        from paradeller.keys import (
+            access_token,
+            accss_token_secret,
+            consumer_key,
+            consumer_secret,
+        )
+
+        auth = tweepy.OAuthHandler(consumer_key, consumer_secret)
+        auth.set_access_token(access_token, accss_token_secret)
+        self.tweepy = tweepy
+        self.api = tweepy.API(auth, wait_on_rate_limit=True)
+        self.errors = (tweepy.TweepError,)
+
+    async def fetch(self) -> list:
+        loop = asyncio.get_running_loop()
+        try:
+            # tweepy blocks, so run it in a thread
+            return await loop.run_in_executor(None, self._search)
+        except self.tweepy.RateLimitError:
+            raise RateLimited(self.rate_limit[1])
+
+    def _search(self):
+        query = "-filter:retweets -filter:links -filter:media"
+        return self.api.search(q=query, lang="en", count=100, include_entities=False)
+
+    def format(self, raw) -> dict:
+        return format_status(raw)
+
+
+class FakeSource(Source):
+    """
+    Stand-in for a search API, replaying canned tweets.
+
+    Parameters
+    ----------
+    tweets : list or str
+        tweet dicts, or path to a JSON lines (or JSON list) file of them
+    count : int
+        tweets returned per fetch
+    latency : float
+        seconds each fetch takes
+    rate_limit : tuple, optional
+        (calls, seconds) the source claims to allow
+    """
+
+    def __init__(self, tweets, count=100, latency=0.0, rate_limit=None):
+        if isinstance(tweets, str):
+            tweets = load_tweets(tweets)
+        self.tweets = tweets
+        self.count = count
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.pos = 0
+
+    async def fetch(self) -> list:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if not self.tweets:
+            return []
+        # wrap around, like a search returning tweets seen before
+        batch = [
+            self.tweets[(self.pos + i) % len(self.tweets)] for i in range(self.count)
+        ]
+        self.pos = (self.pos + self.count) % len(self.tweets)
+        return batch
+
+    def format(self, raw) -> dict:
+        return dict(
+            id=raw["id"], text=raw["text"], author=raw["author"], time=raw["time"]
+        )
+
+
+def load_tweets(fp) -> list:
+    """Tweet dicts from a JSON lines or JSON list file"""
+    with open(fp) as file:
+        text = file.read()
+    if text.lstrip().startswith("["):
+        return json.loads(text)
+    return [json.loads(line) for line in text.splitlines() if line.strip()]
+
+
+# ---------- FILTER / FORMAT ----------
+
+
+def is_good(text) -> bool:
+    """
+    Returns True of text looks useable, False otherwise.
+    """
+
+    # word count too low or too high?
+    tweet_len = len(tokenize(text))
+    if (tweet_len < 3) or (tweet_len > 10):
+        return False
+
+    # has blacklisted words/symbols?
+    blacklist = ["@", "\n"]
+    for char in blacklist:
+        if char in text:
+            return False
+
+    return True
+
+
+def format_status(status):
+    """
+    Extract relevant info from Status object
+
+    Returns
+    -------
+    dict
+        Basic status info (id, text, author, time)
+    """
+    return dict(
+        id=status.id,
+        text=status.text,
+        author=status.author.screen_name,
+        time=status.created_at.strftime("%Y-%m-%d %H:%M:%S"),
+    )
+
+
+# ---------- PIPELINE ----------
+
+
+class RateLimiter:
+    """
+    Token bucket allowing `calls` per `period` seconds on average, in
+    bursts of up to `calls`. `pause` holds everyone back, e.g. after the
+    source says its limit was hit.
+    """
+
+    def __init__(self, calls, period):
+        self.rate = calls / period
+        self.capacity = calls
+        self.tokens = calls
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self.tokens = min(
+                    self.capacity, self.tokens + (now - self.updated) * self.rate
+                )
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+
+async def ingest(source: Source, store: ArchiveStore, n, **kwargs) -> dict:
+    """
+    Fetch n batches from source and add the usable, new tweets to store.
+
+    Parameters
+    ----------
+    source : Source
+        where to get tweets
+    store : ArchiveStore
+        archive to add them to
+    n : int
+        number of fetches
+    fetchers : int
+        fetches in flight at once (default 4)
+    batch_size : int
+        tweets per archive write (default 500)
+    queue_size : int
+        batches each queue holds before its producers wait (default 16)
+    sink : callable, optional
+        called with each batch of tweets once it's archived
+    nobar : bool
+        hide the progress bar (default False)
+
+    Returns
+    -------
+    dict
+        counts of fetches, errors, tweets fetched, kept and added
+    """
+    nobar = kwargs.get("nobar", False)
+    fetchers = kwargs.get("fetchers", 4)
+    batch_size = kwargs.get("batch_size", 500)
+    queue_size = kwargs.get("queue_size", 16)
+    sink = kwargs.get("sink")
+
+    limiter = RateLimiter(*source.rate_limit) if source.rate_limit else None
+    raw_q = asyncio.Queue(queue_size)
+    tweet_q = asyncio.Queue(queue_size)
+    stats = dict(fetches=0, errors=0, fetched=0, kept=0, added=0)
+    todo = iter(range(n))
+    bar = tqdm(total=n, disable=nobar)
+
+    async def fetch():
+        for _ in todo:
+            while True:
+                if limiter:
+                    await limiter.acquire()
+                try:
+                    raw = await source.fetch()
+                except RateLimited as e:
+                    if limiter:
+                        limiter.pause(e.retry_after)
+                    else:
+                        await asyncio.sleep(e.retry_after)
+                    continue
+                except source.errors as e:
+                    print(e)
+                    stats["errors"] += 1
+                    raw = []
+                break
+            stats["fetches"] += 1
+            stats["fetched"] += len(raw)
+            bar.update()
+            await raw_q.put(raw)
+
+    async def filter_format():
+        while True:
+            raw = await raw_q.get()
+            if raw is None:
+                break
+            tweets = [source.format(r) for r in raw]
+            tweets = [t for t in tweets if is_good(t["text"])]
+            stats["kept"] += len(tweets)
+            await tweet_q.put(tweets)
+        await tweet_q.put(None)
+
+    async def write():
+        loop = asyncio.get_running_loop()
+        pending = []
+        while True:
+            tweets = await tweet_q.get()
+            if tweets is not None:
+                pending.extend(tweets)
+            if pending and (tweets is None or len(pending) >= batch_size):
+                # archive writes sync to disk, so keep them off the loop
+                batch, pending = pending, []
+                stats["added"] += await loop.run_in_executor(None, store.add, batch)
+                if sink is not None:
+                    await loop.run_in_executor(None, sink, batch)
+            if tweets is None:
+                break
+
+    async def fetch_all():
+        await asyncio.gather(*(fetch() for _ in range(fetchers)))
+        await raw_q.put(None)
+
+    with bar:
+        await asyncio.gather(fetch_all(), filter_format(), write())
+    return stats
+
+
+def benchmark(fp, n=1000, **kwargs) -> dict:
+    """Run the pipeline from a FakeSource into a throwaway archive"""
+    source = FakeSource(fp, latency=kwargs.pop("latency", 0.0))
+    with tempfile.TemporaryDirectory() as tmpdir:
+        with ArchiveStore(tmpdir) as store:
+            start = time.perf_counter()
+            stats = asyncio.run(ingest(source, store, n, **kwargs))
+            elapsed = time.perf_counter() - start
+    return dict(stats, seconds=elapsed, tweets_per_sec=stats["fetched"] / elapsed)
+
+
+if __name__ == "__main__":
+    args_dict = dict(enumerate(sys.argv))
+    fp = args_dict.get(1)
+    if fp is None:
+        exit("Usage: python -m paradeller.ingest FILE [n]")
+    n = int(args_dict.get(2, "1000"))
+    print(json.dumps(benchmark(fp, n), indent=2))
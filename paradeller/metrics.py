@@ -0,0 +1,86 @@
+"""
+Lightweight instrumentation: wall-clock timers, counters and histograms.
+
+Everything is kept in one flat Counter of numbers, with keys like
+"time.find_matches.gather" or "hist.find_matches.pot_ids.16". Every entry
+simply adds up, so metrics from pool workers merge into the driver's by
+summing (see parallel.WorkerEnv.pop_stats), and checkpoints can store them
+as they are. `summarize` turns the flat form into a readable nested dict.
+
+Each process has a module-level `metrics`. Recording is a dict update or
+two (plus a clock read for timers), cheap enough to leave on; set
+`metrics.enabled = False` to skip even that.
+"""
+
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+
+class Metrics:
+    def __init__(self):
+        self.enabled = True
+        self.data = Counter()
+
+    def count(self, name, n=1):
+        """Add n to a counter"""
+        if self.enabled:
+            self.data["count." + name] += n
+
+    def observe(self, name, value):
+        """Add a value to a histogram with power-of-two buckets (0, 1, 2, 4, ...)"""
+        if self.enabled:
+            bucket = 1 << (int(value).bit_length() - 1) if value >= 1 else 0
+            self.data[f"hist.{name}.{bucket}"] += 1
+
+    @contextmanager
+    def timer(self, name):
+        """Time a block, adding to the stage's total seconds and calls"""
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.data["time." + name] += time.perf_counter() - start
+            self.data["calls." + name] += 1
+
+    def add_time(self, name, seconds, calls=1):
+        """Record time measured some other way"""
+        if self.enabled:
+            self.data["time." + name] += seconds
+            self.data["calls." + name] += calls
+
+    def pop(self) -> dict:
+        """Everything recorded since the last pop, in flat form"""
+        data = dict(self.data)
+        self.data.clear()
+        return data
+
+
+metrics = Metrics()
+
+
+def summarize(flat) -> dict:
+    """
+    Nested form of flat metrics (other keys are ignored):
+    {"timers": {stage: {"seconds", "calls"}}, "counters": {name: n},
+     "histograms": {name: {bucket: n}}}
+    """
+    timers, counters, histograms = {}, {}, {}
+    for key, value in sorted(flat.items()):
+        kind, _, name = key.partition(".")
+        if kind == "time":
+            timers.setdefault(name, {})["seconds"] = round(value, 6)
+        elif kind == "calls":
+            timers.setdefault(name, {})["calls"] = value
+        elif kind == "count":
+            counters[name] = value
+        elif kind == "hist":
+            name, _, bucket = name.rpartition(".")
+            histograms.setdefault(name, {})[int(bucket)] = value
+    histograms = {
+        name: dict(sorted(buckets.items())) for name, buckets in histograms.items()
+    }
+    return dict(timers=timers, counters=counters, histograms=histograms)
@@ -0,0 +1,504 @@
+"""
+Process pool that shares the corpus index with its workers.
+
+Workers memory map the index's files when it was loaded from disk, or
+else attach to a copy of its arrays in shared memory. Either way this is
+done in the pool initializer, rather than relying on globals inherited
+through fork, so it works with any multiprocessing start method.
+
+Work is described by (start, stop) ranges over a combinatorial index
+space: workers generate their own pairs or triples from the range, so the
+driver never holds the work list. Ranges are sized so each takes roughly
+`target_secs`, only a few are in flight at once, and only non-empty
+results come back.
+"""
+
+import os
+import queue
+import signal
+import sys
+import time
+from collections import Counter
+from multiprocessing import Pool, resource_tracker, shared_memory
+
+import numpy as np
+from tqdm.auto import tqdm
+
+from paradeller.analysis import (
+    FinalStanzaCache,
+    StanzaFeasibility,
+    combinations_range,
+    find_final_stanzas,
+    find_matches,
+    triangles,
+)
+from paradeller.index import CorpusIndex, VocabMasks
+from paradeller.metrics import metrics
+from paradeller.vectorized import VectorMatcher
+
+
+class SharedArrays:
+    """
+    Copies of some NumPy arrays in shared memory.
+
+    `spec` is a small, picklable description that workers pass to
+    `attach` to get the same arrays without copying them.
+    """
+
+    def __init__(self, arrays):
+        self.blocks = []
+        self.spec = {}
+        for name, arr in arrays.items():
+            arr = np.ascontiguousarray(arr)
+            shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+            np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[...] = arr
+            self.blocks.append(shm)
+            self.spec[name] = (shm.name, arr.shape, arr.dtype.str)
+        self.arrays, self.attached = attach(self.spec, track=True)
+
+    def close(self):
+        self.arrays = None
+        _close(self.attached)
+        _close(self.blocks)
+        for shm in self.blocks:
+            shm.unlink()
+        self.attached, self.blocks = [], []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class SharedIndex(SharedArrays):
+    """A CorpusIndex with its arrays in shared memory"""
+
+    def __init__(self, index: CorpusIndex):
+        super().__init__(index.arrays)
+        self.index = CorpusIndex(self.arrays)
+
+    def close(self):
+        self.index = None
+        super().close()
+
+
+def attach(spec, track=False):
+    """
+    Attach to shared arrays, returns (arrays, shared memory blocks).
+    Keep the blocks referenced for as long as the arrays are used.
+    Only the process that created the blocks should track them (and so
+    unlink them at exit).
+    """
+    blocks, arrays = [], {}
+    for name, (shm_name, shape, dtype) in spec.items():
+        if track:
+            shm = shared_memory.SharedMemory(name=shm_name)
+        else:
+            shm = _attach_untracked(shm_name)
+        blocks.append(shm)
+        arrays[name] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+    return arrays, blocks
+
+
+def _attach_untracked(name):
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+    register = resource_tracker.register
+    resource_tracker.register = lambda *args, **kwargs: None
+    try:
+        return shared_memory.SharedMemory(name=name)
+    finally:
+        resource_tracker.register = register
+
+
+def _close(blocks):
+    for shm in blocks:
+        try:
+            shm.close()
+        except BufferError:
+            # arrays over this block are still referenced somewhere
+            pass
+
+
+# ---------- WORKERS ----------
+
+
+class WorkerEnv:
+    """
+    What a task function gets to work with in a worker process:
+    the corpus views, vocab masks, a final stanza cache, a VectorMatcher
+    (if context["backend"] is "numpy"), the `context` dict given to the
+    Executor, and the current task's deadline (see out_of_time).
+    """
+
+    def __init__(self, index: CorpusIndex, context: dict):
+        self.index = index
+        self.context = context
+        self.adj_list_ids = index.adj_list_ids
+        self.adj_list_words = index.adj_list_words
+        self.final_cache = FinalStanzaCache(context.get("cache_size", 1_000_000))
+        self._masks = None
+        self._matcher = None
+        self._overall_wc = None
+        self._memo = {}
+        self.deadline = None
+
+    def out_of_time(self) -> bool:
+        """Whether the current task's deadline (if any) has passed"""
+        return self.deadline is not None and time.monotonic() >= self.deadline
+
+    @property
+    def masks(self) -> VocabMasks:
+        if self._masks is None:
+            self._masks = VocabMasks(self.index)
+        return self._masks
+
+    @property
+    def matcher(self):
+        if self._matcher is None and self.context.get("backend") == "numpy":
+            budget = self.context.get("memory_budget", 64_000_000)
+            self._matcher = VectorMatcher(self.index, budget)
+        return self._matcher
+
+    @property
+    def overall_wc(self) -> Counter:
+        if self._overall_wc is None:
+            self._overall_wc = self.index.word_counts()
+        return self._overall_wc
+
+    def memo(self, key, make):
+        """
+        Value made once per key in this worker, e.g. something built from
+        the arrays of the current map. Cleared when the next map starts.
+        """
+        if key not in self._memo:
+            self._memo[key] = make()
+        return self._memo[key]
+
+    def reset(self):
+        """Forget the values made with memo, as the next map starts"""
+        self._memo.clear()
+
+    def pop_stats(self) -> dict:
+        """Counters and metrics to send back with a batch of results"""
+        stats = self.final_cache.pop_stats()
+        stats = {f"final_stanza_cache.{k}": v for k, v in stats.items()}
+        stats.update(metrics.pop())
+        return stats
+
+
+_env = None
+_blocks = None
+_shared = {}
+
+
+def _init_worker(source, context):
+    global _env, _blocks
+    # Ctrl-C reaches the whole process group: leave it to the driver
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # forked workers start with a copy of the driver's metrics
+    metrics.pop()
+    if isinstance(source, str):
+        # index saved on disk: map the same files as the driver
+        index = CorpusIndex.load(source)
+    else:
+        arrays, _blocks = attach(source)
+        index = CorpusIndex(arrays)
+    _env = WorkerEnv(index, context)
+
+
+def _shared_arrays(spec):
+    """Arrays shared for the current map, attaching on first use"""
+    key = tuple(name for name, _, _ in spec.values())
+    if key not in _shared:
+        for arrays, blocks in _shared.values():
+            _close(blocks)
+        _shared.clear()
+        _shared[key] = attach(spec)
+        _env.reset()
+    return _shared[key][0]
+
+
+def _run_range(func, start, stop, spec, deadline):
+    """
+    Run func over a range of work, return only the non-empty results, and
+    where it got to (stop, unless it ran out of time)
+    """
+    t0 = time.perf_counter()
+    _env.deadline = deadline
+    batch, stop = func(start, stop, _env, _shared_arrays(spec))
+    elapsed = time.perf_counter() - t0
+    metrics.add_time("tasks." + func.__name__, elapsed)
+    metrics.observe("tasks.size", stop - start)
+    return start, stop, batch, elapsed, _env.pop_stats()
+
+
+# ---------- TASKS ----------
+
+
+def find_matches_range(start, stop, env: WorkerEnv, arrays):
+    """
+    Find initial stanzas for pairs of arrays["ids"], ranked start to stop - 1
+    (see analysis.combinations_range).
+    Returns list of (rank, (pair, matches)) for pairs with matches, and
+    the rank it got to.
+
+    Every pair of ids is searched, and (i, j) comes after every pair of
+    ids before j. So matches of two ids before j are left out: their
+    stanza comes from that pair instead (see analysis.find_matches).
+    """
+    ids = arrays["ids"]
+    position = env.memo("seed_positions", lambda: _positions(ids))
+    batch = []
+    for rank, (i, j) in enumerate(combinations_range(2, start, stop), start):
+        if env.out_of_time():
+            return batch, rank
+        pair = (int(ids[i]), int(ids[j]))
+        earlier = lambda id_: position.get(id_, j) < j
+        valid = find_matches(
+            *pair,
+            env.adj_list_ids,
+            env.adj_list_words,
+            env.masks,
+            earlier=earlier,
+            matcher=env.matcher,
+        )
+        if valid:
+            batch.append((rank, (pair, valid)))
+    return batch, stop
+
+
+def _positions(ids) -> dict:
+    return {id_: pos for pos, id_ in enumerate(ids.tolist())}
+
+
+def find_matches_pairs(start, stop, env: WorkerEnv, arrays):
+    """
+    Find initial stanzas for rows start to stop - 1 of arrays["pairs"],
+    an (n, 2) array of tweet id pairs.
+    Returns list of (row, (pair, matches)) for pairs with matches, and the
+    row it got to.
+    """
+    pairs = arrays["pairs"]
+    batch = []
+    for row in range(start, stop):
+        if env.out_of_time():
+            return batch, row
+        pair = (int(pairs[row, 0]), int(pairs[row, 1]))
+        valid = find_matches(
+            *pair, env.adj_list_ids, env.adj_list_words, env.masks, matcher=env.matcher
+        )
+        if valid:
+            batch.append((row, (pair, valid)))
+    return batch, stop
+
+
+def find_final_stanzas_range(start, stop, env: WorkerEnv, arrays):
+    """
+    Find final stanzas for triangles of the stanza compatibility graph whose
+    last stanza is in range(start, stop) (see analysis.triangles).
+    Returns list of ((u, v, w), (stanzas, ends)) for triples with matches,
+    and the last stanza it got to.
+    """
+    stanzas, graph, feasible = env.memo(
+        "stanza_graph", lambda: _stanza_graph(env, arrays)
+    )
+    batch = []
+    for last in range(start, stop):
+        found = []
+        for u, v, w in triangles(graph, feasible, last, last + 1, env.deadline):
+            if env.out_of_time():
+                break
+            combo = (stanzas[u], stanzas[v], stanzas[w])
+            valid = find_final_stanzas(
+                *combo,
+                env.adj_list_ids,
+                env.adj_list_words,
+                env.masks,
+                env.final_cache,
+                env.matcher,
+            )
+            if valid:
+                found.append(((u, v, w), (combo, valid)))
+        if env.out_of_time():
+            # its triangles may not all be done: leave it for later
+            return batch, last
+        batch.extend(found)
+    return batch, stop
+
+
+def _stanza_graph(env, arrays):
+    stanzas = [tuple(s) for s in arrays["stanzas"].tolist()]
+    graph = CSRGraph(arrays["graph_offsets"], arrays["graph_nbrs"])
+    feasible = StanzaFeasibility(stanzas, env.adj_list_ids, env.overall_wc)
+    return stanzas, graph, feasible
+
+
+class CSRGraph:
+    """Graph stored as flat neighbor lists with offsets, indexable by node"""
+
+    def __init__(self, offsets, nbrs):
+        self.offsets = offsets
+        self.nbrs = nbrs
+
+    @classmethod
+    def from_lists(cls, graph):
+        offsets = np.zeros(len(graph) + 1, dtype=np.int64)
+        np.cumsum([len(x) for x in graph], out=offsets[1:])
+        nbrs = np.fromiter((v for x in graph for v in x), dtype=np.int64)
+        return cls(offsets, nbrs)
+
+    def __getitem__(self, u):
+        return self.nbrs[self.offsets[u] : self.offsets[u + 1]].tolist()
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+
+# ---------- DRIVER ----------
+
+
+class Executor:
+    """
+    Pool of worker processes sharing one corpus index.
+
+    Parameters
+    ----------
+    index : CorpusIndex
+        prepared corpus. If it's memory mapped from disk, workers map the
+        same files; otherwise it is copied into shared memory.
+    workers : int, optional
+        number of worker processes (default: os.cpu_count())
+    context : dict, optional
+        picklable extras handed to every worker (see WorkerEnv)
+    target_secs : float
+        how long each task should roughly take
+    """
+
+    def __init__(self, index, workers=None, context=None, target_secs=0.5):
+        self.workers = workers or os.cpu_count()
+        self.target_secs = target_secs
+        self.stats = Counter()
+        if index.path is not None:
+            self.shared = None
+            self._index = index
+            source = index.path
+        else:
+            self.shared = SharedIndex(index)
+            self._index = self.shared.index
+            source = self.shared.spec
+        self.pool = Pool(
+            self.workers, initializer=_init_worker, initargs=(source, context or {})
+        )
+
+    @property
+    def index(self) -> CorpusIndex:
+        """The shared index, for use in the driver too"""
+        return self._index
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
+        self._index = None
+        if self.shared is not None:
+            self.shared.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def map_ranges(self, func, total, arrays=None, todo=None, **kwargs):
+        """
+        Split range(total) into tasks and run func(start, stop, env, arrays)
+        for each in the workers. `arrays` (dict of NumPy arrays) are put in
+        shared memory for the duration of the map. `todo` limits the work
+        to some (start, stop) spans of range(total), e.g. those a resumed
+        run has left to do. Pass `deadline` (a time.monotonic() time) to
+        stop at it: no tasks start after it, and task functions check it
+        (env.out_of_time) as they go. `max_size` caps how much of the range
+        a task takes on.
+
+        func returns a list of (key, result) and where in its range it got
+        to: stop, unless it ran out of time. Yields (start, stop, batch)
+        for each task, with stop where it got to, in the order tasks
+        finish. Counters reported by
+        workers, and the driver's own metrics, are added to self.stats.
+        IPC is timed as "ipc.wait" (driver waiting on workers) and
+        "ipc.latency" (time tasks spend queued or in transit).
+
+        If the map stops before every task has come back, the pool is
+        terminated, and the Executor can't be used for another map.
+        """
+        nobar = kwargs.get("nobar", False)
+        deadline = kwargs.get("deadline")
+        max_size = kwargs.get("max_size")
+        spans = [(0, total)] if todo is None else list(todo)
+        max_in_flight = self.workers * 2
+        done = queue.Queue()
+        size = 1
+        in_flight = 0
+        submitted = {}
+
+        def tasks():
+            for pos, end in spans:
+                while pos < end:
+                    if deadline is not None and time.monotonic() >= deadline:
+                        return
+                    stop = min(pos + size, end)
+                    yield pos, stop
+                    pos = stop
+
+        pending = tasks()
+        with SharedArrays(arrays or {}) as shared, tqdm(
+            total=sum(stop - start for start, stop in spans), disable=nobar
+        ) as bar:
+            try:
+                while True:
+                    for start, stop in pending:
+                        submitted[start] = time.perf_counter()
+                        self.pool.apply_async(
+                            _run_range,
+                            (func, start, stop, shared.spec, deadline),
+                            callback=done.put,
+                            error_callback=done.put,
+                        )
+                        in_flight += 1
+                        if in_flight >= max_in_flight:
+                            break
+                    if not in_flight:
+                        break
+
+                    with metrics.timer("ipc.wait"):
+                        out = done.get()
+                    in_flight -= 1
+                    if isinstance(out, BaseException):
+                        raise out
+                    start, stop, batch, elapsed, stats = out
+                    round_trip = time.perf_counter() - submitted.pop(start)
+                    metrics.add_time("ipc.latency", round_trip - elapsed)
+                    self.stats.update(stats)
+                    self.stats.update(metrics.pop())
+                    size = self.adapt(size, stop - start, elapsed)
+                    if max_size is not None:
+                        size = min(size, max_size)
+                    bar.update(stop - start)
+                    yield start, stop, batch
+            finally:
+                if in_flight:
+                    # stopped early (an error, Ctrl-C, or the caller closing
+                    # the generator): rather than wait on tasks that may
+                    # never finish, stop the workers, so the arrays aren't
+                    # unlinked while in use
+                    self.pool.terminate()
+                    self.pool.join()
+
+    def adapt(self, size, count, elapsed) -> int:
+        """Next task size, aiming for target_secs per task"""
+        if elapsed <= 0:
+            return size * 2
+        ideal = count * self.target_secs / elapsed
+        # move towards the ideal size, but not too fast
+        return int(max(1, min(ideal, size * 2)))
@@ -1,3 +1,93 @@
+"""
+Looking up, ranking and rendering the stanzas and poems of search results.
+
+Usage: python -m paradeller.postprocess [RESULTS] [--format F] [-n N] [--out FILE]
+    render the best n stanzas and poems of a results file (default: the
+    latest in data/found/) as text, markdown or JSON
+"""
+
+import argparse
+import glob
+import json
+import os
+from itertools import chain
+
+from paradeller.archive import ArchiveStore, open_archive
+from paradeller.dataprep import tokenize
+from paradeller.helper import data_fp
+from paradeller.samples import load_samples
+
+FORMATS = ("text", "md", "json")
+
+# lines of a stanza are A, A, B, B, C, D
+STANZA_LINES = [0, 0, 1, 1, 2, 3]
+
+
+class TweetStore:
+    """
+    Tweet dicts by id.
+
+    source is a list of tweet dicts, hashed by id on first lookup, or an
+    archive.ArchiveStore, which only reads the tweets asked for. Tweets
+    looked up are kept, so each is only loaded once. Closing the store
+    (or using it as a context manager) closes an ArchiveStore source.
+    """
+
+    def __init__(self, source):
+        self.source = source
+        self._tweets = None
+
+    @classmethod
+    def of(cls, data) -> "TweetStore":
+        """data as a TweetStore, if it isn't one already"""
+        return data if isinstance(data, cls) else cls(data)
+
+    @property
+    def tweets(self) -> dict:
+        """Id -> tweet, for the tweets loaded so far"""
+        if self._tweets is None:
+            if isinstance(self.source, ArchiveStore):
+                self._tweets = {}
+            else:
+                self._tweets = {x["id"]: x for x in self.source}
+        return self._tweets
+
+    def get_many(self, ids) -> dict:
+        """Tweets by id, loading any not loaded yet in one go"""
+        ids = set(ids)
+        tweets = self.tweets
+        missing = [id_ for id_ in ids if id_ not in tweets]
+        if missing and isinstance(self.source, ArchiveStore):
+            tweets.update(self.source.get_many(missing))
+            missing = []
+        if missing:
+            raise KeyError(f"no tweets with ids {sorted(missing)[:10]}")
+        return {id_: tweets[id_] for id_ in ids}
+
+    def __getitem__(self, id_) -> dict:
+        return self.get_many([id_])[id_]
+
+    def __contains__(self, id_):
+        try:
+            self[id_]
+        except KeyError:
+            return False
+        return True
+
+    def close(self):
+        if isinstance(self.source, ArchiveStore):
+            self.source.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# ---------- RANKING ----------
+
+
 def stanza_sorter_maker(adj_list_ids):
     def stanza_sorter(stanza):
         """
@@ -27,28 +117,188 @@ def stanza_sorter_maker(adj_list_ids):
     return stanza_sorter
 
 
+def poem_sorter_maker(adj_list_ids):
+    stanza_sorter = stanza_sorter_maker(adj_list_ids)
+
+    def poem_sorter(poem):
+        """
+        Sort by interesting-ness of the initial stanzas
+        """
+        return sum(stanza_sorter(stanza) for stanza in poem[:3])
+
+    return poem_sorter
+
+
+# ---------- RENDERING ----------
+
+
+def render(results, data, fmt="text", n=50, rank=True) -> str:
+    """
+    Render the stanzas and poems of a results dict.
+
+    Parameters
+    ----------
+    results : dict
+        search results, with "stanzas" and "poems"
+    data : TweetStore or list
+        where to look up lines
+    fmt : str
+        one of FORMATS
+    n : int
+        number of stanzas and of poems to render
+    rank : bool
+        render the most interesting ones (by stanza_sorter), rather than
+        the first n
+
+    Returns
+    -------
+    str
+        the rendered stanzas, then poems
+    """
+    tweets = TweetStore.of(data)
+    stanzas, poems = results["stanzas"], results["poems"]
+    if rank:
+        # ranking needs the words of every line, so load them all at once
+        lines = tweets.get_many(_ids(stanzas, poems))
+        adj_list_ids = {id_: tokenize(x["text"]) for id_, x in lines.items()}
+        stanzas = sorted(stanzas, key=stanza_sorter_maker(adj_list_ids), reverse=True)
+        poems = sorted(poems, key=poem_sorter_maker(adj_list_ids), reverse=True)
+    stanzas, poems = stanzas[:n], poems[:n]
+
+    lines = tweets.get_many(_ids(stanzas, poems))
+    stanzas = [_stanza_entry(stanza, lines) for stanza in stanzas]
+    poems = [_poem_entry(poem, lines) for poem in poems]
+    if fmt == "json":
+        return json.dumps(dict(stanzas=stanzas, poems=poems), indent=2)
+    if fmt == "md":
+        return "\n\n".join(
+            ["## Stanzas", *_md_entries(stanzas, "Stanza")]
+            + ["## Poems", *_md_entries(poems, "Poem")]
+        )
+    if fmt == "text":
+        return "\n".join(_text_entry(entry) for entry in stanzas + poems)
+    raise ValueError(f"unknown format {fmt!r}, expected one of {FORMATS}")
+
+
+def _ids(stanzas, poems) -> set:
+    """Every line in some stanzas and poems"""
+    return set(chain.from_iterable(stanzas)) | set(
+        chain.from_iterable(chain.from_iterable(poems))
+    )
+
+
+def _line(tweet) -> dict:
+    keys = ("id", "author", "text", "time")
+    return {k: tweet[k] for k in keys if k in tweet}
+
+
+def _stanza_entry(stanza, lines) -> dict:
+    return dict(ids=list(stanza), lines=[_line(lines[stanza[i]]) for i in STANZA_LINES])
+
+
+def _poem_entry(poem, lines) -> dict:
+    *initial_stanzas, final_stanza = poem
+    return dict(
+        stanzas=[_stanza_entry(stanza, lines) for stanza in initial_stanzas],
+        final=[_line(lines[id_]) for id_ in final_stanza],
+    )
+
+
+def _text_lines(lines) -> list:
+    return [f"@{line['author']:20} {line['text']} " for line in lines]
+
+
+def _text_entry(entry) -> str:
+    """A stanza or poem, as print_stanzas and print_poems show them"""
+    parts = ["~" * 50]
+    if "lines" in entry:
+        parts.extend(_text_lines(entry["lines"]))
+    else:
+        for stanza in entry["stanzas"]:
+            parts.extend(_text_lines(stanza["lines"]) + [""])
+        parts.extend(_text_lines(entry["final"]))
+    return "\n".join(parts)
+
+
+def _md_entries(entries, title) -> list:
+    # two trailing spaces make a line break
+    fmt_lines = lambda lines: "\n".join(
+        f"{line['text']} *(@{line['author']})*  " for line in lines
+    )
+    out = []
+    for i, entry in enumerate(entries, 1):
+        if "lines" in entry:
+            body = fmt_lines(entry["lines"])
+        else:
+            stanzas = [stanza["lines"] for stanza in entry["stanzas"]]
+            body = "\n\n".join(map(fmt_lines, stanzas + [entry["final"]]))
+        out.append(f"### {title} {i}\n\n{body}")
+    return out
+
+
+# ---------- PRINTING ----------
+
+
 def print_stanza(stanza, data):
-    get_line = lambda id: next(x for x in data if x["id"] == id)
-    for i in [0, 0, 1, 1, 2, 3]:
-        id_ = stanza[i]
-        line = get_line(id_)
-        print(f"@{line['author']:20} {line['text']} ")
+    lines = TweetStore.of(data).get_many(stanza)
+    print("\n".join(_text_lines(_stanza_entry(stanza, lines)["lines"])))
 
 
 def print_stanzas(stanzas, data, n=50):
-    for stanza in stanzas[:n]:
-        print("~" * 50)
-        print_stanza(stanza, data)
+    out = render(dict(stanzas=stanzas, poems=[]), data, n=n, rank=False)
+    if out:
+        print(out)
 
 
 def print_poems(poems, data, n=50):
-    get_line = lambda id: next(x for x in data if x["id"] == id)
-    for poem in poems[:n]:
-        print("~" * 50)
-        *initial_stanzas, final_stanza = poem
-        for s in initial_stanzas:
-            print_stanza(s, data)
-            print()
-        for id_ in final_stanza:
-            line = get_line(id_)
-            print(f"@{line['author']:20} {line['text']} ")
+    out = render(dict(stanzas=[], poems=poems), data, n=n, rank=False)
+    if out:
+        print(out)
+
+
+# ---------- RESULTS FILES ----------
+
+
+def latest_results() -> str:
+    """Path of the most recent results file in data/found/"""
+    fps = sorted(glob.glob(os.path.join(data_fp, "found", "results_*.json")))
+    if not fps:
+        raise FileNotFoundError("no results in data/found/")
+    return fps[-1]
+
+
+def results_tweets(results) -> TweetStore:
+    """
+    Where the lines of some results are: the samples, or the archive.
+    Close it when done with it, e.g. with a with block.
+    """
+    if results.get("meta", {}).get("style") == "test":
+        return TweetStore(load_samples())
+    return TweetStore(open_archive())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog="python -m paradeller.postprocess",
+        description="Render the stanzas and poems of search results",
+    )
+    parser.add_argument("results", nargs="?", help="results file (default: latest)")
+    parser.add_argument("--format", choices=FORMATS, default="text")
+    parser.add_argument(
+        "-n", type=int, default=50, help="number of stanzas and of poems to show"
+    )
+    parser.add_argument(
+        "--unranked", action="store_true", help="keep the order they were found in"
+    )
+    parser.add_argument("--out", metavar="FILE", help="write here instead of stdout")
+    args = parser.parse_args()
+
+    with open(args.results or latest_results()) as file:
+        results = json.load(file)
+    with results_tweets(results) as tweets:
+        out = render(results, tweets, args.format, args.n, rank=not args.unranked)
+    if args.out:
+        with open(args.out, "w") as file:
+            file.write(out + "\n")
+    else:
+        print(out)
@@ -0,0 +1,168 @@
+"""
+Search results kept across runs, so a bigger search only does new work.
+
+Each phase of a search (stanzas, poems) is a range of positions over a
+list of items: pairs of seed ids in colex order, or triangles of stanzas
+by their last stanza. In both, the first get_num_combos(p, 2) pairs (or
+first p triangle positions) only depend on the first p items. So results
+cached for a list of items can be reused for any list that starts the
+same way, e.g. the top 2,000 seeds after a run with the top 1,000.
+
+The cache is an sqlite database holding, per corpus fingerprint and
+phase: the items, the ranges of positions searched, and the non-empty
+results. Positions searched with no result are covered by the ranges.
+"""
+
+import json
+import os
+import sqlite3
+
+from paradeller.checkpoint import Ranges, _tuples
+from paradeller.helper import data_fp
+
+cache_fp = os.path.join(data_fp, "cache", "results.sqlite")
+
+# bump when the results of a search change form (e.g. their order), so
+# results cached before aren't mixed in
+RESULTS_VERSION = 2
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS phases (
+    fingerprint TEXT, phase TEXT, items TEXT, spans TEXT,
+    PRIMARY KEY (fingerprint, phase)
+);
+CREATE TABLE IF NOT EXISTS results (
+    fingerprint TEXT, phase TEXT, position INTEGER, key TEXT, result TEXT
+);
+CREATE INDEX IF NOT EXISTS results_position ON results (fingerprint, phase, position);
+"""
+
+
+class ResultCache:
+    """
+    Cache of search results for a corpus, see module docstring.
+
+    Parameters
+    ----------
+    fingerprint : str
+        the corpus' CorpusIndex.fingerprint()
+    path : str
+        sqlite database file (created if needed)
+    """
+
+    def __init__(self, fingerprint, path=cache_fp):
+        self.fingerprint = f"{fingerprint}-v{RESULTS_VERSION}"
+        self.path = path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.db = sqlite3.connect(path)
+        self.db.executescript(SCHEMA)
+
+    def phase(self, phase, items, covered) -> "CachedPhase":
+        """
+        Cached results of a phase, searching positions over items.
+        covered(p) is how many positions depend only on the first p items.
+        """
+        return CachedPhase(self, phase, items, covered)
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class CachedPhase:
+    """What a ResultCache holds for one phase of a search"""
+
+    def __init__(self, cache, phase, items, covered):
+        self.db = cache.db
+        self.where = dict(fingerprint=cache.fingerprint, phase=phase)
+        items = [_tuples(item) for item in items]
+
+        row = self.db.execute(
+            "SELECT items, spans FROM phases"
+            " WHERE fingerprint = :fingerprint AND phase = :phase",
+            self.where,
+        ).fetchone()
+        cached_items, spans = ([], []) if row is None else map(json.loads, row)
+        cached_items = [_tuples(item) for item in cached_items]
+        same = _common_prefix(items, cached_items)
+        self.done = Ranges(spans)
+
+        # a list of items starting the same way as the cached one is
+        # covered as far as they match
+        if same < len(items):
+            limit = covered(same)
+            self.done = Ranges(
+                (start, min(stop, limit))
+                for start, stop in self.done.spans
+                if start < limit
+            )
+            with self.db:
+                self.db.execute(
+                    "DELETE FROM results WHERE fingerprint = :fingerprint"
+                    " AND phase = :phase AND position >= :limit",
+                    dict(self.where, limit=limit),
+                )
+                self._save(items)
+
+    def results(self, start, stop) -> list:
+        """(key, result) cached for positions start to stop - 1"""
+        rows = self.db.execute(
+            "SELECT key, result FROM results WHERE fingerprint = :fingerprint"
+            " AND phase = :phase AND position >= :start AND position < :stop",
+            dict(self.where, start=start, stop=stop),
+        )
+        return [(_tuples(json.loads(k)), _tuples(json.loads(r))) for k, r in rows]
+
+    def write(self, start, stop, batch):
+        """Record the (key, result) batch found for range(start, stop)"""
+        self.done.add(start, stop)
+        rows = [
+            dict(
+                self.where,
+                position=position(key),
+                key=json.dumps(key),
+                result=json.dumps(result),
+            )
+            for key, result in batch
+        ]
+        with self.db:
+            self.db.executemany(
+                "INSERT INTO results VALUES"
+                " (:fingerprint, :phase, :position, :key, :result)",
+                rows,
+            )
+            self._save()
+
+    def _save(self, items=None):
+        params = dict(self.where, spans=json.dumps(self.done.spans))
+        if items is None:
+            self.db.execute(
+                "UPDATE phases SET spans = :spans"
+                " WHERE fingerprint = :fingerprint AND phase = :phase",
+                params,
+            )
+        else:
+            self.db.execute(
+                "INSERT OR REPLACE INTO phases VALUES"
+                " (:fingerprint, :phase, :items, :spans)",
+                dict(params, items=json.dumps(items)),
+            )
+
+
+def position(key) -> int:
+    """Position of a result in its phase: a rank, or a triangle's last stanza"""
+    return key[-1] if isinstance(key, (tuple, list)) else key
+
+
+def _common_prefix(a, b) -> int:
+    n = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        n += 1
+    return n
@@ -1,107 +1,414 @@
+import argparse
 import os
-import sys
+import time
 from datetime import datetime
-from itertools import combinations
-from multiprocessing import Pool
 
+import numpy as np
 from tqdm.auto import tqdm
 
 from paradeller.analysis import (
+    StanzaFeasibility,
+    compatibility_graph,
     consolidate_poems,
     consolidate_stanzas,
-    find_final_stanzas,
-    find_matches,
     get_num_combos,
 )
-from paradeller.dataprep import load_and_prep, prep_data, sort_ids_by_popularity
+from paradeller.checkpoint import Run
+from paradeller.dataprep import (
+    PreparedCorpus,
+    load_prepared,
+    sort_ids_by_popularity,
+)
 from paradeller.helper import DATE_FMT, save_results
+from paradeller.metrics import metrics, summarize
+from paradeller.parallel import (
+    CSRGraph,
+    Executor,
+    find_final_stanzas_range,
+    find_matches_pairs,
+    find_matches_range,
+)
+from paradeller.resultcache import ResultCache
 from paradeller.samples import load_samples
+from paradeller.scheduler import SeedScheduler
 
-
-def find_matches_for_pair(p):
-    """Helper function to find initial stanzas, given a pair of lines"""
-    return find_matches(p[0], p[1], adj_list_ids, adj_list_words)
-
-
-def find_final_stanzas_helper(stanzas):
-    """Helper function to find final stanzas, given a group of 3 stanzas"""
-    return find_final_stanzas(*stanzas, adj_list_ids, adj_list_words)
+# with a time budget, share of it spent looking for stanzas (the rest is
+# left for poems)
+STANZA_SHARE = 0.75
 
 
-if __name__ == "__main__":
-    # parse command line arguments
-    args_dict = dict(enumerate(sys.argv))
-    n = int(args_dict.get(1, "100"))  # number of ids to pair off
-    style = args_dict.get(2, "load")  # load | fresh | test
-
-    # note start time
-    start_time = datetime.utcnow()
-
-    # ---------- LOOK FOR STANZAS ----------
-
-    # load & prepare data
+def load(style, workers=None) -> PreparedCorpus:
+    """Load & prepare data (in `workers` processes, if it needs preparing)"""
     if style == "load":
         print("loading data")
-        data, duplicates, adj_list_words, adj_list_ids = load_and_prep(use_pickle=True)
+        return load_prepared(workers=workers)
     elif style == "fresh":
         print("fresh")
-        data, duplicates, adj_list_words, adj_list_ids = load_and_prep(
-            use_pickle=False, update_pickle=True
-        )
+        return load_prepared(rebuild=True, workers=workers)
     elif style == "test":
         print("Loading samples")
         data = load_samples()
-        data, duplicates, adj_list_words, adj_list_ids = prep_data(data, verbose=False)
-    else:
-        exit("Invalid argument")
-
-    # sort tweet ids by avg popularity of its words
-    print("\nSorting by popularity...")
-    sorted_ids = sort_ids_by_popularity(adj_list_ids, adj_list_words)
-
-    # choose some IDS
-    some_ids = sorted_ids[:n]
-    pairs = list(combinations(some_ids, 2))
-
-    # search for stanzas
-    print(f"\nSearching for matches, using {n} ids")
-    with Pool(os.cpu_count()) as pool:
-        res = list(tqdm(pool.imap(find_matches_for_pair, pairs), total=len(pairs)))
-
-    # zip results with search pairs, filter out empty
-    valid_stanzas = [x for x in list(zip(pairs, res)) if x[1]]
-    stanzas = consolidate_stanzas(valid_stanzas)
-    print(f"Found {len(stanzas)} results.")
-
-    # ---------- LOOK FOR PARADELLES ----------
-    if len(stanzas) >= 3:
-        print("\nFinding stanza combinations to check...")
-        # all combinations of stanzas
-        combos = combinations(stanzas, 3)
-        num_combos = get_num_combos(len(stanzas), 3)
-
-        # look for complete paradelles
-        print("Searching for complete paradelles")
-        with Pool(os.cpu_count()) as pool:
-            res = list(
-                tqdm(pool.imap(find_final_stanzas_helper, combos), total=num_combos)
+        return PreparedCorpus.from_data(data, verbose=False)
+    exit("Invalid argument")
+
+
+def search_stanzas(executor, run, some_ids, cache=None):
+    """
+    Look for stanzas seeded by pairs of some_ids.
+
+    Pairs are addressed by their colex rank, so workers generate their own
+    share of them and the pair list is never built. Pass `cache` (a
+    ResultCache) to reuse pairs searched by earlier runs.
+    """
+    ids = np.asarray(some_ids, dtype=np.int64)
+    total = get_num_combos(len(ids), 2)
+    cached = None
+    if cache is not None:
+        covered = lambda p: get_num_combos(p, 2)
+        cached = cache.phase("stanzas", ids.tolist(), covered)
+    res = stream(
+        executor, run, "stanzas", find_matches_range, total, dict(ids=ids), cached
+    )
+
+    # only non-empty results come back, keyed by rank
+    valid_stanzas = [found for _, found in res]
+    return consolidate_stanzas(valid_stanzas)
+
+
+def search_stanzas_budget(executor, run, some_ids, deadline, round_secs=5.0):
+    """
+    Look for stanzas seeded by pairs of some_ids, best pairs first (see
+    scheduler.SeedScheduler), until deadline (a time.monotonic() time).
+
+    Pairs are searched in rounds of about round_secs. After each round the
+    scheduler has learned from its results, and picks the next round.
+    """
+    adj_list_ids = executor.index.adj_list_ids
+    adj_list_words = executor.index.adj_list_words
+    scheduler = SeedScheduler(some_ids, adj_list_ids, adj_list_words)
+    size = executor.workers * 16
+    offset = 0
+    with tqdm(unit="pairs") as bar:
+        while time.monotonic() < deadline:
+            pairs = scheduler.next_pairs(size)
+            if not pairs:
+                break
+            arrays = dict(pairs=np.array(pairs, dtype=np.int64))
+            started = time.monotonic()
+            tasks = executor.map_ranges(
+                find_matches_pairs, len(pairs), arrays, nobar=True, deadline=deadline
+            )
+            for start, stop, batch in tasks:
+                scheduler.record(pairs[start:stop], [found for _, found in batch])
+                batch = [(offset + row, found) for row, found in batch]
+                run.write("stanzas", offset + start, offset + stop, batch)
+                bar.update(stop - start)
+            metrics.count("scheduler.rounds")
+            offset += len(pairs)
+
+            # aim for round_secs a round, but don't grow too fast
+            elapsed = time.monotonic() - started
+            size = int(
+                max(executor.workers, min(size * 2, size * round_secs / elapsed))
             )
-        combos = combinations(stanzas, 3)  # replenish generator
-        valid_poems = list((x for x in zip(combos, res) if x[1]))
-        poems = consolidate_poems(valid_poems)
-        print(f"Found {len(poems)} poems.")
+    run.save(executor.stats)
+
+    # keyed by the order pairs were handed out
+    valid_stanzas = [found for _, found in run.results("stanzas")]
+    return consolidate_stanzas(valid_stanzas)
+
+
+def search_poems(executor, run, stanzas, cache=None, deadline=None):
+    """
+    Look for complete paradelles, given stanzas.
+    Pass `cache` (a ResultCache) to reuse triples searched by earlier runs,
+    and `deadline` (a time.monotonic() time) to stop searching at a time.
+    """
+    adj_list_ids = executor.index.adj_list_ids
+
+    # stanzas that could be in a poem together
+    print("\nFinding compatible stanzas...")
+    with metrics.timer("run.compatibility_graph"):
+        feasible = StanzaFeasibility(
+            stanzas, adj_list_ids, executor.index.word_counts()
+        )
+        graph = compatibility_graph(stanzas, feasible, deadline=deadline)
+        graph = CSRGraph.from_lists(graph)
+    if len(graph) < len(stanzas):
+        print(f"Out of time: only the first {len(graph):,} stanzas are linked up")
+    num_combos = get_num_combos(len(stanzas), 3)
+    print(
+        f"Checking triangles of {len(graph.nbrs):,} compatible stanza pairs "
+        f"({num_combos:,} combinations in all)"
+    )
+
+    # look for complete paradelles, in triangles of the graph
+    print("Searching for complete paradelles")
+    arrays = dict(
+        stanzas=np.array(stanzas, dtype=np.int64).reshape(-1, 4),
+        graph_offsets=graph.offsets,
+        graph_nbrs=graph.nbrs,
+    )
+    cached = None
+    if cache is not None:
+        cached = cache.phase("poems", stanzas, lambda p: p)
+    # later stanzas have more neighbors, so tasks sized on the early ones
+    # would run long: keep them to a share of the graph
+    max_size = max(1, len(graph) // (executor.workers * 8))
+    res = stream(
+        executor,
+        run,
+        "poems",
+        find_final_stanzas_range,
+        len(graph),
+        arrays,
+        cached,
+        deadline,
+        max_size,
+    )
+    valid_poems = [found for _, found in res]
+    return consolidate_poems(valid_poems)
+
+
+def stream(
+    executor,
+    run,
+    phase,
+    func,
+    total,
+    arrays,
+    cached=None,
+    deadline=None,
+    max_size=None,
+):
+    """
+    Search whatever of range(total) the run hasn't done yet (or what it can
+    before deadline), streaming results to the run (and to `cached`, a
+    resultcache.CachedPhase) as they come in, in tasks of up to max_size.
+    Returns all of the phase's results, in key order.
+    """
+    done = run.done(phase)
+    if done.count():
+        print(f"Resuming: {done.count():,} of {total:,} already searched")
+
+    # take what earlier runs found
+    if cached is not None:
+        reused = 0
+        for start, stop in done.missing(total):
+            for s, e in cached.done.overlap(start, stop):
+                run.write(phase, s, e, cached.results(s, e))
+                reused += e - s
+        if reused:
+            print(f"Reusing {reused:,} of {total:,} from earlier runs")
+        metrics.count(f"result_cache.{phase}.reused", reused)
+
+    todo = done.missing(total)
+    tasks = executor.map_ranges(
+        func, total, arrays, todo, deadline=deadline, max_size=max_size
+    )
+    for start, stop, batch in tasks:
+        run.write(phase, start, stop, batch, executor.stats)
+        if cached is not None:
+            cached.write(start, stop, batch)
+    run.save(executor.stats)
+    return run.results(phase)
+
+
+def main(args):
+    started = time.monotonic()
+
+    # ---------- START OR RESUME ----------
+    if args.resume:
+        try:
+            if args.resume == "latest":
+                run = Run.latest()
+            else:
+                run = Run.resume(args.resume)
+        except FileNotFoundError as e:
+            exit(str(e))
+        print(f"Resuming run in {run.path}")
+        if run.state["args"].get("time_budget"):
+            exit(f"Run {run.path} had a time budget, so it can't be resumed")
+        for key in ("n", "style", "cache_size"):
+            setattr(args, key, run.state["args"][key])
+        start_time = datetime.strptime(run.state["args"]["start_time"], DATE_FMT)
     else:
-        print("Not enough stanzas to check for poems")
-        poems = []
+        run = Run.new()
+        print(f"Saving progress to {run.path}")
+        start_time = datetime.utcnow()
+        # checkpoint straight away, so a run stopped while loading resumes
+        run.state["args"] = dict(
+            n=args.n,
+            style=args.style,
+            cache_size=args.cache_size,
+            time_budget=args.time_budget,
+            start_time=start_time.strftime(DATE_FMT),
+        )
+        run.save()
+
+    # ---------- LOOK FOR STANZAS ----------
+    with metrics.timer("run.load"):
+        corpus = load(args.style, args.workers)
+    index = corpus.index
+
+    # results saved so far are only valid for the same corpus
+    fingerprint = index.fingerprint()
+    if run.state["fingerprint"] is None:
+        run.state["fingerprint"] = fingerprint
+        run.save()
+    elif run.state["fingerprint"] != fingerprint:
+        exit(f"Data has changed since run {run.path} started, can't resume it")
+
+    # a budgeted search's order isn't a prefix of anything, so don't cache it
+    deadline = None
+    if args.time_budget:
+        deadline = started + args.time_budget * 60
+    cache = None if args.no_cache or deadline else ResultCache(fingerprint)
+    context = dict(
+        cache_size=args.cache_size,
+        backend=args.backend,
+        memory_budget=int(args.memory_budget * 1e6),
+    )
+    with Executor(index, workers=args.workers, context=context) as executor:
+        del index
+        executor.stats.update(run.state["stats"])
+        adj_list_ids = executor.index.adj_list_ids
+        adj_list_words = executor.index.adj_list_words
+
+        # sort tweet ids by avg popularity of its words
+        print("\nSorting by popularity...")
+        sorted_ids = sort_ids_by_popularity(adj_list_ids, adj_list_words)
+
+        # search for stanzas
+        try:
+            with metrics.timer("run.search_stanzas"):
+                if deadline:
+                    seeds = sorted_ids[: args.n] if args.n else sorted_ids
+                    print(
+                        f"\nSearching for matches, pairing off {len(seeds)} ids "
+                        f"best first for {args.time_budget * STANZA_SHARE:g} minutes"
+                    )
+                    stanza_deadline = started + (deadline - started) * STANZA_SHARE
+                    stanzas = search_stanzas_budget(
+                        executor, run, seeds, stanza_deadline
+                    )
+                else:
+                    args.n = args.n or 100
+                    print(f"\nSearching for matches, using {args.n} ids")
+                    stanzas = search_stanzas(executor, run, sorted_ids[: args.n], cache)
+            print(f"Found {len(stanzas)} results.")
+
+            # ---------- LOOK FOR PARADELLES ----------
+            if len(stanzas) >= 3:
+                with metrics.timer("run.search_poems"):
+                    poems = search_poems(executor, run, stanzas, cache, deadline)
+                print(f"Found {len(poems)} poems.")
+            else:
+                print("Not enough stanzas to check for poems")
+                poems = []
+        finally:
+            # keep what's done so far, e.g. on Ctrl-C
+            executor.stats.update(metrics.pop())
+            run.save(executor.stats)
+            run.close()
+            if cache is not None:
+                cache.close()
+
+        prefix = "final_stanza_cache."
+        cache_stats = {
+            k[len(prefix) :]: v
+            for k, v in executor.stats.items()
+            if k.startswith(prefix)
+        }
 
     # ---------- SUMMARIZE & SAVE ----------
     stop_time = datetime.utcnow()
     meta = dict(
         start_time=start_time.strftime(DATE_FMT),
         stop_time=stop_time.strftime(DATE_FMT),
-        n=n,
-        style=style,
-        data_len=len(data),
+        n=args.n,
+        style=args.style,
+        time_budget=args.time_budget,
+        data_len=corpus.data_len,
+        workers=executor.workers,
+        backend=args.backend,
+        final_stanza_cache=dict(cache_stats, maxsize=args.cache_size),
+        metrics=summarize(executor.stats),
+        run=run.path,
+    )
+    results = dict(
+        meta=meta, stanzas=stanzas, poems=poems, duplicates=corpus.duplicates
     )
-    results = dict(meta=meta, stanzas=stanzas, poems=poems, duplicates=duplicates)
     save_results(results)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m paradeller.run", description="Search for paradelles"
+    )
+    parser.add_argument(
+        "n",
+        nargs="?",
+        type=int,
+        help="number of ids to pair off (default: 100, or all of them "
+        "with --time-budget)",
+    )
+    parser.add_argument(
+        "style",
+        nargs="?",
+        default="load",
+        choices=["load", "fresh", "test"],
+        help="where to get data",
+    )
+    parser.add_argument(
+        "cache_size",
+        nargs="?",
+        type=int,
+        default=1_000_000,
+        help="tweet ids held in each worker's final stanza cache",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=os.cpu_count(),
+        help="number of worker processes (default: number of CPUs)",
+    )
+    parser.add_argument(
+        "--resume",
+        nargs="?",
+        const="latest",
+        metavar="RUN_DIR",
+        help="resume an interrupted run (default: the latest one), "
+        "with the arguments it was started with",
+    )
+    parser.add_argument(
+        "--time-budget",
+        type=float,
+        metavar="MINUTES",
+        help="search the most promising pairs first, for this long, "
+        "instead of every pair of n ids",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="search everything again, rather than reusing earlier runs' results",
+    )
+    parser.add_argument(
+        "--backend",
+        choices=["python", "numpy"],
+        default="python",
+        help="how candidate lines are found and checked: one at a time, or "
+        "as batches of word-count vectors (faster when words are common)",
+    )
+    parser.add_argument(
+        "--memory-budget",
+        type=float,
+        default=64,
+        metavar="MB",
+        help="most memory for each worker's numpy batches",
+    )
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    main(parse_args())
@@ -0,0 +1,179 @@
+"""
+Best-first scheduling of seed pairs, for searches with a time budget.
+
+Each seed (tweet) gets a score, and a pair's score is the sum of its
+seeds' scores. Pairs come off a heap best first, rather than in
+combinations order, so whatever the budget allows is spent on the pairs
+most likely to make stanzas.
+
+The heap holds one entry per seed: its pair with the best-scoring partner
+it hasn't been tried with yet. Scores change as results come in, and then
+the partners are re-sorted and the heap rebuilt before the next pairs are
+handed out, so each batch of pairs is the best by the scores so far.
+
+A seed's score starts from its words:
+  - popularity: the mean number of tweets sharing each of its words (as
+    dataprep.sort_ids_by_popularity), since common words have more lines
+    to match them
+  - rare-word coverage: how many tweets share its rarest word, since the
+    other two lines of a stanza must have that word between them
+
+and learns from the search so far:
+  - hit rate: stanzas found by pairs with the seed, over pairs tried,
+    smoothed towards `prior_rate`
+  - vocabulary overlap: the share of the seed's words used by stanzas
+    found so far
+"""
+
+import heapq
+import math
+from collections import Counter
+from statistics import mean
+
+
+class SeedScheduler:
+    """
+    Hands out pairs of seeds, best first, learning from results as it goes.
+
+    Parameters
+    ----------
+    seeds : list
+        tweet ids to pair off
+    adj_list_ids : dict
+        tweet id -> list of words
+    adj_list_words : dict
+        word -> ids of tweets with it
+    rare_weight : float
+        weight of rare-word coverage, relative to popularity
+    learn_weight : float
+        weight of the hit rate
+    overlap_weight : float
+        weight of vocabulary overlap
+    prior_rate : float
+        stanzas expected per pair, before a seed has been tried
+    smoothing : float
+        how many pairs' worth of evidence the prior rate counts for
+    """
+
+    def __init__(self, seeds, adj_list_ids, adj_list_words, **kwargs):
+        self.rare_weight = kwargs.get("rare_weight", 1.0)
+        self.learn_weight = kwargs.get("learn_weight", 1.0)
+        self.overlap_weight = kwargs.get("overlap_weight", 2.0)
+        self.prior_rate = kwargs.get("prior_rate", 0.01)
+        self.smoothing = kwargs.get("smoothing", 20)
+        self.adj_list_ids = adj_list_ids
+        self.adj_list_words = adj_list_words
+
+        priors = {id_: self.prior(adj_list_ids[id_]) for id_ in seeds}
+        # seeds are numbered by position, in order of prior score
+        self.ids = sorted(seeds, key=priors.get, reverse=True)
+        self.pos = {id_: p for p, id_ in enumerate(self.ids)}
+        self.priors = [priors[id_] for id_ in self.ids]
+
+        self.tries = Counter()  # position -> pairs tried
+        self.hits = Counter()  # position -> stanzas found
+        self.hit_words = set()  # words of stanzas found
+        self.scores = [self.score(p) for p in range(len(self.ids))]
+
+        self.partners = [set() for _ in self.ids]  # position -> partners tried
+        self.handed_out = 0
+        self._rebuild()
+
+    def prior(self, words) -> float:
+        """Score of a seed before any searching: popularity and rare-word coverage"""
+        num_ids = [len(self.adj_list_words[w]) for w in words]
+        return math.log(mean(num_ids)) + self.rare_weight * math.log(min(num_ids))
+
+    def score(self, p) -> float:
+        """Current score of the seed at position p"""
+        rate = (self.hits[p] + self.smoothing * self.prior_rate) / (
+            self.tries[p] + self.smoothing
+        )
+        words = set(self.adj_list_ids[self.ids[p]])
+        overlap = len(words & self.hit_words) / len(words)
+        return (
+            self.priors[p]
+            + self.learn_weight * math.log(rate / self.prior_rate)
+            + self.overlap_weight * overlap
+        )
+
+    def __len__(self):
+        """Number of pairs not handed out yet"""
+        n = len(self.ids)
+        return n * (n - 1) // 2 - self.handed_out
+
+    def next_pairs(self, k) -> list:
+        """Up to k of the best pairs not handed out yet"""
+        if self.stale:
+            self._rebuild()
+        pairs = []
+        heap = self.heap
+        while heap and len(pairs) < k:
+            _, p, q = heapq.heappop(heap)
+            if q in self.partners[p]:
+                # handed out from q's side since this was pushed
+                self._push(p)
+                continue
+            pairs.append((self.ids[min(p, q)], self.ids[max(p, q)]))
+            self.partners[p].add(q)
+            self.partners[q].add(p)
+            self.handed_out += 1
+            self._push(p)
+        return pairs
+
+    def record(self, pairs, found):
+        """
+        Learn from a batch of searched pairs, and the (pair, matches) found
+        among them. Updates the scores of every seed affected.
+        """
+        changed = set()
+        for pair in pairs:
+            for id_ in pair:
+                self.tries[self.pos[id_]] += 1
+                changed.add(self.pos[id_])
+
+        new_words = set()
+        for pair, matches in found:
+            for id_ in pair:
+                self.hits[self.pos[id_]] += len(matches)
+            for id_ in (*pair, *(x for match in matches for x in match)):
+                new_words.update(self.adj_list_ids[id_])
+        new_words -= self.hit_words
+        self.hit_words |= new_words
+        for word in new_words:
+            changed.update(
+                self.pos[id_] for id_ in self.adj_list_words[word] if id_ in self.pos
+            )
+
+        for p in changed:
+            self.scores[p] = self.score(p)
+        self.stale = self.stale or bool(changed)
+
+    def _rebuild(self):
+        """Order partners by current score, and queue each seed's best pair"""
+        self.order = sorted(
+            range(len(self.ids)), key=self.scores.__getitem__, reverse=True
+        )
+        # how far down self.order each seed has looked for a partner
+        self.cursor = [0] * len(self.ids)
+        self.heap = []
+        for p in range(len(self.ids)):
+            self._push(p, heap=False)
+        heapq.heapify(self.heap)
+        self.stale = False
+
+    def _push(self, p, heap=True):
+        """Queue seed p's best pair not handed out yet, if it has one left"""
+        order, tried = self.order, self.partners[p]
+        i = self.cursor[p]
+        while i < len(order) and (order[i] == p or order[i] in tried):
+            i += 1
+        self.cursor[p] = i
+        if i == len(order):
+            return
+        q = order[i]
+        entry = (-(self.scores[p] + self.scores[q]), p, q)
+        if heap:
+            heapq.heappush(self.heap, entry)
+        else:
+            self.heap.append(entry)
@@ -0,0 +1,86 @@
+from collections import Counter
+
+from paradeller.metrics import metrics
+
+
+def exact_covers(pot_ids, adj_list_ids, target_words, k=6):
+    """
+    Find groups of k tweets whose words together exactly equal target_words.
+
+    Treats the search as an exact cover of the target_words multiset.
+    Depth-first search that always branches on the remaining word with the
+    fewest candidate lines, and prunes candidates that no longer fit the
+    remaining word counts. Each group is yielded once, as it is found.
+
+    Parameters
+    ----------
+    pot_ids : list
+        candidate tweet ids
+    adj_list_ids : dict
+        tweet id -> list of words
+    target_words : list
+        words to cover, with repeats
+    k : int
+        number of tweets in each group
+
+    Yields
+    ------
+    tuple
+        k tweet ids, in the order they appear in pot_ids
+    """
+    target = Counter(target_words)
+
+    # only keep lines that could fit in the target at all
+    lines = {}
+    for pos, id_ in enumerate(pot_ids):
+        counts = Counter(adj_list_ids[id_])
+        if fits(counts, target):
+            lines[pos] = counts
+
+    metrics.count("exact_covers.lines", len(lines))
+    for positions in _search(lines, target, sorted(lines), [], k):
+        yield tuple(pot_ids[pos] for pos in sorted(positions))
+
+
+def _search(lines, remaining, available, chosen, k):
+    """Recursive step of exact_covers, yields lists of positions"""
+    total = sum(remaining.values())
+    if k == 0 or total == 0:
+        if k == 0 and total == 0:
+            yield list(chosen)
+        return
+
+    # prune on line lengths: k lines must use up exactly `total` words
+    if len(available) < k:
+        return
+    lengths = sorted(sum(lines[pos].values()) for pos in available)
+    if sum(lengths[:k]) > total or sum(lengths[-k:]) < total:
+        return
+
+    # branch on the rarest remaining word
+    options = None
+    for word, count in remaining.items():
+        if count <= 0:
+            continue
+        word_options = [pos for pos in available if word in lines[pos]]
+        if options is None or len(word_options) < len(options):
+            options = word_options
+            if not options:
+                return
+
+    # every cover uses at least one line with the word; branching on the
+    # first such line (in order) means each cover is only found once
+    for i, pos in enumerate(options):
+        excluded = set(options[: i + 1])
+        new_remaining = remaining - lines[pos]
+        new_available = [
+            q for q in available if q not in excluded and fits(lines[q], new_remaining)
+        ]
+        chosen.append(pos)
+        yield from _search(lines, new_remaining, new_available, chosen, k - 1)
+        chosen.pop()
+
+
+def fits(counts, remaining) -> bool:
+    """True if counts (a Counter) is a sub-multiset of remaining"""
+    return all(remaining[word] >= n for word, n in counts.items())
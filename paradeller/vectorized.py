@@ -0,0 +1,217 @@
+"""
+NumPy backend for finding matches: candidate lines are tested and
+paired as arrays of word counts, rather than one tweet at a time.
+
+A tweet's word-count vector, over the interned vocabulary of a
+CorpusIndex, is sparse. Candidates for a stanza can only use the stanza's
+own words, so each is held as a dense vector over just those k words, one
+row of an (n, k) count matrix built straight from the index's flat token
+arrays. Tweets with any other word, or with more of a word than the
+stanza has, are dropped on the way. Before their tokens are read, most
+are ruled out at once by a 64-bit mask per tweet, of its words hashed to
+bits: a tweet can't be made of the stanza's words if its mask has bits
+outside theirs.
+
+Two candidates complete the stanza when their counts add up to the
+stanza's. Rather than adding up every pair, each row's complement
+(target minus the row) is labelled alongside the rows themselves, and
+pairs are rows whose label equals another's complement label. Arrays are
+worked through in batches, sized so none takes more than memory_budget
+bytes.
+"""
+
+import numpy as np
+
+from paradeller.index import CorpusIndex, word_bits
+from paradeller.metrics import metrics
+
+
+class VectorMatcher:
+    """
+    Finds matches like analysis.find_matches, against a CorpusIndex.
+
+    Parameters
+    ----------
+    index : CorpusIndex
+        corpus to search
+    memory_budget : int
+        most bytes of temporary arrays to work with at once
+    """
+
+    def __init__(self, index: CorpusIndex, memory_budget=64_000_000):
+        self.index = index
+        self.memory_budget = memory_budget
+        self.lengths = np.diff(index.token_offsets)
+        self.posting_lengths = index.posting_lengths()
+
+    def find_matches(self, id1, id2, earlier=None) -> list:
+        """
+        Pairs of tweets that complete the stanza started by tweets id1 and
+        id2, as analysis.find_matches (same pairs, in row order)
+        """
+        index = self.index
+        seeds = np.array([index.row_of(id1), index.row_of(id2)])
+        word_ids = np.concatenate([index.token_ids(row) for row in seeds])
+        vocab, target = np.unique(word_ids, return_counts=True)
+
+        with metrics.timer("find_matches.gather"):
+            rows, counts = self.candidates(vocab, target, seeds)
+        metrics.count("find_matches.seeds")
+        metrics.count("find_matches.candidates", len(rows))
+        metrics.observe("find_matches.pot_ids", len(rows))
+
+        if len(rows) < 2:
+            return []
+        with metrics.timer("find_matches.verify"):
+            pairs = self.complement_pairs(counts, target)
+            ids = index.tweet_ids[rows]
+            if earlier is not None and len(pairs):
+                before = np.fromiter(map(earlier, ids.tolist()), bool, len(ids))
+                pairs = pairs[~(before[pairs[:, 0]] & before[pairs[:, 1]])]
+            valid = [tuple(pair) for pair in ids[pairs].tolist()]
+        metrics.count("find_matches.matches", len(valid))
+        return valid
+
+    def candidates(self, vocab, target, exclude) -> tuple:
+        """
+        Rows (not in exclude) that could be one of two lines completing a
+        stanza with word ids vocab (sorted) and counts target.
+        Returns (rows, their count matrix over vocab), by row.
+
+        As analysis.gather_candidates: one line of a completing pair has
+        the stanza's rarest word, and its partner then has the rarest word
+        of what's left, so only those words' postings are read.
+        """
+        rarest = lambda mask: vocab[mask][np.argmin(self.posting_lengths[vocab[mask]])]
+        by_word = {}
+
+        def lookup(word_id):
+            if word_id not in by_word:
+                rows = self.index.rows_with(word_id)
+                rows = rows[~np.isin(rows, exclude)]
+                by_word[word_id] = self.subset_rows(rows, vocab, target)
+            return by_word[word_id]
+
+        anchors, anchor_counts = lookup(int(rarest(target > 0)))
+        complements = target - anchor_counts
+        partner_words = {int(rarest(left > 0)) for left in complements if left.any()}
+        found = [(anchors, anchor_counts)]
+        for word_id in sorted(partner_words):
+            rows, counts = lookup(word_id)
+            # partners must be exactly the complement of some anchor
+            keep = _isin_rows(counts, complements)
+            found.append((rows[keep], counts[keep]))
+
+        rows = np.concatenate([rows for rows, _ in found])
+        counts = np.concatenate([counts for _, counts in found])
+        rows, first = np.unique(rows, return_index=True)
+        return rows, counts[first]
+
+    def final_candidates(self, words, exclude) -> list:
+        """
+        Ids of tweets (not in exclude) that could be lines of a final
+        stanza using up words (with repeats), for analysis.search_final_lines
+        """
+        word_ids = np.array([self.index.word_id(word) for word in words])
+        vocab, target = np.unique(word_ids, return_counts=True)
+        rows = np.unique(np.concatenate([self.index.rows_with(w) for w in vocab]))
+        rows, _ = self.subset_rows(rows, vocab, target)
+        ids = self.index.tweet_ids[rows].tolist()
+        return [id_ for id_ in ids if id_ not in exclude]
+
+    def subset_rows(self, rows, vocab, target) -> tuple:
+        """
+        Rows whose words are a sub-multiset of target (counts of the word
+        ids vocab), and their count matrix over vocab.
+        """
+        index = self.index
+        tested = len(rows)
+        mask = np.bitwise_or.reduce(word_bits(vocab))
+        rows = rows[(index.row_masks[rows] & ~mask) == 0]
+
+        kept_rows, kept_counts = [], []
+        # tokens take ~40 bytes each on the way, counts 4 per word
+        nbytes = self.lengths[rows] * 40 + len(vocab) * 4
+        for batch in self._batches(rows, nbytes):
+            tokens, row_of_token = index.tokens_of(batch)
+
+            pos = np.searchsorted(vocab, tokens)
+            known = vocab[np.minimum(pos, len(vocab) - 1)] == tokens
+            subset = np.ones(len(batch), bool)
+            subset[row_of_token[~known]] = False
+
+            counts = np.zeros((len(batch), len(vocab)), np.int32)
+            np.add.at(counts, (row_of_token[known], pos[known]), 1)
+            ok = subset & (counts <= target).all(axis=1)
+            kept_rows.append(batch[ok])
+            kept_counts.append(counts[ok])
+
+        metrics.count("filter_subsets.tested", tested)
+        kept = sum(len(r) for r in kept_rows)
+        metrics.count("filter_subsets.rejected", tested - kept)
+        if not kept_rows:
+            return np.zeros(0, rows.dtype), np.zeros((0, len(vocab)), np.int32)
+        return np.concatenate(kept_rows), np.concatenate(kept_counts)
+
+    def complement_pairs(self, counts, target) -> np.ndarray:
+        """
+        (i, j) positions, i < j, of the rows of counts that add up to
+        target, as an (m, 2) array sorted by i then j
+        """
+        n = len(counts)
+        # label every row and every complement, equal vectors share a label
+        _, labels = np.unique(
+            np.concatenate([counts, target - counts]), axis=0, return_inverse=True
+        )
+        labels = labels.reshape(-1)
+        row_labels, complement_labels = labels[:n], labels[n:]
+
+        order = np.argsort(row_labels, kind="stable")
+        sorted_labels = row_labels[order]
+        lo = np.searchsorted(sorted_labels, complement_labels, "left")
+        hi = np.searchsorted(sorted_labels, complement_labels, "right")
+
+        found = []
+        # ~48 bytes for each pair considered
+        for batch in self._batches(np.arange(n), (hi - lo) * 48):
+            num = hi[batch] - lo[batch]
+            i = np.repeat(batch, num)
+            j = order[_ranges(lo[batch], num)]
+            keep = i < j
+            found.append(np.stack([i[keep], j[keep]], axis=1))
+        if not found:
+            return np.zeros((0, 2), np.int64)
+        pairs = np.concatenate(found)
+        return pairs[np.lexsort((pairs[:, 1], pairs[:, 0]))]
+
+    def _batches(self, items, nbytes):
+        """
+        Split items into runs that take no more than memory_budget bytes
+        between them (at least one item each), given the bytes each takes
+        """
+        ends = np.cumsum(nbytes)
+        start = 0
+        while start < len(items):
+            base = ends[start - 1] if start else 0
+            stop = int(np.searchsorted(ends, base + self.memory_budget, "right"))
+            stop = max(stop, start + 1)
+            yield items[start:stop]
+            start = stop
+
+
+def _ranges(starts, lengths) -> np.ndarray:
+    """Concatenated range(start, start + length) for each start and length"""
+    total = int(lengths.sum())
+    if not total:
+        return np.zeros(0, np.int64)
+    offsets = np.repeat(np.cumsum(lengths) - lengths, lengths)
+    return np.repeat(starts, lengths) + np.arange(total) - offsets
+
+
+def _isin_rows(a, b) -> np.ndarray:
+    """For each row of a, whether it's also a row of b"""
+    if not len(a) or not len(b):
+        return np.zeros(len(a), bool)
+    _, labels = np.unique(np.concatenate([a, b]), axis=0, return_inverse=True)
+    labels = labels.reshape(-1)
+    return np.isin(labels[: len(a)], labels[len(a) :])
@@ -0,0 +1,45 @@
+import random
+from collections import Counter
+from itertools import combinations
+
+import pytest
+
+from paradeller.analysis import find_valid_matches
+
+
+def random_lines(rng, num_lines, vocab_size, max_len=4):
+    """id -> words, for lines of random words from a small vocabulary"""
+    vocab = [f"w{i}" for i in range(vocab_size)]
+    return {
+        id_: rng.choices(vocab, k=rng.randint(1, max_len))
+        for id_ in range(100, 100 + num_lines)
+    }
+
+
+def brute_force_matches(pot_ids, adj_list_ids, stanza_words, earlier=None):
+    """Every pair of pot_ids whose words add up to stanza_words"""
+    target = Counter(stanza_words)
+    return [
+        (a, b)
+        for a, b in combinations(pot_ids, 2)
+        if Counter(adj_list_ids[a] + adj_list_ids[b]) == target
+        and not (earlier is not None and earlier(a) and earlier(b))
+    ]
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_find_valid_matches_same_as_brute_force(seed):
+    rng = random.Random(seed)
+    adj_list_ids = random_lines(rng, 60, 5)
+    pot_ids = list(adj_list_ids)
+    rng.shuffle(pot_ids)
+    id1, id2 = rng.sample(pot_ids, 2)
+    stanza_words = adj_list_ids[id1] + adj_list_ids[id2]
+    earlier = lambda id_: id_ % 3 == 0
+
+    expected = brute_force_matches(pot_ids, adj_list_ids, stanza_words)
+    assert expected
+    assert find_valid_matches(pot_ids, adj_list_ids, stanza_words) == expected
+    assert find_valid_matches(
+        pot_ids, adj_list_ids, stanza_words, earlier
+    ) == brute_force_matches(pot_ids, adj_list_ids, stanza_words, earlier)
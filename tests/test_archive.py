@@ -0,0 +1,34 @@
+import pytest
+
+from paradeller.archive import ArchiveStore
+
+TWEETS = [dict(id=i, text=f"tweet {i}", author="a", time="t") for i in range(5)]
+
+
+def test_reading_missing_archive_raises(tmp_path):
+    path = tmp_path / "mistyped"
+    store = ArchiveStore(str(path))
+    assert len(store) == 0
+    assert not store.exists
+    with pytest.raises(FileNotFoundError):
+        list(store)
+    with pytest.raises(FileNotFoundError):
+        store.get(1)
+    with pytest.raises(FileNotFoundError):
+        store.fingerprint()
+    store.close()
+    assert not path.exists()
+
+
+def test_created_on_first_add(tmp_path):
+    path = tmp_path / "archive"
+    with ArchiveStore(str(path)) as store:
+        assert store.add([]) == 0
+        assert not path.exists()
+        assert store.add(TWEETS) == len(TWEETS)
+        assert store.add(TWEETS) == 0
+
+    with ArchiveStore(str(path)) as store:
+        assert store.exists
+        assert list(store) == TWEETS
+        assert store.get(3) == TWEETS[3]
@@ -0,0 +1,38 @@
+import pytest
+
+from paradeller.bench.corpus import synthetic_corpus
+from paradeller.bench.suite import run_stages
+
+
+@pytest.fixture(scope="module")
+def corpus():
+    return synthetic_corpus(200, plant=2, seed=0)
+
+
+@pytest.mark.parametrize("backend", ["python", "numpy"])
+def test_run_every_stage(corpus, backend):
+    results = run_stages(
+        corpus, repeat=1, seeds=20, workers=1, prep_workers=(1, 2), backend=backend
+    )
+    by_stage = {result["stage"]: result for result in results}
+    assert set(by_stage) == {
+        "prep",
+        "prep_parallel_1",
+        "prep_parallel_2",
+        "find_matches",
+        "find_final_stanzas",
+        "pipeline",
+    }
+    for result in results:
+        assert result["seconds"] >= 0
+        assert len(result["times"]) == 1
+    assert by_stage["prep_parallel_1"]["counts"]["same"]
+    assert by_stage["prep_parallel_2"]["counts"]["same"]
+    counts = by_stage["find_final_stanzas"]["counts"]
+    assert counts["poems"] >= counts["planted_poems"] > 0
+
+
+def test_prep_parallel_without_workers(corpus):
+    results = run_stages(corpus, stages=("prep_parallel",), repeat=1, prep_workers=())
+    assert results == []
+
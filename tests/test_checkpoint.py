@@ -0,0 +1,89 @@
+import pytest
+
+import paradeller.checkpoint as checkpoint
+import paradeller.run as run_module
+from paradeller.checkpoint import Run, has_checkpoint
+from paradeller.run import main, parse_args
+
+
+@pytest.fixture
+def runs_fp(tmp_path, monkeypatch):
+    path = tmp_path / "runs"
+    monkeypatch.setattr(checkpoint, "runs_fp", str(path))
+    return path
+
+
+@pytest.fixture
+def saved(monkeypatch):
+    """Results main would have saved to data/found"""
+    found = []
+    monkeypatch.setattr(run_module, "save_results", found.append)
+    return found
+
+
+def test_latest_skips_runs_without_checkpoint(runs_fp):
+    first = Run.new()
+    first.save()
+    first.close()
+    (runs_fp / "run_9999-99-99-999999").mkdir()
+
+    run = Run.latest()
+    assert run.path == first.path
+    run.close()
+
+
+def test_latest_skips_runs_with_time_budget(runs_fp):
+    first = Run.new()
+    first.save()
+    first.close()
+    budgeted = Run(str(runs_fp / "run_9999-99-99-999999"))
+    budgeted.state["args"] = dict(time_budget=5)
+    budgeted.save()
+    budgeted.close()
+
+    run = Run.latest()
+    assert run.path == first.path
+    run.close()
+
+
+def test_resume_only_budgeted_runs_exits(runs_fp, saved):
+    budgeted = Run.new()
+    budgeted.state["args"] = dict(time_budget=5)
+    budgeted.save()
+    budgeted.close()
+    with pytest.raises(SystemExit, match="time budget"):
+        main(parse_args(["--resume", "--workers", "1"]))
+    with pytest.raises(SystemExit, match="time budget"):
+        main(parse_args(["--resume", budgeted.path, "--workers", "1"]))
+    assert not saved
+
+
+def test_resume_without_checkpoint_exits(runs_fp, saved):
+    empty = runs_fp / "run_empty"
+    empty.mkdir(parents=True)
+    with pytest.raises(SystemExit, match="nothing to resume"):
+        main(parse_args(["--resume", str(empty), "--workers", "1"]))
+
+    with pytest.raises(SystemExit, match="no runs to resume"):
+        main(parse_args(["--resume", "--workers", "1"]))
+    assert not saved
+
+
+def test_resume_run_stopped_while_loading(runs_fp, saved, monkeypatch):
+    load = run_module.load
+
+    def interrupted(style, workers=None):
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(run_module, "load", interrupted)
+    with pytest.raises(KeyboardInterrupt):
+        main(parse_args(["100", "test", "--workers", "1", "--no-cache"]))
+    (path,) = runs_fp.iterdir()
+    assert has_checkpoint(path)
+
+    monkeypatch.setattr(run_module, "load", load)
+    main(parse_args(["--resume", "--workers", "1", "--no-cache"]))
+    (results,) = saved
+    assert results["meta"]["n"] == 100
+    assert len(results["stanzas"]) == 12
+    assert len(results["poems"]) == 4
@@ -0,0 +1,36 @@
+import pytest
+
+from paradeller.bench.corpus import synthetic_corpus
+from paradeller.dataprep import (
+    filter_out_oddballs,
+    filter_out_oddballs_recursive,
+    prep_data,
+    prep_data_parallel,
+)
+
+
+def prune_in_rounds(data):
+    """Oddballs removed the old way: whole rounds until nothing changes"""
+    while True:
+        kept = filter_out_oddballs(data, nobar=True)
+        if len(kept) == len(data):
+            return kept
+        data = kept
+
+
+# from nothing removed to almost everything, over several rounds
+@pytest.mark.parametrize("vocab_size", [30, 150, 400])
+def test_oddball_pruner_same_as_rounds(vocab_size):
+    data = synthetic_corpus(300, plant=1, vocab_size=vocab_size).data
+    kept = filter_out_oddballs_recursive(data, verbose=False, nobar=True)
+    assert kept == prune_in_rounds(data)
+
+
+def test_prep_data_parallel_same_as_prep_data():
+    data = synthetic_corpus(400, plant=2, vocab_size=150).data
+    # repeat some tweets' words, so there are duplicates across chunks
+    data += [dict(x, id=10_000 + i) for i, x in enumerate(data[::7])]
+    data += [dict(id=20_000, text="too short"), dict(id=20_001, text="")]
+    expected = prep_data(data, verbose=False)
+    assert prep_data_parallel(data, workers=2, verbose=False, chunk_size=50) == expected
+    assert prep_data_parallel(data, workers=1, verbose=False) == expected
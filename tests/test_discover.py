@@ -0,0 +1,55 @@
+from collections import defaultdict
+from itertools import combinations
+
+import pytest
+
+from paradeller.analysis import canonical_stanza
+from paradeller.bench.corpus import synthetic_corpus
+from paradeller.dataprep import prep_data
+from paradeller.discover import DiskLimitExceeded, discover_stanzas
+from paradeller.index import CorpusIndex
+
+
+def brute_force_stanzas(adj_list_ids):
+    """Every two disjoint pairs of tweets with the same words"""
+    by_words = defaultdict(list)
+    for pair in combinations(adj_list_ids, 2):
+        words = sorted(adj_list_ids[pair[0]] + adj_list_ids[pair[1]])
+        by_words[tuple(words)].append(pair)
+    return sorted(
+        canonical_stanza(p1, p2)
+        for pairs in by_words.values()
+        for p1, p2 in combinations(pairs, 2)
+        if len({*p1, *p2}) == 4
+    )
+
+
+@pytest.fixture(scope="module", params=[(40, 0), (150, 1)], ids=["40", "150"])
+def corpus(request):
+    vocab_size, seed = request.param
+    data = synthetic_corpus(250, plant=2, vocab_size=vocab_size, seed=seed).data
+    _, _, _, adj_list_ids = prep_data(data, verbose=False)
+    return adj_list_ids, CorpusIndex.build(adj_list_ids)
+
+
+def test_same_as_brute_force(corpus):
+    adj_list_ids, index = corpus
+    expected = brute_force_stanzas(adj_list_ids)
+    assert expected
+    assert discover_stanzas(index, nobar=True) == expected
+
+
+def test_spilled_to_shards(corpus, tmp_path):
+    adj_list_ids, index = corpus
+    stanzas = discover_stanzas(index, max_pairs=500, tmpdir=str(tmp_path), nobar=True)
+    assert stanzas == brute_force_stanzas(adj_list_ids)
+    assert not list(tmp_path.iterdir())
+
+
+def test_disk_limit(corpus, tmp_path):
+    _, index = corpus
+    with pytest.raises(DiskLimitExceeded):
+        discover_stanzas(
+            index, max_pairs=500, tmpdir=str(tmp_path), max_disk_bytes=1000, nobar=True
+        )
+    assert not list(tmp_path.iterdir())
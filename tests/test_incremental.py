@@ -0,0 +1,34 @@
+import pytest
+
+from paradeller.bench.corpus import synthetic_corpus
+from paradeller.dataprep import prep_data
+from paradeller.discover import discover_stanzas
+from paradeller.incremental import IncrementalCorpus
+from paradeller.index import CorpusIndex
+
+
+def expected(data):
+    """Kept ids and stanzas, preparing and searching everything from scratch"""
+    _, _, _, adj_list_ids = prep_data(data, verbose=False)
+    if not adj_list_ids:
+        return set(), set()
+    index = CorpusIndex.build(adj_list_ids)
+    return set(adj_list_ids), set(discover_stanzas(index, nobar=True))
+
+
+# with 40 words random tweets make stanzas too, with 150 many tweets are
+# pruned as oddballs, and some come back into play as their words turn up
+@pytest.mark.parametrize("vocab_size,seed", [(40, 0), (150, 1)])
+def test_same_as_prep_data_after_every_batch(vocab_size, seed):
+    data = synthetic_corpus(300, plant=2, vocab_size=vocab_size, seed=seed).data
+    corpus = IncrementalCorpus()
+    found = set()
+    for start in range(0, len(data), 50):
+        new = corpus.add(data[start : start + 50])
+        assert not found & set(new)
+        found.update(new)
+
+        kept, stanzas = expected(data[: start + 50])
+        assert set(corpus.adj_list_ids) == kept
+        assert corpus.stanzas == found == stanzas
+    assert found
@@ -0,0 +1,85 @@
+import asyncio
+import time
+
+import pytest
+
+from paradeller.archive import ArchiveStore
+from paradeller.ingest import FakeSource, RateLimited, ingest
+
+GOOD = [
+    dict(id=i, text=f"line {i} of some good words", author="a", time="t")
+    for i in range(10)
+]
+BAD = [
+    dict(id=100, text="@someone hello there friend", author="a", time="t"),
+    dict(id=101, text="too short", author="a", time="t"),
+]
+
+
+class FetchError(Exception):
+    pass
+
+
+class OtherError(Exception):
+    pass
+
+
+class ScriptedSource(FakeSource):
+    """FakeSource whose fetches fail as scripted, noting when each was made"""
+
+    errors = (FetchError,)
+
+    def __init__(self, script, **kwargs):
+        super().__init__(GOOD[:5] + BAD + GOOD[5:], count=4, **kwargs)
+        self.script = list(script)
+        self.calls = []
+
+    async def fetch(self) -> list:
+        self.calls.append(time.monotonic())
+        outcome = self.script.pop(0) if self.script else "ok"
+        if outcome == "error":
+            raise FetchError("fetch failed")
+        if outcome == "other":
+            raise OtherError("bug in source")
+        if outcome == "limit":
+            raise RateLimited(0.3)
+        return await super().fetch()
+
+
+def run(source, store, n):
+    return asyncio.run(ingest(source, store, n, batch_size=5, nobar=True))
+
+
+def test_good_tweets_archived_once(tmp_path):
+    source = ScriptedSource(["ok", "error", "ok", "limit", "error"])
+    with ArchiveStore(str(tmp_path)) as store:
+        stats = run(source, store, 12)
+        assert sorted(x["id"] for x in store) == [x["id"] for x in GOOD]
+
+    assert stats["fetches"] == 12
+    assert stats["errors"] == 2
+    # the rate limited call is retried, not counted as a fetch
+    assert len(source.calls) == 13
+    assert stats["fetched"] == 4 * 10
+    assert stats["added"] == len(GOOD)
+
+
+def test_other_errors_propagate(tmp_path):
+    source = ScriptedSource(["ok", "other"])
+    with ArchiveStore(str(tmp_path)) as store:
+        with pytest.raises(OtherError):
+            run(source, store, 4)
+
+
+def test_rate_limit_respected(tmp_path):
+    # bursts of 2, then 10 calls a second
+    source = ScriptedSource(["ok", "ok", "ok", "limit"], rate_limit=(2, 0.2))
+    with ArchiveStore(str(tmp_path)) as store:
+        run(source, store, 6)
+
+    calls = [t - source.calls[0] for t in source.calls]
+    assert len(calls) == 7
+    for k, t in enumerate(calls[:4]):
+        assert t >= (k - 1) * 0.1 - 0.01
+    # after being told the limit was hit, every fetcher waits it out
+    assert min(calls[4:]) >= calls[3] + 0.3 - 0.01
@@ -0,0 +1,49 @@
+from itertools import combinations
+
+from paradeller.scheduler import SeedScheduler
+
+# 8 seeds, each with a word of its own and a few shared by others
+WORDS = {
+    i: [f"own{i}", *(f"w{j}" for j in range(i % 4 + 1))] for i in range(1, 9)
+}
+
+
+def make_scheduler():
+    adj_list_words = {}
+    for id_, words in WORDS.items():
+        for word in words:
+            adj_list_words.setdefault(word, []).append(id_)
+    return SeedScheduler(list(WORDS), WORDS, adj_list_words)
+
+
+def pair_score(scheduler, pair):
+    return sum(scheduler.scores[scheduler.pos[id_]] for id_ in pair)
+
+
+def test_pairs_best_first_and_once_each():
+    scheduler = make_scheduler()
+    assert len(scheduler) == 28
+    pairs = []
+    while len(scheduler):
+        pairs.extend(scheduler.next_pairs(3))
+    assert scheduler.next_pairs(3) == []
+
+    expected = {tuple(sorted(pair)) for pair in combinations(WORDS, 2)}
+    assert len(pairs) == len(expected)
+    assert {tuple(sorted(pair)) for pair in pairs} == expected
+    scores = [pair_score(scheduler, pair) for pair in pairs]
+    assert scores == sorted(scores, reverse=True)
+
+
+def test_partner_whose_score_rises_comes_forward():
+    scheduler = make_scheduler()
+    handed_out = {tuple(sorted(pair)) for pair in scheduler.next_pairs(2)}
+
+    # stanzas seeded by the worst seed make its pairs the best ones left
+    best, worst = scheduler.ids[0], scheduler.ids[-1]
+    scheduler.record([(best, worst)], [((best, worst), [(best, worst)] * 50)])
+
+    (pair,) = scheduler.next_pairs(1)
+    assert worst in pair
+    left = [p for p in combinations(WORDS, 2) if p not in handed_out]
+    assert pair_score(scheduler, pair) == max(pair_score(scheduler, p) for p in left)
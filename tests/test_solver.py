@@ -0,0 +1,45 @@
+import random
+from collections import Counter
+from itertools import combinations
+
+import pytest
+
+from paradeller.analysis import find_valid_final_lines
+from paradeller.solver import exact_covers
+
+
+def brute_force_covers(pot_ids, adj_list_ids, target_words, k=6):
+    """Every group of k pot_ids whose words add up to target_words"""
+    target = Counter(target_words)
+    return [
+        group
+        for group in combinations(pot_ids, k)
+        if sum((Counter(adj_list_ids[id_]) for id_ in group), Counter()) == target
+    ]
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_exact_covers_same_as_brute_force(seed):
+    rng = random.Random(seed)
+    vocab = [f"w{i}" for i in range(4)]
+    adj_list_ids = {
+        id_: rng.choices(vocab, k=rng.randint(1, 3)) for id_ in range(100, 114)
+    }
+    pot_ids = list(adj_list_ids)
+    rng.shuffle(pot_ids)
+    target_words = [w for id_ in rng.sample(pot_ids, 6) for w in adj_list_ids[id_]]
+
+    expected = brute_force_covers(pot_ids, adj_list_ids, target_words)
+    assert expected
+    covers = list(exact_covers(pot_ids, adj_list_ids, target_words))
+    assert len(covers) == len(set(covers))
+    assert set(covers) == set(expected)
+    assert find_valid_final_lines(pot_ids, adj_list_ids, target_words) == expected
+
+
+def test_exact_covers_other_sizes():
+    adj_list_ids = {1: ["a"], 2: ["b"], 3: ["a", "b"], 4: ["a"], 5: ["b", "b"]}
+    pot_ids = [1, 2, 3, 4, 5]
+    for k in (1, 2, 3):
+        covers = set(exact_covers(pot_ids, adj_list_ids, ["a", "b", "b"], k=k))
+        assert covers == set(brute_force_covers(pot_ids, adj_list_ids, ["a", "b", "b"], k))
@@ -0,0 +1,74 @@
+from itertools import combinations
+
+import numpy as np
+import pytest
+
+from paradeller.analysis import find_final_stanzas, find_matches, stanza_triples
+from paradeller.bench.corpus import synthetic_corpus
+from paradeller.dataprep import prep_data
+from paradeller.discover import discover_stanzas
+from paradeller.index import CorpusIndex
+from paradeller.vectorized import VectorMatcher
+
+
+@pytest.fixture(scope="module")
+def index():
+    # a small vocabulary, so candidate pools are big and random stanzas common
+    data = synthetic_corpus(300, plant=2, vocab_size=40).data
+    _, _, _, adj_list_ids = prep_data(data, verbose=False)
+    return CorpusIndex.build(adj_list_ids)
+
+
+# a budget of 1 byte makes every batch a single row
+@pytest.fixture(params=[64_000_000, 1], ids=["budget", "tiny_budget"])
+def matcher(index, request):
+    return VectorMatcher(index, memory_budget=request.param)
+
+
+def test_find_matches_same_as_python(index, matcher):
+    # seeds that make stanzas, and some that don't
+    stanzas = discover_stanzas(index, nobar=True)
+    ids = {id_ for stanza in stanzas[:6] for id_ in stanza}
+    ids = sorted(ids | set(index.tweet_ids[:10].tolist()))
+    position = {id_: pos for pos, id_ in enumerate(ids)}
+    found = 0
+    for id1, id2 in combinations(ids, 2):
+        earlier = lambda id_: position.get(id_, position[id2]) < position[id2]
+        for kwargs in ({}, dict(earlier=earlier)):
+            expected = find_matches(
+                id1, id2, index.adj_list_ids, index.adj_list_words, **kwargs
+            )
+            assert expected == find_matches(
+                id1,
+                id2,
+                index.adj_list_ids,
+                index.adj_list_words,
+                matcher=matcher,
+                **kwargs,
+            )
+            found += len(expected)
+    assert found
+
+
+def test_final_stanzas_same_as_python(index, matcher):
+    stanzas = discover_stanzas(index, nobar=True)
+    found = 0
+    for triple in stanza_triples(stanzas, index.adj_list_ids, nobar=True):
+        expected = find_final_stanzas(
+            *triple, index.adj_list_ids, index.adj_list_words
+        )
+        assert expected == find_final_stanzas(
+            *triple, index.adj_list_ids, index.adj_list_words, matcher=matcher
+        )
+        found += len(expected)
+    assert found
+
+
+def test_batches_within_budget(index):
+    matcher = VectorMatcher(index, memory_budget=100)
+    items = np.arange(7)
+    nbytes = np.array([30, 30, 50, 250, 10, 10, 100])
+    batches = [batch.tolist() for batch in matcher._batches(items, nbytes)]
+    # an item bigger than the budget still gets a batch of its own
+    assert batches == [[0, 1], [2], [3], [4, 5], [6]]
+    assert list(matcher._batches(items[:0], nbytes[:0])) == []